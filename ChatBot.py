@@ -1,60 +1,301 @@
+import time
+import sys
+import_start = (time.perf_counter(), len(sys.modules))  # 顶层导入耗时（服务进程内首次运行时计入启动报告）
 import requests
 import streamlit as st
-from langchain.tools import DuckDuckGoSearchRun
-import PyPDF2
-from docx import Document
-import pandas as pd
-import chardet
 import base64
 import io
-from langchain.docstore.document import Document as LC_Document # 新增 langchain 相关依赖
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS  # 替换 Chroma
-from langchain.chains import RetrievalQA
-from langchain.llms import HuggingFaceHub
 import tempfile
 import os
-from pydub import AudioSegment
-from openai import OpenAI
-from bs4 import BeautifulSoup
-from duckduckgo_search import DDGS
 import re
+import json
+import logging
 from urllib.parse import urlparse
 import pickle
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import hashlib
+import sqlite3
+import uuid
+import shutil
+from collections import OrderedDict
 from datetime import datetime
+import threading
+import contextvars
+import itertools
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import http_client  # 进程级连接池（所有会话共享）
+import text_extraction  # 文档文本提取（可在子进程中运行）
+import token_budget  # 按模型计数 token 并按预算组装提示词
+import import_timing  # 启动与按需导入耗时统计
+import tracing  # 分阶段耗时追踪、JSON 日志与 Prometheus 指标
+# langchain/FAISS/embedding、文本切分、联网搜索、OpenAI SDK 等较重的依赖在首次使用处导入，
+# 只聊天的会话和服务冷启动不再为它们付出导入耗时
+
+script_run_start = time.perf_counter()  # 本次完整运行的开始时间（片段单独重跑时不会执行到这里）
+if len(sys.modules) > import_start[1]:
+    # 只有实际加载了新模块的运行（服务进程内首次运行）才计入启动报告
+    import_timing.record("启动（顶层导入）", script_run_start - import_start[0], len(sys.modules) - import_start[1])
+
+logger = logging.getLogger(__name__)
 
 # 全局变量定义
 CHROMADB_PATH = None
 COLLECTION_NAME = "rag_collection"
+EMBEDDING_MODEL_NAME = "shibing624/text2vec-base-chinese"
+EMBEDDING_WARMUP = os.environ.get("EMBEDDING_WARMUP", "1") == "1"  # 服务启动后是否在后台预加载向量模型
+# 文档入库流水线：按字符窗口惰性切分，分批编码写入，峰值内存与文档大小无关
+RAG_CHUNK_SIZE = 500
+RAG_CHUNK_OVERLAP = 50
+RAG_SPLIT_WINDOW = 20000  # 每次送入切分器的原始字符数
+RAG_EMBED_BATCH_SIZE = 20  # 每批编码并写入索引的文本块数
+# 文本提取进程池大小（默认取当前进程可用的 CPU 核数）
+EXTRACT_MAX_WORKERS = int(os.environ.get(
+    "EXTRACT_MAX_WORKERS",
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+))
+# 向量库增量日志（WAL）压缩策略：满足任一条件即把增量合并进快照
+WAL_COMPACT_ENTRIES = 5000  # 待合并的文本块数量
+WAL_COMPACT_SECONDS = 600  # 距上次快照的时间（秒）
+# 已删除文本块达到该数量（或占索引的比例）后触发后台清理
+PURGE_MIN_CHUNKS = 1000
+PURGE_RATIO = 0.1
+# 知识库检索方式：混合检索用倒数排序融合（RRF）合并向量与词法结果
+RETRIEVAL_MODES = ["混合检索", "向量检索", "词法预筛选"]
+RRF_K = 60
+LEXICAL_CANDIDATES = 200  # 词法预筛选时参与向量精排的候选数
+# FAISS 索引类型默认配置（每个知识库的实际配置保存在 index_config.json）
+INDEX_TYPES = ["Flat", "HNSW", "IVF"]
+DEFAULT_INDEX_CONFIG = {
+    "type": "Flat",
+    "hnsw_m": 32,  # HNSW 每个节点的邻居数
+    "ef_search": 64,  # HNSW 搜索时的候选队列长度
+    "ivf_nlist": 0,  # IVF 聚类中心数，0 表示按数据量自动计算
+    "nprobe": 8,  # IVF 搜索时访问的聚类数
+    "auto_migrate": True,  # Flat 索引超过阈值后自动迁移
+    "auto_threshold": 200000,  # 自动迁移的文本块数量阈值
+    "auto_type": "HNSW",  # 自动迁移的目标索引类型
+    "storage": "memory"  # 快照存储方式，见 STORAGE_MODES
+}
+STORAGE_MODES = {
+    "memory": "全部载入内存（pickle 快照）",
+    "lazy": "按需加载（内存映射 + SQLite 文档库）"
+}
+# 向量库快照可能包含的文件（两种存储方式），压缩时删除新快照中不再存在的文件
+# （vectors.f32、docstore.sqlite 即 lazy_vectorstore.VECTORS_FILE、DOCSTORE_FILE，此处不导入该模块以免启动时加载 FAISS）
+SNAPSHOT_FILES = {"index.faiss", "index.pkl", "vectors.f32", "docstore.sqlite"}
+# 支持 SSE 流式输出的模型（OpenAI 兼容接口及混元 OpenAI SDK）
+STREAMING_MODELS = {
+    "豆包", "DeepSeek-V3", "DeepSeek-R1(深度推理)", "通义千问", "智谱清言", "MiniMax",
+    "GPTs(聊天、语音识别)", "grok2", "Kimi(视觉理解)", "o1(深度推理)", "混元生文"
+}
+# 提示词 token 预算：系统提示词、历史与参考信息合计不超过模型上下文窗口的该比例（可在侧边栏调整）
+CONTEXT_SHARE = 0.6
+RAG_CONTEXT_SHARE = 0.5  # 检索到的参考信息最多占用提示词预算的比例，其余留给对话历史
+RAG_MAX_DOCS = 8  # 参与打包的检索结果数上限（按相关度依次填入预算）
+CHAT_HISTORY_MAX_MESSAGES = 200  # 每个模型保存的历史消息上限（实际发送多少由 token 预算决定）
+# 滚动摘要记忆：较早的对话在每轮结束后于后台折叠进摘要，提示词中只保留摘要和最近几条原文
+SUMMARY_KEEP_MESSAGES = 4  # 保持原文的最近消息数
+SUMMARY_TRIGGER_MESSAGES = 4  # 未折叠的早期消息达到该条数时发起摘要
+SUMMARY_TRIGGER_TOKENS = 1500  # 或未折叠的早期消息达到该 token 数时发起摘要（如联网搜索的长回答）
+SUMMARY_MESSAGE_TOKENS = 1000  # 送去摘要的每条消息最多保留的 token 数
+SUMMARY_MAX_TOKENS = 400  # 摘要长度上限
+# 单轮对话内并发分支（联网搜索 / RAG 检索）配置
+TURN_MAX_WORKERS = int(os.environ.get("TURN_MAX_WORKERS", "8"))  # 进程级线程池大小，所有会话共享
+SEARCH_BRANCH_TIMEOUT = 60  # 联网搜索分支截止时间（秒，从本轮开始计）
+RAG_BRANCH_TIMEOUT = 90  # RAG 检索分支截止时间（秒，从本轮开始计）
+COMPARE_TIMEOUT = 180  # 对比模式下单个模型的截止时间（秒）
+# 响应缓存配置
+RESPONSE_CACHE_PATH = os.environ.get(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".multi_llm_agent", "response_cache.sqlite")
+)
+RESPONSE_CACHE_MEMORY_ENTRIES = 256  # 内存 LRU 层最多保留的条目数
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # 缓存有效期（秒）
+RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024  # SQLite 层最大容量，超出后按最久未访问淘汰
+# 对话记录持久化配置：每个对话以 conversation_id 存入 SQLite，界面只渲染最近的消息
+CHAT_STORE_PATH = os.environ.get(
+    "CHAT_STORE_PATH",
+    os.path.join(os.path.expanduser("~"), ".multi_llm_agent", "chat_history.sqlite")
+)
+CHAT_RENDER_MESSAGES = 20  # 会话内保留并渲染的最近消息数
+CHAT_PAGE_SIZE = 20  # 每次加载的更早消息数
+CHAT_WRITE_BEHIND_SECONDS = 1.0  # 追加的消息在后台批量提交的间隔（秒）
+CHAT_WRITE_BATCH = 100  # 待提交消息达到该数量时立即提交
+RUN_TIMING_SAMPLES = 20  # 每个运行范围保留的耗时样本数
+# 分阶段耗时追踪：JSON 行日志（"-" 输出到标准错误，空值关闭）与本地 Prometheus 端点（端口为 0 时关闭）
+TRACE_LOG_PATH = os.environ.get(
+    "TRACE_LOG_PATH",
+    os.path.join(os.path.expanduser("~"), ".multi_llm_agent", "trace.jsonl")
+)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+TURN_TRACE_HISTORY = 20  # 会话内保留的最近轮次耗时分解数
+TRACE_STAGE_LABELS = {
+    "search": "联网搜索",
+    "fetch": "网页抓取",
+    "extract": "文本提取",
+    "split": "文本切分",
+    "embed": "向量编码",
+    "index_write": "写入索引",
+    "retrieve": "知识库检索",
+    "llm_ttft": "模型首字",
+    "llm_total": "模型总耗时",
+}
+# 语义缓存配置
+SEMANTIC_CACHE_THRESHOLD = 0.92  # 默认余弦相似度阈值
+SEMANTIC_CACHE_MAX_ENTRIES = 500  # 每个作用域（模型 + 助手角色）最多保留的问题数
+SEMANTIC_CACHE_TTL = 24 * 3600  # 语义缓存条目有效期（秒）
 
 # 在文件开头添加会话管理相关的初始化
+if "run_timings" not in st.session_state:
+    st.session_state.run_timings = {}  # 运行范围（完整运行 / 各片段）-> 最近的耗时（毫秒）
+
+def record_run_time(scope, start_time):
+    """记录一次完整运行或片段运行的耗时，每个范围保留最近 RUN_TIMING_SAMPLES 次"""
+    samples = st.session_state.run_timings.setdefault(scope, [])
+    samples.append((time.perf_counter() - start_time) * 1000)
+    del samples[:-RUN_TIMING_SAMPLES]
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_server():
+    """进程级：配置追踪日志并启动本地 /metrics 端点，端口被占用或已关闭时返回 None"""
+    try:
+        tracing.configure_log(TRACE_LOG_PATH)
+    except OSError as e:
+        logger.warning("追踪日志不可用（%s）：%s", TRACE_LOG_PATH, e)
+    if not METRICS_PORT:
+        return None
+    try:
+        return tracing.start_metrics_server(METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        # 同一主机上运行多个服务进程时端口可能已被占用，追踪和日志照常进行
+        logger.warning("指标端点启动失败（%s:%s）：%s", METRICS_HOST, METRICS_PORT, e)
+        return None
+
+get_metrics_server()
+
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = {}  # 用于存储不同模型的对话历史
+if "chat_history_lock" not in st.session_state:
+    st.session_state.chat_history_lock = threading.Lock()  # 并发分支同时写入历史时加锁
 
 def manage_chat_history(model_type, role, content):
-    """管理对话历史"""
-    if model_type not in st.session_state.chat_history:
-        st.session_state.chat_history[model_type] = []
-    
-    # 添加新消息
-    st.session_state.chat_history[model_type].append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
-    
-    # 保持历史记录在合理范围内（最近10轮对话）
-    max_history = 10
-    if len(st.session_state.chat_history[model_type]) > max_history * 2:  # 每轮包含用户和助手的消息
-        st.session_state.chat_history[model_type] = st.session_state.chat_history[model_type][-max_history * 2:]
+    """管理对话历史（已超时取消的分支不再写入）"""
+    if branch_cancelled():
+        return
+    with st.session_state.chat_history_lock:
+        if model_type not in st.session_state.chat_history:
+            st.session_state.chat_history[model_type] = []
+        
+        # 添加新消息（同时写入对话存储）
+        message = {
+            "role": role,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            "seq": None  # 提交到对话存储时分配
+        }
+        st.session_state.chat_history[model_type].append(message)
+        get_conversation_store().append(st.session_state.conversation_id, model_type, message)
+        
+        # 保存的历史只设上限，每轮实际发送的历史由 token 预算决定
+        if len(st.session_state.chat_history[model_type]) > CHAT_HISTORY_MAX_MESSAGES:
+            st.session_state.chat_history[model_type] = st.session_state.chat_history[model_type][-CHAT_HISTORY_MAX_MESSAGES:]
 
 def get_chat_history(model_type):
     """获取指定模型的对话历史"""
     return st.session_state.chat_history.get(model_type, [])
 
-def format_messages_for_model(model_type, current_prompt):
-    """根据不同模型格式化消息历史"""
+def get_history_summary(model_type):
+    """摘要记忆开启时返回该模型早期对话的滚动摘要"""
+    if not st.session_state.get("summary_memory_enabled"):
+        return None
+    state = st.session_state.chat_summaries.get(model_type)
+    return state["summary"] if state else None
+
+def get_history_for_prompt(model_type):
+    """发送给模型的原始历史：摘要记忆开启时只包含尚未折叠进摘要的消息"""
+    history = get_chat_history(model_type)
+    state = st.session_state.chat_summaries.get(model_type)
+    if not st.session_state.get("summary_memory_enabled") or not state:
+        return history
+    return [msg for msg in history if msg["timestamp"] > state["covered_until"]]
+
+def summarize_history(model_type, summary, messages):
+    """把新的对话折叠进已有摘要，返回更新后的摘要（失败返回 None）"""
+    counter = token_budget.get_counter()
+    dialogue = "\n".join(
+        f"{'用户' if msg['role'] == 'user' else '助手'}: "
+        f"{counter.truncate(msg['content'], SUMMARY_MESSAGE_TOKENS, model_type)}"
+        for msg in messages
+    )
+    prompt = (
+        f"请把下面的新增对话合并进已有摘要，输出更新后的摘要。保留用户的目标和偏好、已确认的事实、数字和结论，"
+        f"以及尚未解决的问题；省略寒暄和搜索结果原文。摘要不超过 {SUMMARY_MAX_TOKENS} 个 token，"
+        f"使用与对话相同的语言，只输出摘要本身。\n\n"
+        f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{dialogue}"
+    )
+    result = call_model_api(prompt, model_type, use_cache=False, standalone=True)
+    return result.strip() if isinstance(result, str) and result.strip() else None
+
+def schedule_history_summary(model_type):
+    """本轮结束后在后台把较早的对话折叠进滚动摘要（每个模型同时只运行一个摘要任务）
+
+    最近 SUMMARY_KEEP_MESSAGES 条消息保持原文；未折叠的早期消息达到阈值才发起摘要请求。
+    """
+    if not st.session_state.summary_memory_enabled or model_type not in token_budget.MODEL_CONTEXT_WINDOWS:
+        return None
+    summaries = st.session_state.chat_summaries
+    state = summaries.setdefault(model_type, {"summary": None, "covered_until": "", "folded": 0, "future": None})
+    if state["future"] is not None and not state["future"].done():
+        return None
+    history = get_chat_history(model_type)
+    older = [msg for msg in history[:-SUMMARY_KEEP_MESSAGES] if msg["timestamp"] > state["covered_until"]]
+    # 从完整的一轮开始折叠
+    while older and older[-1]["role"] == "user":
+        older.pop()
+    if not older:
+        return None
+    older_tokens = sum(token_budget.count_tokens(msg["content"], model_type) for msg in older)
+    if older_tokens < SUMMARY_TRIGGER_TOKENS and len(older) < SUMMARY_TRIGGER_MESSAGES:
+        return None
+    
+    def run():
+        summary = summarize_history(model_type, state["summary"], older)
+        if summary:
+            state["summary"] = summary
+            state["covered_until"] = older[-1]["timestamp"]
+            state["folded"] += len(older)
+        return summary
+    
+    state["future"] = submit_with_script_ctx(run)
+    return state["future"]
+
+def get_prompt_budget(model_type):
+    """本轮提示词的 token 预算（上下文窗口按会话设置的比例，并为回答预留 max_tokens）"""
+    return token_budget.prompt_budget(
+        model_type, st.session_state.get("context_share", CONTEXT_SHARE), st.session_state.max_tokens
+    )
+
+def fit_history_to_budget(model_type, history, current_prompt, budget, fixed_messages=()):
+    """在预算内保留最近的历史消息：先扣除与历史一同发送的消息，剩余预算从新到旧填入历史
+
+    fixed_messages 为与历史一同发送的其他消息，默认只有当前问题。
+    当前问题已作为最后一条历史记录时不重复发送。
+    """
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == current_prompt:
+        history = history[:-1]
+    fixed = list(fixed_messages) or [{"role": "user", "content": current_prompt}]
+    remaining = budget - token_budget.count_messages(fixed, model_type)
+    return token_budget.fit_history(history, remaining, model_type)
+
+def format_messages_for_model(model_type, current_prompt, budget_models=None):
+    """根据不同模型格式化消息历史
+
+    历史消息按 token 预算从新到旧保留；budget_models 指定多个模型时（对比模式）取其中最小的预算。
+    """
     messages = []
     
     # 添加系统提示词
@@ -74,8 +315,15 @@ def format_messages_for_model(model_type, current_prompt):
     
     messages.append(system_message)
     
-    # 添加历史消息
-    history = get_chat_history(model_type)
+    # 已折叠进摘要的早期对话以摘要形式放入系统提示词
+    summary = get_history_summary(model_type)
+    if summary:
+        system_message["content"] += f"\n\n此前对话的摘要：\n{summary}"
+    
+    # 添加预算内的历史消息
+    budget = min(get_prompt_budget(m) for m in (budget_models or [model_type]))
+    history = fit_history_to_budget(model_type, get_history_for_prompt(model_type), current_prompt, budget,
+                                    [system_message, {"role": "user", "content": current_prompt}])
     for msg in history:
         messages.append({
             "role": msg["role"],
@@ -91,12 +339,16 @@ def format_messages_for_model(model_type, current_prompt):
     return messages
 
 # ChromaDB 配置函数
+@st.fragment
 def configure_chromadb():
-    """配置 ChromaDB 存储路径"""
+    """配置 ChromaDB 存储路径（独立片段：知识库设置的操作只重新运行本面板）"""
+    run_start = time.perf_counter()
     st.divider()
     with st.expander("🗄️ RAG知识库设置与管理", expanded=not bool(st.session_state.get("chromadb_path"))):
         st.markdown("### 向量数据库存储路径")
         
+        st.caption(describe_embedding_status())
+        
         # 默认路径设置
         default_path = os.path.join(os.path.expanduser("~"), "chromadb_data")
         
@@ -104,6 +356,17 @@ def configure_chromadb():
         current_path = st.session_state.get("chromadb_path", "")
         if current_path:
             st.info(f"当前路径：{current_path}")
+            cache_stats = get_embedding_cache(os.path.join(current_path, "embedding_cache")).snapshot()
+            st.caption(
+                f"向量缓存：命中率 {cache_stats['hit_rate']:.0%}（命中 {cache_stats['hits']} / "
+                f"未命中 {cache_stats['misses']}），共 {cache_stats['entries']} 条，"
+                f"{cache_stats['bytes'] / 1024 / 1024:.1f} MB"
+            )
+            registry_stats = get_document_registry(current_path).snapshot()
+            st.caption(
+                f"已登记文档：{registry_stats['documents']} 个，共 {registry_stats['chunks']} 个文本块；"
+                f"待清理的已删除文本块：{registry_stats['pending_purge']} 个"
+            )
         
         # 路径输入
         new_path = st.text_input(
@@ -136,6 +399,31 @@ def configure_chromadb():
             except Exception as e:
                 st.error(f"路径设置失败：{str(e)}")
         
+        if st.session_state.get("chromadb_path"):
+            configure_index_settings()
+            configure_retrieval_settings()
+            
+            # 增量日志状态与手动压缩
+            wal = get_vector_wal(os.path.join(st.session_state.chromadb_path, "faiss_index"))
+            pending = wal.pending_count()
+            st.caption(f"待合并增量：{pending} 个文本块（满 {WAL_COMPACT_ENTRIES} 个或 {WAL_COMPACT_SECONDS // 60} 分钟后自动合并）")
+            pending_purge = get_document_registry(st.session_state.chromadb_path).snapshot()["pending_purge"]
+            if st.button("🗜️ 立即合并快照", disabled=pending == 0 and pending_purge == 0):
+                vectorstore = get_vector_store()
+                if vectorstore:
+                    with st.spinner("正在写入快照..."):
+                        removed = compact_vector_store(vectorstore, st.session_state.chromadb_path)
+                    st.success(f"✅ 快照已更新（清理已删除文本块 {removed} 个）")
+            
+            # 按来源删除文档
+            sources = get_document_registry(st.session_state.chromadb_path).sources()
+            if sources:
+                selected_sources = st.multiselect("选择要删除的文档", sources, key="delete_sources")
+                if st.button("🗑️ 删除所选文档", disabled=not selected_sources):
+                    for source in selected_sources:
+                        removed = delete_knowledge_source(source)
+                        st.success(f"✅ 已删除 {source}（{removed} 个文本块）")
+        
         # 清空知识库按钮
         if st.button("🗑️ 清空知识库"):
             if clear_vector_store():
@@ -149,6 +437,7 @@ def configure_chromadb():
         3. 建议选择本地固定位置
         4. 确保有足够存储空间
         """)
+    record_run_time("知识库设置", run_start)
 
 # 初始化会话状态
 if "messages" not in st.session_state:
@@ -177,12 +466,42 @@ if "max_tokens" not in st.session_state:
     st.session_state.max_tokens = 2048
 if "chromadb_path" not in st.session_state:
     st.session_state.chromadb_path = ""
-if "vector_store" not in st.session_state:
-    st.session_state.vector_store = None
+if "retrieval_mode" not in st.session_state:
+    st.session_state.retrieval_mode = RETRIEVAL_MODES[0]
+if "stream_enabled" not in st.session_state:
+    st.session_state.stream_enabled = True
+if "summary_memory_enabled" not in st.session_state:
+    st.session_state.summary_memory_enabled = True
+if "chat_summaries" not in st.session_state:
+    st.session_state.chat_summaries = {}  # 模型 -> 滚动摘要状态
+if "turn_metrics" not in st.session_state:
+    st.session_state.turn_metrics = []
+if "turn_traces" not in st.session_state:
+    st.session_state.turn_traces = []  # 最近各轮的分阶段耗时分解
+if "turn_prompt_tokens" not in st.session_state:
+    st.session_state.turn_prompt_tokens = []  # 本轮各请求发送的提示词 token 数
+if "context_share" not in st.session_state:
+    st.session_state.context_share = CONTEXT_SHARE
+if "response_cache_enabled" not in st.session_state:
+    st.session_state.response_cache_enabled = True
+if "cache_nondeterministic" not in st.session_state:
+    st.session_state.cache_nondeterministic = False  # 默认不缓存 temperature > 0 的回答
+if "semantic_cache_enabled" not in st.session_state:
+    st.session_state.semantic_cache_enabled = False
+if "semantic_cache_threshold" not in st.session_state:
+    st.session_state.semantic_cache_threshold = SEMANTIC_CACHE_THRESHOLD
+if "compare_enabled" not in st.session_state:
+    st.session_state.compare_enabled = False
+if "compare_models" not in st.session_state:
+    st.session_state.compare_models = []
+if "compare_results" not in st.session_state:
+    st.session_state.compare_results = []
 if "selected_assistant" not in st.session_state:
     st.session_state.selected_assistant = None
-if "assistant_market" not in st.session_state:
-    st.session_state.assistant_market = {
+@st.cache_resource(show_spinner=False)
+def get_assistant_market():
+    """助手市场的角色提示词（静态数据，进程内只构建一次，所有会话共享同一份）"""
+    return {
         "金融领域": {
             "财务分析师": """[角色指南] 专业财务分析师，专长领域：
 1. 财务报表分析和解读
@@ -397,50 +716,219 @@ if "assistant_market" not in st.session_state:
         }
     }
 
+if "assistant_market" not in st.session_state:
+    st.session_state.assistant_market = get_assistant_market()
+
 # 页面配置
 st.set_page_config(page_title="多模型智能助手2.10(学术增强版)", layout="wide")
 
 # 初始化/加载 langchain 封装的 Chroma 向量库
+def iter_vector_store_documents(vectorstore):
+    """按索引位置顺序产出 (chunk_id, Document)"""
+    from langchain_core.documents import Document as LC_Document
+    for _, chunk_id in sorted(vectorstore.index_to_docstore_id.items()):
+        doc = vectorstore.docstore.search(chunk_id)
+        if isinstance(doc, LC_Document):
+            yield chunk_id, doc
+
+def convert_vector_store(vectorstore, storage):
+    """按存储方式转换向量库实例（内容不变），已是目标格式时原样返回"""
+    import lazy_vectorstore
+    is_lazy = isinstance(vectorstore, lazy_vectorstore.LazyFAISS)
+    if storage == "lazy" and not is_lazy:
+        return lazy_vectorstore.LazyFAISS.from_store(vectorstore)
+    if storage == "memory" and is_lazy:
+        return vectorstore.to_memory()
+    return vectorstore
+
+class ReadWriteLock:
+    """读写锁：检索可以并发持有读锁，写入独占写锁
+
+    有写者等待时新的读者排队，避免持续的检索让写入饿死；
+    写锁可被同一线程重入，持有写锁的线程也可以直接获取读锁。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None  # 持有写锁的线程
+        self._write_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+            else:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer, self._write_depth = me, 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+class SharedVectorStore:
+    """进程级共享的向量库：同一知识库路径的所有会话共用一个实例
+
+    检索持读锁并发执行；新增文本块、清理、索引迁移和格式转换持写锁，
+    每次写入后版本号加一，会话据此发现其他会话对知识库的修改。
+    """
+
+    def __init__(self, db_root):
+        self.db_root = db_root
+        self.store = None
+        self.lock = ReadWriteLock()
+        self.version = 0
+        self.load_seconds = None
+        self._load_lock = threading.Lock()
+        self._sessions = {}  # 会话 id -> 最近访问时间
+
+    def get(self, loader):
+        """返回共享实例，首次访问时由 loader 加载（加载失败返回 None，下次重试）"""
+        if self.store is None:
+            with self._load_lock:
+                if self.store is None:
+                    load_start = time.perf_counter()
+                    store = loader()
+                    if store is not None:
+                        self.load_seconds = time.perf_counter() - load_start
+                        self.store = store
+        return self.store
+
+    @contextmanager
+    def writing(self):
+        """持写锁修改向量库，结束后递增版本号"""
+        with self.lock.write():
+            try:
+                yield
+            finally:
+                self.version += 1
+
+    def replace(self, store):
+        """替换共享实例（格式转换后）"""
+        with self.writing():
+            self.store = store
+
+    def touch(self):
+        """知识库内容变化但索引未改动（如按来源删除）时递增版本号"""
+        with self.writing():
+            pass
+
+    def attach(self, session_id):
+        self._sessions[session_id] = time.time()
+
+    def active_sessions(self, window=1800):
+        """最近 window 秒内访问过的会话数"""
+        cutoff = time.time() - window
+        return sum(1 for last_seen in list(self._sessions.values()) if last_seen >= cutoff)
+
+@st.cache_resource(show_spinner=False)
+def get_shared_vector_store(db_root):
+    """按知识库路径共享的进程级向量库句柄"""
+    return SharedVectorStore(db_root)
+
+def load_vector_store(db_root):
+    """从快照和增量日志加载向量库（不存在时新建），失败返回 None"""
+    db_path = os.path.join(db_root, "faiss_index")
+    with import_timing.subsystem("向量库"):
+        import lazy_vectorstore
+        from langchain_community.vectorstores import FAISS
+    
+    # 获取 embeddings
+    embeddings = get_embeddings()
+    if not embeddings:
+        return None
+        
+    # 如果存在现有快照，则加载（按需加载格式无需反序列化 pickle）
+    if os.path.exists(os.path.join(db_path, lazy_vectorstore.DOCSTORE_FILE)):
+        try:
+            vectorstore = lazy_vectorstore.LazyFAISS.load_lazy(db_path, embeddings)
+        except Exception as e:
+            st.error(f"加载向量库失败：{str(e)}")
+            return None
+    elif os.path.exists(os.path.join(db_path, "index.pkl")):
+        try:
+            vectorstore = FAISS.load_local(
+                db_path, 
+                embeddings,
+                allow_dangerous_deserialization=True  # 添加此参数
+            )
+        except Exception as e:
+            st.error(f"加载向量库失败：{str(e)}")
+            return None
+    else:
+        # 如果不存在，创建新的向量库实例
+        vectorstore = FAISS.from_texts(
+            texts=["初始化文档"],
+            embedding=embeddings
+        )
+    
+    # 回放快照之后追加的增量日志
+    get_vector_wal(db_path).replay(vectorstore, get_document_registry(db_root).deleted_ids())
+    
+    # 为启用混合检索之前建立的知识库补建倒排索引
+    lexical = get_lexical_index(db_root)
+    if lexical.count() == 0 and vectorstore.index.ntotal > 1:
+        items = [(chunk_id, doc.page_content) for chunk_id, doc in iter_vector_store_documents(vectorstore)
+                 if doc.page_content != "初始化文档"]
+        lexical.add([chunk_id for chunk_id, _ in items], [text for _, text in items])
+    
+    # 存储方式与配置不一致时转换格式并重写快照
+    index_config = load_index_config(db_root)
+    converted = convert_vector_store(vectorstore, index_config["storage"])
+    apply_index_config(converted, index_config)
+    if converted is not vectorstore:
+        compact_vector_store(converted, db_root)
+    return converted
+
 def get_vector_store():
-    """获取向量数据库实例"""
+    """获取向量数据库实例（同一路径的所有会话共享，只加载一次）"""
     try:
         # 检查是否已设置路径
         if not st.session_state.get("chromadb_path"):
             st.error("⚠️ 请先在侧边栏设置向量数据库存储路径！")
             return None
-            
-        # 如果向量库已经在会话状态中，直接返回
-        if st.session_state.get("vector_store") is not None:
-            return st.session_state.vector_store
-            
-        # 使用用户设置的路径
-        db_path = os.path.join(st.session_state.chromadb_path, "faiss_index")
         
-        # 获取 embeddings
-        embeddings = get_embeddings()
-        if not embeddings:
+        db_root = st.session_state.chromadb_path
+        shared = get_shared_vector_store(db_root)
+        vectorstore = shared.get(lambda: load_vector_store(db_root))
+        if vectorstore is None:
             return None
-            
-        # 如果存在现有索引，则加载
-        if os.path.exists(db_path):
-            try:
-                vectorstore = FAISS.load_local(
-                    db_path, 
-                    embeddings,
-                    allow_dangerous_deserialization=True  # 添加此参数
-                )
-                st.session_state.vector_store = vectorstore
-                return vectorstore
-            except Exception as e:
-                st.error(f"加载向量库失败：{str(e)}")
-                return None
         
-        # 如果不存在，创建新的向量库实例
-        vectorstore = FAISS.from_texts(
-            texts=["初始化文档"],
-            embedding=embeddings
-        )
-        st.session_state.vector_store = vectorstore
+        ctx = get_script_run_ctx()
+        if ctx:
+            shared.attach(ctx.session_id)
+        # 其他会话修改过知识库时刷新本会话的文档列表
+        seen_version = st.session_state.get("vector_store_version")
+        if seen_version is not None and seen_version != shared.version:
+            st.session_state.rag_data = get_document_registry(db_root).sources()
+        st.session_state.vector_store_version = shared.version
         return vectorstore
         
     except Exception as e:
@@ -449,30 +937,1293 @@ def get_vector_store():
         st.error(f"详细错误：{traceback.format_exc()}")
         return None
 
-# 初始化 DuckDuckGo 搜索工具
-search_tool = DuckDuckGoSearchRun()
+class VectorStoreWAL:
+    """向量库的追加式增量日志
+
+    新增文本块的向量追加写入 wal.vec（float32 行），文本、元数据和 docstore id
+    逐行写入 wal.jsonl，两者按行号一一对应。加载时在快照之上回放日志，
+    压缩时把内存中的完整向量库写成新快照并清空日志，因此单次入库的 I/O 只与增量大小相关。
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(db_path, exist_ok=True)
+        self.db_path = db_path
+        self.vectors_path = os.path.join(db_path, "wal.vec")
+        self.records_path = os.path.join(db_path, "wal.jsonl")
+        self._lock = threading.RLock()
+        self.maintenance_lock = threading.RLock()  # 索引重建/快照与入库互斥
+        self.purge_lock = threading.Lock()  # 后台清理任务标记（由清理线程释放，不能用 maintenance_lock）
+        snapshots = [os.path.join(db_path, name) for name in SNAPSHOT_FILES if os.path.exists(os.path.join(db_path, name))]
+        self.last_compaction = max(map(os.path.getmtime, snapshots)) if snapshots else time.time()
+        # 日志条数只在打开时读一次文件，之后随追加和压缩在内存中维护
+        self._pending = 0
+        if os.path.exists(self.records_path):
+            with open(self.records_path, "rb") as f:
+                self._pending = sum(1 for _ in f)
+
+    def append(self, ids, texts, metadatas, vectors):
+        """追加一批文本块（先写向量再写记录，回放时以两者较短者为准）"""
+        import numpy as np
+        matrix = np.asarray(vectors, dtype="float32")
+        with self._lock:
+            with open(self.vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.records_path, "a", encoding="utf-8") as f:
+                for doc_id, text, metadata in zip(ids, texts, metadatas):
+                    f.write(json.dumps({"id": doc_id, "text": text, "metadata": metadata,
+                                        "dim": matrix.shape[1]}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending += len(ids)
+
+    def _read(self):
+        """读取日志，返回 (records, vectors)；忽略写入中断造成的不完整尾部（调用方需持有锁）"""
+        import numpy as np
+        records = []
+        if os.path.exists(self.records_path):
+            with open(self.records_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        if not records or not os.path.exists(self.vectors_path):
+            return [], None
+        dimension = records[0]["dim"]
+        vectors = np.fromfile(self.vectors_path, dtype="float32")
+        rows = min(len(records), len(vectors) // dimension)
+        return records[:rows], vectors[:rows * dimension].reshape(rows, dimension)
+
+    def replay(self, vectorstore, skip_ids=()):
+        """把日志中尚未包含在向量库里的文本块加入向量库（跳过 skip_ids 中已删除的文本块），返回回放条数"""
+        from langchain_core.documents import Document as LC_Document
+        with self._lock:
+            records, vectors = self._read()
+        skip_ids = set(skip_ids)
+        pending = [(record, vector) for record, vector in zip(records, vectors if vectors is not None else [])
+                   if record["id"] not in skip_ids
+                   and not isinstance(vectorstore.docstore.search(record["id"]), LC_Document)]
+        if pending:
+            vectorstore.add_embeddings(
+                text_embeddings=[(record["text"], vector.tolist()) for record, vector in pending],
+                metadatas=[record["metadata"] for record, _ in pending],
+                ids=[record["id"] for record, _ in pending]
+            )
+        return len(pending)
+
+    def pending_count(self):
+        with self._lock:
+            return self._pending
+
+    def should_compact(self):
+        pending = self.pending_count()
+        return (pending >= WAL_COMPACT_ENTRIES
+                or (pending > 0 and time.time() - self.last_compaction >= WAL_COMPACT_SECONDS))
+
+    def compact(self, vectorstore, skip_ids=(), **save_options):
+        """把完整向量库写成新快照并清空日志
+
+        持锁回放其他会话追加的增量，保证快照不丢数据；快照写入临时目录后再替换。
+        save_options 原样传给 save_local（按需加载格式可在写快照时移除文本块）。
+        """
+        with self._lock:
+            self.replay(vectorstore, skip_ids)
+            tmp_path = self.db_path + ".tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            vectorstore.save_local(tmp_path, **save_options)
+            written = set(os.listdir(tmp_path))
+            for name in written:
+                os.replace(os.path.join(tmp_path, name), os.path.join(self.db_path, name))
+            # 删除另一种存储方式遗留的快照文件
+            for name in SNAPSHOT_FILES - written:
+                if os.path.exists(os.path.join(self.db_path, name)):
+                    os.remove(os.path.join(self.db_path, name))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            for path in (self.vectors_path, self.records_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._pending = 0
+            self.last_compaction = time.time()
+
+@st.cache_resource(show_spinner=False)
+def get_vector_wal(db_path):
+    """按向量库路径共享的进程级增量日志"""
+    return VectorStoreWAL(db_path)
+
+class DocumentRegistry:
+    """知识库文档登记表：按内容哈希记录已入库文档的来源、文本块 id、块数和入库时间
+
+    与 faiss_index 同目录的 SQLite 文件，判断文档是否已入库只需一次主键查询。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "content_hash TEXT PRIMARY KEY, source TEXT, chunk_ids TEXT, "
+            "chunk_count INTEGER, indexed_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_source ON documents (source)")
+        # 已删除文本块的墓碑：检索时过滤，后台清理从索引中物理移除后标记 purged
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tombstones ("
+            "chunk_id TEXT PRIMARY KEY, source TEXT, deleted_at REAL, purged INTEGER DEFAULT 0)"
+        )
+        self._conn.commit()
+        self._deleted = {row[0] for row in self._conn.execute("SELECT chunk_id FROM tombstones")}
+
+    def get(self, content_hash):
+        """返回已登记文档的信息，未登记时返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source, chunk_ids, chunk_count, indexed_at FROM documents WHERE content_hash = ?",
+                (content_hash,)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "content_hash": content_hash,
+            "source": row[0],
+            "chunk_ids": json.loads(row[1]),
+            "chunk_count": row[2],
+            "indexed_at": row[3]
+        }
+
+    def register(self, content_hash, source, chunk_ids):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (content_hash, source, chunk_ids, chunk_count, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, source, json.dumps(chunk_ids), len(chunk_ids), time.time())
+            )
+            self._conn.commit()
+
+    def delete_source(self, source, keep_hash=None):
+        """删除某个来源的全部文档（keep_hash 指定的版本除外），文本块记为墓碑，返回删除的文本块数"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash, chunk_ids FROM documents WHERE source = ? AND content_hash != ?",
+                (source, keep_hash or "")
+            ).fetchall()
+            chunk_ids = [chunk_id for _, ids in rows for chunk_id in json.loads(ids)]
+            self._add_tombstones(source, chunk_ids)
+            self._conn.executemany(
+                "DELETE FROM documents WHERE content_hash = ?", [(row[0],) for row in rows]
+            )
+            self._conn.commit()
+            self._deleted.update(chunk_ids)
+        return len(chunk_ids)
+
+    def discard(self, source, chunk_ids):
+        """把未登记的文本块（入库中途失败时已写入索引的部分）记为墓碑"""
+        with self._lock:
+            self._add_tombstones(source, chunk_ids)
+            self._conn.commit()
+            self._deleted.update(chunk_ids)
+
+    def _add_tombstones(self, source, chunk_ids):
+        deleted_at = time.time()
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO tombstones (chunk_id, source, deleted_at) VALUES (?, ?, ?)",
+            [(chunk_id, source, deleted_at) for chunk_id in chunk_ids]
+        )
+
+    def is_deleted(self, chunk_id):
+        return chunk_id in self._deleted
+
+    def deleted_ids(self):
+        with self._lock:
+            return set(self._deleted)
+
+    def pending_purge(self):
+        """返回尚未从索引中物理移除的墓碑文本块 id"""
+        with self._lock:
+            rows = self._conn.execute("SELECT chunk_id FROM tombstones WHERE purged = 0").fetchall()
+        return [row[0] for row in rows]
+
+    def mark_purged(self, chunk_ids):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE tombstones SET purged = 1 WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids]
+            )
+            self._conn.commit()
+
+    def sources(self):
+        """按入库时间返回所有来源"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source FROM documents GROUP BY source ORDER BY MIN(indexed_at)"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def snapshot(self):
+        with self._lock:
+            documents, chunks = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(chunk_count), 0) FROM documents"
+            ).fetchone()
+            pending = self._conn.execute("SELECT COUNT(*) FROM tombstones WHERE purged = 0").fetchone()[0]
+        return {"documents": documents, "chunks": chunks, "pending_purge": pending}
+
+@st.cache_resource(show_spinner=False)
+def get_document_registry(db_root):
+    """按知识库路径共享的进程级文档登记表"""
+    os.makedirs(db_root, exist_ok=True)
+    return DocumentRegistry(os.path.join(db_root, "documents.sqlite"))
+
+def lexical_terms(text):
+    """切分检索词：中文按相邻两字切成二元组，英文单词和数字（股票代码、基金代码、条文编号等）整体成词"""
+    terms = []
+    for run in re.findall(r'[\u4e00-\u9fff]+|[A-Za-z0-9]+', text):
+        if '\u4e00' <= run[0] <= '\u9fff':
+            terms.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+        else:
+            terms.append(run.lower())
+    return terms
+
+class LexicalIndex:
+    """中文二元组 + 词的倒排索引（SQLite FTS5，BM25 排序），与向量库同步维护
+
+    入库时写入预先切好的检索词，FTS5 按空格分词，因此二元组和数字代码都能精确命中。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(body)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunk_rows (chunk_id TEXT PRIMARY KEY, row INTEGER)")
+        self._conn.commit()
+
+    def add(self, chunk_ids, texts):
+        with self._lock:
+            for chunk_id, text in zip(chunk_ids, texts):
+                cursor = self._conn.execute("INSERT INTO terms (body) VALUES (?)", (" ".join(lexical_terms(text)),))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO chunk_rows (chunk_id, row) VALUES (?, ?)", (chunk_id, cursor.lastrowid)
+                )
+            self._conn.commit()
+
+    def delete(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                row = self._conn.execute("SELECT row FROM chunk_rows WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM terms WHERE rowid = ?", row)
+                    self._conn.execute("DELETE FROM chunk_rows WHERE chunk_id = ?", (chunk_id,))
+            self._conn.commit()
+
+    def search(self, query, limit):
+        """按 BM25 返回最相关的文本块 id"""
+        terms = list(dict.fromkeys(lexical_terms(query)))[:64]
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_rows.chunk_id FROM terms JOIN chunk_rows ON chunk_rows.row = terms.rowid "
+                "WHERE terms MATCH ? ORDER BY bm25(terms) LIMIT ?",
+                (match, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunk_rows").fetchone()[0]
+
+@st.cache_resource(show_spinner=False)
+def get_lexical_index(db_root):
+    """按知识库路径共享的进程级倒排索引"""
+    os.makedirs(db_root, exist_ok=True)
+    return LexicalIndex(os.path.join(db_root, "lexical.sqlite"))
+
+def skip_if_indexed(content_hash, source):
+    """内容哈希已登记时提示并返回 True（内容未变化的文档无需重新入库）"""
+    existing = get_document_registry(st.session_state.chromadb_path).get(content_hash)
+    if not existing:
+        return False
+    indexed_at = datetime.fromtimestamp(existing["indexed_at"]).strftime("%Y-%m-%d %H:%M")
+    note = f"，与 {existing['source']} 内容相同" if existing["source"] != source else ""
+    st.info(f"⏭️ {source} 内容未变化，已跳过（{existing['chunk_count']} 个文本块，入库于 {indexed_at}{note}）")
+    if source not in st.session_state.rag_data:
+        st.session_state.rag_data.append(source)
+    return True
+
+def purge_deleted_chunks(vectorstore, chunk_ids, config, shared):
+    """从内存向量库中物理移除指定文本块：按原顺序用其余向量重建索引和 id 映射，返回移除数量
+
+    重建期间检索照常进行，只在替换索引时持写锁。
+    """
+    from langchain_core.documents import Document as LC_Document
+    remove = set(chunk_ids)
+    mapping = dict(vectorstore.index_to_docstore_id.items())
+    keep_positions = [pos for pos in range(vectorstore.index.ntotal) if mapping[pos] not in remove]
+    removed = vectorstore.index.ntotal - len(keep_positions)
+    if removed == 0:
+        return 0
+    vectors = extract_index_vectors(vectorstore.index)[keep_positions]
+    index = build_faiss_index(get_index_type(vectorstore.index), vectors, config)
+    apply_search_params(index, config)
+    with shared.writing():
+        vectorstore.index = index
+        vectorstore.index_to_docstore_id = {new: mapping[old] for new, old in enumerate(keep_positions)}
+        vectorstore.docstore.delete([chunk_id for chunk_id in remove
+                                     if isinstance(vectorstore.docstore.search(chunk_id), LC_Document)])
+    return removed
+
+def compact_vector_store(vectorstore, db_root):
+    """合并增量日志、物理移除已删除的文本块并写入新快照，返回移除的文本块数"""
+    import lazy_vectorstore
+    registry = get_document_registry(db_root)
+    shared = get_shared_vector_store(db_root)
+    wal = get_vector_wal(os.path.join(db_root, "faiss_index"))
+    with wal.maintenance_lock:
+        deleted = registry.deleted_ids()
+        pending = registry.pending_purge()
+        with shared.writing():
+            wal.replay(vectorstore, deleted)
+        config = load_index_config(db_root)
+        lazy = isinstance(vectorstore, lazy_vectorstore.LazyFAISS)
+        if lazy:
+            # 按需加载的向量库不在内存中重建：写快照时跳过已删除的文本块，再重新打开新快照
+            removed = len(chunk_positions(vectorstore, pending)) if pending else 0
+            save_options = {"exclude": pending, "rebuild": lambda keep_positions: build_faiss_index(
+                get_index_type(vectorstore.index), extract_index_vectors(vectorstore.index)[keep_positions], config
+            )}
+        else:
+            removed = purge_deleted_chunks(vectorstore, pending, config, shared)
+            save_options = {}
+        get_lexical_index(db_root).delete(pending)
+        # 入库持有 maintenance_lock，写快照期间向量库不会变化，检索只需读锁
+        with shared.lock.read():
+            wal.compact(vectorstore, deleted, **save_options)
+        if lazy:
+            # 在新快照上重新打开，释放快照之后新增文本块的内存覆盖层
+            with shared.writing():
+                vectorstore.reload(wal.db_path)
+                apply_search_params(vectorstore.index, config)
+        registry.mark_purged(pending)
+    return removed
+
+def schedule_purge(vectorstore, db_root):
+    """墓碑积累到阈值后在后台线程中清理索引（同一知识库同时只运行一个清理任务）"""
+    registry = get_document_registry(db_root)
+    pending = registry.snapshot()["pending_purge"]
+    if pending < max(PURGE_MIN_CHUNKS, vectorstore.index.ntotal * PURGE_RATIO):
+        return False
+    wal = get_vector_wal(os.path.join(db_root, "faiss_index"))
+    if not wal.purge_lock.acquire(blocking=False):
+        return False
+    
+    def run():
+        try:
+            # 在清理线程中获取 maintenance_lock：等待进行中的入库结束，清理期间新的入库排队等待
+            compact_vector_store(vectorstore, db_root)
+        except Exception:
+            logger.exception("后台清理知识库失败（%s）", db_root)
+        finally:
+            wal.purge_lock.release()
+    
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+def delete_knowledge_source(source):
+    """按来源删除知识库文档：文本块立即从检索结果中消失，索引在后台清理"""
+    db_root = st.session_state.chromadb_path
+    removed = get_document_registry(db_root).delete_source(source)
+    get_shared_vector_store(db_root).touch()
+    if source in st.session_state.rag_data:
+        st.session_state.rag_data.remove(source)
+    vectorstore = get_vector_store()
+    if vectorstore:
+        schedule_purge(vectorstore, db_root)
+    return removed
+
+def chunk_positions(vectorstore, chunk_ids):
+    """查询文本块 id 对应的索引位置
+
+    按需加载的向量库直接查询 SQLite；内存向量库使用缓存的反向映射（映射变化后重新生成）。
+    """
+    import lazy_vectorstore
+    mapping = vectorstore.index_to_docstore_id
+    if isinstance(mapping, lazy_vectorstore.LazyIdMap):
+        return mapping.positions_of(chunk_ids)
+    cached = getattr(vectorstore, "_position_cache", None)
+    if cached is None or cached[0] is not mapping or cached[1] != len(mapping):
+        cached = (mapping, len(mapping), {doc_id: pos for pos, doc_id in mapping.items()})
+        vectorstore._position_cache = cached
+    return {chunk_id: cached[2][chunk_id] for chunk_id in chunk_ids if chunk_id in cached[2]}
+
+def dense_rank(vectorstore, query_vector, fetch_k):
+    """向量检索：返回按距离排序的文本块 id"""
+    import numpy as np
+    _, positions = vectorstore.index.search(np.asarray([query_vector], dtype="float32"), fetch_k)
+    mapping = vectorstore.index_to_docstore_id
+    return [mapping[pos] for pos in positions[0].tolist() if pos != -1]
+
+def prefilter_rank(vectorstore, query_vector, candidate_ids):
+    """词法预筛选：只对候选文本块计算向量距离，返回按距离排序的 id"""
+    import faiss
+    import numpy as np
+    positions = chunk_positions(vectorstore, candidate_ids)
+    pairs = [(chunk_id, positions[chunk_id]) for chunk_id in candidate_ids if chunk_id in positions]
+    if not pairs:
+        return []
+    index = vectorstore.index
+    if isinstance(index, faiss.IndexIVF) and index.direct_map.no():
+        index.make_direct_map()
+    vectors = np.vstack([index.reconstruct(pos) for _, pos in pairs])
+    distances = ((vectors - np.asarray(query_vector, dtype="float32")) ** 2).sum(axis=1)
+    return [pairs[i][0] for i in np.argsort(distances)]
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """倒数排序融合：score = Σ 1 / (k + 名次)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+@tracing.traced("retrieve")
+def search_knowledge_base(vectorstore, query, k, mode=None):
+    """检索知识库：按检索方式排序候选，过滤已删除的文本块并按内容去重，候选不足时扩大检索范围
+
+    mode 为 RETRIEVAL_MODES 之一，默认取会话设置；词法预筛选没有足够候选时退回混合检索。
+    """
+    from langchain_core.documents import Document as LC_Document
+    db_root = st.session_state.chromadb_path
+    registry = get_document_registry(db_root)
+    lexical = get_lexical_index(db_root)
+    mode = mode or st.session_state.retrieval_mode
+    shared = get_shared_vector_store(db_root)
+    with tracing.span("embed", kind="query"):
+        query_vector = get_embeddings().embed_query(query)
+    fetch_k = k * 3
+    while True:
+        with shared.lock.read():
+            if mode == "词法预筛选":
+                ranked_ids = prefilter_rank(vectorstore, query_vector, lexical.search(query, LEXICAL_CANDIDATES))
+                exhausted = True
+            else:
+                dense_ids = dense_rank(vectorstore, query_vector, fetch_k)
+                exhausted = len(dense_ids) < fetch_k
+                ranked_ids = dense_ids
+                if mode == "混合检索":
+                    ranked_ids = reciprocal_rank_fusion([dense_ids, lexical.search(query, fetch_k)])
+            
+            docs = []
+            for chunk_id in ranked_ids:
+                if registry.is_deleted(chunk_id):
+                    continue
+                doc = vectorstore.docstore.search(chunk_id)
+                # 跳过新建向量库时写入的占位文档
+                if isinstance(doc, LC_Document) and doc.page_content != "初始化文档":
+                    docs.append(doc)
+        results = unique_documents(docs, k)
+        if len(results) >= k:
+            return results
+        if mode == "词法预筛选":
+            mode = "混合检索"
+        elif exhausted:
+            return results
+        else:
+            fetch_k *= 4
+
+def benchmark_retrieval(vectorstore, k=3, n_queries=30):
+    """检索方式测评（已知答案检索）：从库内文本块截取含数字/代码的片段作为查询，
+    统计各检索方式 top-k 命中原文本块的比例和平均查询延迟"""
+    import random
+    from langchain_core.documents import Document as LC_Document
+    registry = get_document_registry(st.session_state.chromadb_path)
+    rng = random.Random(0)
+    samples = []
+    with get_shared_vector_store(st.session_state.chromadb_path).lock.read():
+        chunk_ids = [chunk_id for chunk_id in vectorstore.index_to_docstore_id.values()
+                     if not registry.is_deleted(chunk_id)]
+        for chunk_id in rng.sample(chunk_ids, len(chunk_ids)):
+            doc = vectorstore.docstore.search(chunk_id)
+            if not isinstance(doc, LC_Document) or len(doc.page_content) < 20:
+                continue
+            text = doc.page_content
+            code = re.search(r'[A-Za-z0-9]{3,}', text)
+            start = max(0, code.start() - 6) if code else rng.randrange(0, len(text) - 12)
+            samples.append((text[start:start + 16], text))
+            if len(samples) == n_queries:
+                break
+    if not samples:
+        return None
+    
+    results = {}
+    for mode in RETRIEVAL_MODES:
+        hits = 0
+        start_time = time.perf_counter()
+        for query, target in samples:
+            docs = search_knowledge_base(vectorstore, query, k, mode)
+            hits += any(doc.page_content == target for doc in docs)
+        results[mode] = {
+            "recall": hits / len(samples),
+            "latency_ms": (time.perf_counter() - start_time) * 1000 / len(samples)
+        }
+    return {"queries": len(samples), "k": k, "modes": results}
+
+def configure_retrieval_settings():
+    """RAG 设置中的检索方式选择与测评"""
+    st.markdown("### 检索方式")
+    st.session_state.retrieval_mode = st.radio(
+        "检索方式", RETRIEVAL_MODES, index=RETRIEVAL_MODES.index(st.session_state.retrieval_mode),
+        help="混合检索融合向量和关键词（二元组/代码）结果；词法预筛选只对关键词命中的候选做向量精排",
+        label_visibility="collapsed"
+    )
+    if st.button("📏 测评检索方式"):
+        vectorstore = get_vector_store()
+        result = benchmark_retrieval(vectorstore) if vectorstore else None
+        if result:
+            lines = [
+                f"- {mode}：recall@{result['k']} = {stats['recall']:.0%}，单次查询 {stats['latency_ms']:.1f} ms"
+                for mode, stats in result["modes"].items()
+            ]
+            st.info(f"{result['queries']} 个查询：\n" + "\n".join(lines))
+        else:
+            st.warning("知识库为空，无法测评")
+
+def index_config_path(db_root):
+    return os.path.join(db_root, "index_config.json")
+
+def load_index_config(db_root):
+    """读取知识库的索引配置，缺失项使用默认值"""
+    config = dict(DEFAULT_INDEX_CONFIG)
+    try:
+        with open(index_config_path(db_root), "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return config
+
+def save_index_config(db_root, config):
+    os.makedirs(db_root, exist_ok=True)
+    with open(index_config_path(db_root), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+def get_index_type(index):
+    """识别 FAISS 索引类型"""
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        return "HNSW"
+    if isinstance(index, faiss.IndexIVF):
+        return "IVF"
+    return "Flat"
+
+def extract_index_vectors(index):
+    """按存储顺序取出索引中的全部向量（顺序与 index_to_docstore_id 一致）"""
+    import faiss
+    import numpy as np
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def ivf_nlist(config, count):
+    """IVF 聚类中心数：配置为 0 时按数据量自动计算；每个聚类中心至少需要约 39 个训练样本"""
+    import numpy as np
+    nlist = int(config["ivf_nlist"]) or int(4 * np.sqrt(max(count, 1)))
+    return max(1, min(nlist, count // 39 or 1))
+
+def build_faiss_index(index_type, vectors, config):
+    """用给定向量构建指定类型的 L2 索引（IVF 会先训练聚类中心）"""
+    import faiss
+    dimension = vectors.shape[1]
+    if index_type == "HNSW":
+        index = faiss.IndexHNSWFlat(dimension, int(config["hnsw_m"]))
+    elif index_type == "IVF":
+        nlist = ivf_nlist(config, len(vectors))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist, faiss.METRIC_L2)
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    if len(vectors):
+        index.add(vectors)
+    return index
+
+def apply_search_params(index, config):
+    """设置 HNSW efSearch / IVF nprobe 搜索参数"""
+    index_type = get_index_type(index)
+    if index_type == "HNSW":
+        index.hnsw.efSearch = int(config["ef_search"])
+    elif index_type == "IVF":
+        index.nprobe = min(int(config["nprobe"]), index.nlist)
+
+def target_index_type(config, chunk_count):
+    """根据配置和文本块数量决定应使用的索引类型"""
+    if config["type"] == "Flat" and config["auto_migrate"] and chunk_count >= int(config["auto_threshold"]):
+        return config["auto_type"]
+    return config["type"]
+
+def index_params_changed(index, config):
+    """当前索引的构建参数是否与配置不一致（HNSW 的 M、IVF 手动指定的 nlist）
+
+    nlist 因数据量不足而被截断时不随数据增长反复重建，数据量足以达到配置值时才重建一次。
+    """
+    index_type = get_index_type(index)
+    if index_type == "HNSW":
+        return index.hnsw.nb_neighbors(1) != int(config["hnsw_m"])
+    if index_type == "IVF" and int(config["ivf_nlist"]):
+        requested = int(config["ivf_nlist"])
+        return index.nlist > requested or (index.nlist < requested and ivf_nlist(config, index.ntotal) == requested)
+    return False
+
+def apply_index_config(vectorstore, config):
+    """按配置迁移索引类型或按新的构建参数重建（必要时训练）并设置搜索参数，返回是否重建了索引"""
+    target = target_index_type(config, vectorstore.index.ntotal)
+    migrated = False
+    if get_index_type(vectorstore.index) != target or index_params_changed(vectorstore.index, config):
+        vectors = extract_index_vectors(vectorstore.index)
+        vectorstore.index = build_faiss_index(target, vectors, config)
+        migrated = True
+    apply_search_params(vectorstore.index, config)
+    return migrated
+
+def benchmark_index(vectorstore, k=4, n_queries=50):
+    """召回率-延迟测评：以库内向量加扰动作为查询，和精确 Flat 检索结果对比"""
+    import faiss
+    import numpy as np
+    index = vectorstore.index
+    vectors = extract_index_vectors(index)
+    if len(vectors) == 0:
+        return None
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    queries = (sample + rng.normal(0, 0.01, sample.shape)).astype("float32")
+    k = min(k, len(vectors))
+    
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    start_time = time.perf_counter()
+    _, exact_ids = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+    
+    start_time = time.perf_counter()
+    _, approx_ids = index.search(queries, k)
+    approx_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+    
+    recall = np.mean([
+        len(set(exact_row) & set(approx_row)) / k
+        for exact_row, approx_row in zip(exact_ids.tolist(), approx_ids.tolist())
+    ])
+    return {
+        "index_type": get_index_type(index),
+        "chunks": index.ntotal,
+        "recall": float(recall),
+        "latency_ms": approx_ms,
+        "flat_latency_ms": exact_ms,
+        "k": k
+    }
+
+def configure_index_settings():
+    """RAG 设置中的索引类型选择、自动迁移与召回率测评"""
+    db_root = st.session_state.chromadb_path
+    config = load_index_config(db_root)
+    st.markdown("### 向量索引类型")
+    index_type = st.selectbox("索引类型", INDEX_TYPES, index=INDEX_TYPES.index(config["type"]),
+                              help="Flat 为精确检索；HNSW/IVF 为近似检索，适合大规模知识库")
+    if index_type == "HNSW":
+        config["hnsw_m"] = st.number_input("M（邻居数）", 4, 128, int(config["hnsw_m"]),
+                                           help="修改后应用设置时按新的 M 重建索引")
+        config["ef_search"] = st.number_input("efSearch", 8, 1024, int(config["ef_search"]))
+    elif index_type == "IVF":
+        config["ivf_nlist"] = st.number_input("nlist（0 为自动）", 0, 65536, int(config["ivf_nlist"]),
+                                              help="修改后应用设置时重新训练聚类中心；数据量不足时先按每个中心约 39 个样本截断")
+        config["nprobe"] = st.number_input("nprobe", 1, 1024, int(config["nprobe"]))
+    else:
+        config["auto_migrate"] = st.checkbox("超过阈值后自动迁移", value=config["auto_migrate"])
+        if config["auto_migrate"]:
+            config["auto_threshold"] = st.number_input(
+                "自动迁移阈值（文本块数）", 1000, 100000000, int(config["auto_threshold"]), step=10000
+            )
+            config["auto_type"] = st.selectbox("迁移目标", ["HNSW", "IVF"],
+                                               index=["HNSW", "IVF"].index(config["auto_type"]))
+    config["type"] = index_type
+    config["storage"] = st.selectbox(
+        "快照存储方式", list(STORAGE_MODES), index=list(STORAGE_MODES).index(config["storage"]),
+        format_func=STORAGE_MODES.get,
+        help="按需加载时 Flat 索引以内存映射方式检索，文本块内容只在命中时从 SQLite 读取，冷启动不随知识库规模增长"
+    )
+    shared = get_shared_vector_store(db_root)
+    if shared.store is not None:
+        load_note = f"，加载耗时 {shared.load_seconds * 1000:.0f} ms" if shared.load_seconds is not None else ""
+        st.caption(f"向量库为进程内共享实例（版本 {shared.version}，{shared.active_sessions()} 个活跃会话共用{load_note}）")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 应用索引设置"):
+            save_index_config(db_root, config)
+            vectorstore = get_vector_store()
+            if vectorstore:
+                wal = get_vector_wal(os.path.join(db_root, "faiss_index"))
+                with st.spinner("正在迁移索引..."), wal.maintenance_lock:
+                    with shared.writing():
+                        converted = convert_vector_store(vectorstore, config["storage"])
+                        migrated = apply_index_config(converted, config)
+                    if migrated or converted is not vectorstore:
+                        compact_vector_store(converted, db_root)
+                    shared.replace(converted)
+                    vectorstore = converted
+                st.success(f"✅ 当前索引：{get_index_type(vectorstore.index)}，{STORAGE_MODES[config['storage']]}")
+    with col2:
+        run_benchmark = st.button("📏 测评召回率")
+    if run_benchmark:
+        vectorstore = get_vector_store()
+        with shared.lock.read():
+            result = benchmark_index(vectorstore) if vectorstore else None
+        if result:
+            st.info(
+                f"{result['index_type']}（{result['chunks']} 个文本块）：recall@{result['k']} = "
+                f"{result['recall']:.1%}，单次查询 {result['latency_ms']:.3f} ms"
+                f"（精确检索 {result['flat_latency_ms']:.3f} ms）"
+            )
+        else:
+            st.warning("知识库为空，无法测评")
+
+@st.cache_resource(show_spinner=False)
+def get_search_tool():
+    """进程级共享的 DuckDuckGo 搜索工具"""
+    with import_timing.subsystem("联网搜索"):
+        from langchain_community.tools import DuckDuckGoSearchRun
+    return DuckDuckGoSearchRun()
 
 # 核心功能实现
 
+@tracing.traced("search")
 def handle_web_search(query):
     """联网搜索功能，使用 DuckDuckGo API"""
     if not st.session_state.search_enabled:
         return None
     try:
-        search = DuckDuckGoSearchRun()
-        results = search.run(query)
+        results = get_search_tool().run(query)
         return results
     except Exception as e:
         st.error(f"联网搜索失败: {str(e)}")
         return None
 
-def call_model_api(prompt, model_type, rag_data=None):
-    """调用除 RAG 部分外的其他接口"""
+class ResponseCache:
+    """LLM 响应精确匹配缓存：内存 LRU 层 + SQLite 持久化层，支持 TTL 与容量淘汰
+
+    键为 (model_type, 最终请求 payload, 引用来源) 的 SHA-256，payload 中已包含
+    messages、temperature 与 max_tokens。线程安全，由所有会话共享。
+    """
+
+    def __init__(self, db_path, max_memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                 ttl_seconds=RESPONSE_CACHE_TTL, max_disk_bytes=RESPONSE_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (response, created_at)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_type TEXT,
+                response TEXT,
+                created_at REAL,
+                last_access REAL,
+                size INTEGER
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+        self._conn.commit()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(model_type, payload, rag_data=None):
+        """根据模型与最终请求 payload 计算缓存键"""
+        key_data = {
+            "model_type": model_type,
+            "payload": {k: v for k, v in payload.items() if k != "stream"},
+            "rag_data": rag_data or []
+        }
+        return hashlib.sha256(
+            json.dumps(key_data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def is_cacheable(payload, allow_nondeterministic=False):
+        """只有 temperature 为 0 的确定性请求才缓存，除非显式允许非确定性缓存"""
+        if allow_nondeterministic:
+            return True
+        temperature = payload.get("temperature")
+        return temperature is not None and float(temperature) == 0.0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+            
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self.stats["evictions"] += 1
+                self.stats["misses"] += 1
+                return None
+            
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._remember(key, row[0], row[1])
+            self.stats["disk_hits"] += 1
+            return row[0]
+
+    def put(self, key, model_type, response):
+        if not response or not isinstance(response, str):
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model_type, response, created_at, last_access, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_type, response, now, now, len(response.encode("utf-8")))
+            )
+            self.stats["stores"] += 1
+            self._evict_disk(now)
+            self._conn.commit()
+
+    def _remember(self, key, response, created_at):
+        """写入内存 LRU 层（调用方需持有锁）"""
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        """清理过期条目，并在超出容量时按最久未访问淘汰（调用方需持有锁）"""
+        expired = self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        self.stats["evictions"] += max(expired, 0)
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total_size > self.max_disk_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", [(row[0],) for row in rows])
+            for row in rows:
+                self._memory.pop(row[0], None)
+            total_size -= sum(row[1] for row in rows)
+            self.stats["evictions"] += len(rows)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def snapshot(self):
+        """返回命中统计与容量信息"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            stats = dict(self.stats)
+            stats.update({"memory_entries": len(self._memory), "disk_entries": entries, "disk_bytes": size})
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+@st.cache_resource
+def get_response_cache():
+    """进程级共享的响应缓存"""
+    return ResponseCache(RESPONSE_CACHE_PATH)
+
+class ConversationStore:
+    """SQLite 持久化的对话记录，按对话 id 和作用域分页读取
+
+    scope 为空字符串表示界面显示的消息，其余为各模型的对话历史；seq 为对话内递增的消息序号，
+    提交时在写事务内按 MAX(seq) + 1 分配并回填到消息 dict，同一对话在多个会话（复制的标签页、
+    旧会话仍存活时刷新）中同时追加也不会相互覆盖。
+    追加的消息先进入内存队列，由后台线程定期批量提交（write-behind），不阻塞本轮回答；
+    读取前先提交队列中的消息，保证读到自己的写入。
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "conversation_id TEXT, scope TEXT, seq INTEGER, role TEXT, type TEXT, content TEXT, "
+            "timestamp TEXT, PRIMARY KEY (conversation_id, scope, seq))"
+        )
+        self._conn.commit()
+        self._pending = []
+        self._cond = threading.Condition()
+        threading.Thread(target=self._write_behind, daemon=True, name="chat-store-writer").start()
+        atexit.register(self.flush)
+
+    def append(self, conversation_id, scope, message):
+        """排队追加一条消息，提交后 message["seq"] 被设为分配的序号"""
+        with self._cond:
+            self._pending.append((conversation_id, scope, message))
+            if len(self._pending) >= CHAT_WRITE_BATCH:
+                self._cond.notify()
+
+    def _write_behind(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=CHAT_WRITE_BEHIND_SECONDS)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("对话记录提交失败，稍后重试")
+
+    def flush(self):
+        """提交队列中的消息并回填序号，返回提交条数
+
+        提交失败（如数据库被锁）时回滚，把这批消息放回队列最前面等待下次提交，然后抛出异常。
+        """
+        with self._lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if batch:
+                assigned = []
+                # IMMEDIATE 事务先取得写锁，其他进程不会在读取 MAX(seq) 之后插入同一对话的消息；
+                # 使用普通 INSERT，序号冲突时报错而不是覆盖已有消息
+                try:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    for conversation_id, scope, message in batch:
+                        cursor = self._conn.execute(
+                            "INSERT INTO messages SELECT ?, ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? "
+                            "FROM messages WHERE conversation_id = ?",
+                            (conversation_id, scope, message["role"], message.get("type", "text"), message["content"],
+                             message.get("timestamp") or datetime.now().isoformat(), conversation_id)
+                        )
+                        assigned.append(self._conn.execute(
+                            "SELECT seq FROM messages WHERE rowid = ?", (cursor.lastrowid,)
+                        ).fetchone()[0])
+                    self._conn.commit()
+                except Exception:
+                    self._conn.rollback()
+                    with self._cond:
+                        self._pending[:0] = batch
+                    raise
+                # 提交成功后才回填序号，回滚的消息保持 seq=None
+                for (_, _, message), seq in zip(batch, assigned):
+                    message["seq"] = seq
+        return len(batch)
+
+    def _flush_for_read(self):
+        """读取前提交队列（读到自己的写入）；提交失败时记录日志，只读取已提交的消息"""
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("对话记录提交失败，稍后重试")
+
+    def page(self, conversation_id, scope, before_seq=None, limit=CHAT_PAGE_SIZE):
+        """按时间顺序返回 before_seq 之前（默认最新）的 limit 条消息"""
+        self._flush_for_read()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, role, type, content, timestamp FROM messages "
+                "WHERE conversation_id = ? AND scope = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (conversation_id, scope, before_seq if before_seq is not None else 2 ** 62, limit)
+            ).fetchall()
+        return [
+            {"seq": seq, "role": role, "type": msg_type, "content": content, "timestamp": timestamp}
+            for seq, role, msg_type, content, timestamp in reversed(rows)
+        ]
+
+    def has_before(self, conversation_id, scope, before_seq):
+        self._flush_for_read()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM messages WHERE conversation_id = ? AND scope = ? AND seq < ? LIMIT 1",
+                (conversation_id, scope, before_seq)
+            ).fetchone() is not None
+
+    def scopes(self, conversation_id):
+        self._flush_for_read()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT scope FROM messages WHERE conversation_id = ?", (conversation_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, conversation_id):
+        self._flush_for_read()
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._conn.commit()
+
+@st.cache_resource
+def get_conversation_store():
+    """进程级共享的对话记录存储"""
+    return ConversationStore(CHAT_STORE_PATH)
+
+def start_conversation(conversation_id=None):
+    """切换到指定对话（从存储恢复最近的消息和各模型历史），未指定时开始新对话
+
+    对话 id 写入地址栏参数，刷新页面或会话过期后仍可恢复同一对话。
+    """
+    store = get_conversation_store()
+    st.session_state.messages = []
+    st.session_state.chat_history = {}
+    st.session_state.chat_summaries = {}
+    st.session_state.history_pages = 0
+    if conversation_id:
+        st.session_state.messages = store.page(conversation_id, "", limit=CHAT_RENDER_MESSAGES)
+        for scope in store.scopes(conversation_id):
+            if scope:
+                st.session_state.chat_history[scope] = store.page(conversation_id, scope,
+                                                                  limit=CHAT_HISTORY_MAX_MESSAGES)
+    else:
+        conversation_id = uuid.uuid4().hex
+    st.session_state.conversation_id = conversation_id
+    st.query_params["cid"] = conversation_id
+
+def append_display_message(message):
+    """追加一条界面消息：写入对话存储，会话内只保留最近 CHAT_RENDER_MESSAGES 条"""
+    message = {**message, "seq": None, "timestamp": datetime.now().isoformat()}  # seq 在提交到对话存储时分配
+    get_conversation_store().append(st.session_state.conversation_id, "", message)
+    st.session_state.messages.append(message)
+    if len(st.session_state.messages) > CHAT_RENDER_MESSAGES:
+        del st.session_state.messages[:-CHAT_RENDER_MESSAGES]
+
+def render_message(msg):
+    with st.chat_message(msg["role"]):
+        if msg.get("type") == "image":
+            st.image(msg["content"])
+        else:
+            st.write(msg["content"])
+
+# 新会话：恢复地址栏参数中的对话，或开始新对话
+if "conversation_id" not in st.session_state:
+    start_conversation(st.query_params.get("cid"))
+
+class SemanticCache:
+    """语义响应缓存：用 embedding 模型编码问题，在按（模型, 助手角色）划分的小型
+    FAISS 内积索引中查找近似问题，余弦相似度超过阈值即返回缓存的回答
+
+    条目按时间（TTL）和数量淘汰，淘汰后重建对应作用域的索引。线程安全，由所有会话共享。
+    """
+
+    def __init__(self, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl_seconds=SEMANTIC_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._scopes = {}  # scope -> {"index": faiss.Index, "entries": [dict]}
+        self._embeddings = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _encode(self, text):
+        """编码并归一化问题向量（归一化后内积即余弦相似度）"""
+        import numpy as np
+        if self._embeddings is None:
+            self._embeddings = get_embeddings()
+            if self._embeddings is None:
+                return None
+        vector = np.asarray(self._embeddings.embed_query(text), dtype="float32").reshape(1, -1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _rebuild(self, scope_data, dimension):
+        """根据保留的条目重建作用域索引（调用方需持有锁）"""
+        import faiss
+        import numpy as np
+        index = faiss.IndexFlatIP(dimension)
+        if scope_data["entries"]:
+            index.add(np.vstack([entry["vector"] for entry in scope_data["entries"]]))
+        scope_data["index"] = index
+
+    def _evict(self, scope_data, now):
+        """淘汰过期及超量条目（调用方需持有锁）"""
+        entries = scope_data["entries"]
+        kept = [entry for entry in entries if now - entry["created_at"] <= self.ttl_seconds]
+        if len(kept) > self.max_entries:
+            kept = kept[-self.max_entries:]
+        if len(kept) != len(entries):
+            self.stats["evictions"] += len(entries) - len(kept)
+            scope_data["entries"] = kept
+            self._rebuild(scope_data, scope_data["index"].d)
+
+    def lookup(self, scope, prompt, threshold=SEMANTIC_CACHE_THRESHOLD):
+        """查找语义相近的问题，返回 (命中信息或 None, 问题向量)"""
+        vector = self._encode(prompt)
+        if vector is None:
+            return None, None
+        now = time.time()
+        with self._lock:
+            scope_data = self._scopes.get(scope)
+            if scope_data:
+                self._evict(scope_data, now)
+            if not scope_data or scope_data["index"].ntotal == 0:
+                self.stats["misses"] += 1
+                return None, vector
+            scores, positions = scope_data["index"].search(vector, 1)
+            similarity, position = float(scores[0][0]), int(positions[0][0])
+            if position < 0 or similarity < threshold:
+                self.stats["misses"] += 1
+                return None, vector
+            entry = scope_data["entries"][position]
+            self.stats["hits"] += 1
+            return {
+                "response": entry["response"],
+                "prompt": entry["prompt"],
+                "similarity": similarity
+            }, vector
+
+    def add(self, scope, prompt, response, vector=None):
+        if not response or not isinstance(response, str):
+            return
+        if vector is None:
+            vector = self._encode(prompt)
+            if vector is None:
+                return
+        with self._lock:
+            scope_data = self._scopes.get(scope)
+            if scope_data is None:
+                scope_data = {"entries": []}
+                self._rebuild(scope_data, vector.shape[1])
+                self._scopes[scope] = scope_data
+            scope_data["entries"].append({
+                "prompt": prompt,
+                "response": response,
+                "created_at": time.time(),
+                "vector": vector
+            })
+            scope_data["index"].add(vector)
+            self.stats["stores"] += 1
+            self._evict(scope_data, time.time())
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = sum(len(data["entries"]) for data in self._scopes.values())
+            stats["scopes"] = len(self._scopes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+@st.cache_resource
+def get_semantic_cache():
+    """进程级共享的语义缓存"""
+    return SemanticCache()
+
+def semantic_cache_scope(model_type):
+    """语义缓存作用域：同一模型、同一助手角色下的问题才会相互命中"""
+    return (model_type, st.session_state.selected_assistant or "无")
+
+def replay_cached_response(model_type, cached, stream=False):
+    """返回缓存命中的回答，并像正常回答一样写入对话历史"""
+    if stream:
+        chat_stream = ChatStream(
+            model_type,
+            iter([cached]),
+            on_complete=lambda text: manage_chat_history(model_type, "assistant", text)
+        )
+        chat_stream.cache_hit = True
+        return chat_stream
+    manage_chat_history(model_type, "assistant", cached)
+    return cached
+
+@st.cache_resource
+def get_turn_executor():
+    """进程级有界线程池，用于并发执行单轮对话中的各个分支"""
+    return ThreadPoolExecutor(max_workers=TURN_MAX_WORKERS, thread_name_prefix="turn-branch")
+
+def submit_with_script_ctx(fn, *args, **kwargs):
+    """提交任务到线程池，并把当前会话的 ScriptRunContext 绑定到工作线程，
+    使分支内可以正常访问 st.session_state 和输出 st.error 等提示；
+    同时复制当前的 contextvars，分支内的耗时 span 计入本轮追踪"""
+    ctx = get_script_run_ctx()
+    context = contextvars.copy_context()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return context.run(fn, *args, **kwargs)
+
+    return get_turn_executor().submit(run)
+
+# 当前分支的取消标记（由 run_turn_branches 在分支上下文中设置）
+branch_cancel_event = contextvars.ContextVar("branch_cancel_event", default=None)
+
+def branch_cancelled():
+    """当前线程执行的分支是否已因超时被取消（不在分支内时为 False）"""
+    event = branch_cancel_event.get()
+    return event is not None and event.is_set()
+
+def run_branch(fn, args, cancel_event):
+    branch_cancel_event.set(cancel_event)
+    return fn(*args, cancel_event=cancel_event)
+
+def run_turn_branches(branches):
+    """并发执行多个分支并按提交顺序收集结果
+
+    branches: [(name, fn, args, deadline_seconds), ...]，截止时间从本轮开始计算；
+    fn 需接受 cancel_event 关键字参数。返回 {name: (result, error)}；超时的分支 error 为 TimeoutError。
+    已在运行的 future 无法 cancel()，超时后置位该分支的 cancel_event：分支在输出提示和调用模型前检查，
+    对话历史写入和用量记录也会检查（通过 contextvars 传递），之后才完成的结果直接丢弃。
+    """
+    start_time = time.perf_counter()
+    futures = []
+    for name, fn, args, deadline in branches:
+        cancel_event = threading.Event()
+        futures.append((name, submit_with_script_ctx(run_branch, fn, args, cancel_event), deadline, cancel_event))
+    results = {}
+    for name, future, deadline, cancel_event in futures:
+        remaining = max(deadline - (time.perf_counter() - start_time), 0)
+        try:
+            results[name] = (future.result(timeout=remaining), None)
+        except FutureTimeoutError:
+            cancel_event.set()
+            future.cancel()  # 尚未开始执行时直接取消
+            results[name] = (None, TimeoutError(f"超过 {deadline} 秒未完成"))
+        except Exception as e:
+            results[name] = (None, e)
+    return results
+
+def call_model_api(prompt, model_type, rag_data=None, stream=False, messages=None, use_cache=True, standalone=False):
+    """调用除 RAG 部分外的其他接口
+
+    stream=True 且模型支持流式输出时返回 ChatStream（逐块产出文本），否则返回完整回答。
+    messages 为预先格式化好的消息列表（对比模式下多个模型共用），为空时按模型历史生成。
+    use_cache=False 时跳过响应缓存（如对比模式需要测量真实延迟）。
+    standalone=True 时为独立请求（如后台生成对话摘要）：不附带也不写入对话历史。
+    在已超时取消的分支中调用时不再发出请求，直接返回 None。
+    """
+    if branch_cancelled():
+        return None
     headers = {"Content-Type": "application/json"}
+    stream = stream and model_type in STREAMING_MODELS
     
     try:
         # 获取格式化后的消息列表
-        messages = format_messages_for_model(model_type, prompt)
+        if messages is None:
+            messages = [{"role": "user", "content": prompt}] if standalone else format_messages_for_model(model_type, prompt)
         
         if model_type == "豆包":
             api_key = st.session_state.api_keys.get("豆包", "")
@@ -481,20 +2232,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://ark.cn-beijing.volces.com/api/v3/chat/completions",
-                json={
+                {
                     "model": "ep-20250128163906-p4tb5",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "DeepSeek-V3":
             api_key = st.session_state.api_keys.get("DeepSeek", "")
@@ -503,20 +2255,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.deepseek.com/v1/chat/completions",
-                json={
+                {
                     "model": "deepseek-chat",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "通义千问":
             api_key = st.session_state.api_keys.get("通义千问", "")
@@ -525,20 +2278,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions",
-                json={
+                {
                     "model": "qwen-plus",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "文心一言":
             api_key = st.session_state.api_keys.get("文心一言", "")
@@ -554,27 +2308,31 @@ def call_model_api(prompt, model_type, rag_data=None):
                 role_prompt = st.session_state.assistant_market[domain][st.session_state.selected_assistant]
                 enhanced_prompt = f"{role_prompt}\n\n请以{st.session_state.selected_assistant}的身份回答以下问题：\n{prompt}"
             # 获取历史消息
-            history = get_chat_history(model_type)
+            history = [] if standalone else get_history_for_prompt(model_type)
             if history:
-                # 将最近的对话历史添加到提示词中
-                recent_history = history[-6:]  # 保留最近3轮对话
+                # 将预算内最近的对话历史添加到提示词中
+                recent_history = fit_history_to_budget(model_type, history, prompt, get_prompt_budget(model_type),
+                                                       [{"role": "user", "content": enhanced_prompt}])
                 history_text = "\n".join([f"{'用户' if msg['role']=='user' else '助手'}: {msg['content']}" 
                                         for msg in recent_history])
                 enhanced_prompt = f"以下是历史对话：\n{history_text}\n\n当前问题：{enhanced_prompt}"
-            response = requests.post(
+            summary = None if standalone else get_history_summary(model_type)
+            if summary:
+                enhanced_prompt = f"此前对话的摘要：\n{summary}\n\n{enhanced_prompt}"
+            return request_chat_completion(
+                model_type,
                 "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions",
-                json={
+                {
                     "model": "ERNIE-Bot",
                     "messages": [{"role": "user", "content": enhanced_prompt}],
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "智谱清言":
             api_key = st.session_state.api_keys.get("智谱清言", "")
@@ -583,20 +2341,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://open.bigmodel.cn/api/paas/v4/chat/completions",
-                json={
+                {
                     "model": "glm-4",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "MiniMax":
             api_key = st.session_state.api_keys.get("MiniMax", "")
@@ -605,20 +2364,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.minimax.chat/v1/text/chatcompletion_v2",
-                json={
+                {
                     "model": "abab5.5-chat",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "DALL-E(文生图)":
             api_key = st.session_state.api_keys.get("OpenAI", "")
@@ -627,15 +2387,16 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {st.session_state.api_keys['OpenAI']}"
             
-            response = requests.post(
-                "https://api.openai.com/v1/images/generations",
-                json={
-                    "prompt": prompt,
-                    "n": 1,
-                    "size": "512x512"
-                },
-                headers=headers
-            )
+            with tracing.span("llm_total", model_type, stream=False):
+                response = http_client.post(
+                    "https://api.openai.com/v1/images/generations",
+                    json={
+                        "prompt": prompt,
+                        "n": 1,
+                        "size": "512x512"
+                    },
+                    headers=headers
+                )
             response_json = response.json()
             if "data" in response_json and len(response_json["data"]) > 0:
                 image_url = response_json["data"][0]["url"]
@@ -660,28 +2421,33 @@ def call_model_api(prompt, model_type, rag_data=None):
                 enhanced_prompt = f"{role_prompt}\n\n请以{st.session_state.selected_assistant}的身份回答以下问题：\n{prompt}"
             
             # 获取历史消息
-            history = get_chat_history(model_type)
+            history = [] if standalone else get_history_for_prompt(model_type)
             if history:
-                # 将最近的对话历史添加到提示词中
-                recent_history = history[-6:]  # 保留最近3轮对话
+                # 将预算内最近的对话历史添加到提示词中
+                recent_history = fit_history_to_budget(model_type, history, prompt, get_prompt_budget(model_type),
+                                                       [{"role": "user", "content": enhanced_prompt}])
                 history_text = "\n".join([f"{'用户' if msg['role']=='user' else '助手'}: {msg['content']}" 
                                         for msg in recent_history])
                 enhanced_prompt = f"以下是历史对话：\n{history_text}\n\n当前问题：{enhanced_prompt}"
+            summary = None if standalone else get_history_summary(model_type)
+            if summary:
+                enhanced_prompt = f"此前对话的摘要：\n{summary}\n\n{enhanced_prompt}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.deepseek.com/v1/chat/completions",
-                json={
+                {
                     "model": "deepseek-reasoner",
                     "messages": [{"role": "user", "content": enhanced_prompt}],
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "o1(深度推理)":
             api_key = st.session_state.api_keys.get("OpenAI", "")
@@ -699,27 +2465,32 @@ def call_model_api(prompt, model_type, rag_data=None):
                 enhanced_prompt = f"{role_prompt}\n\n请以{st.session_state.selected_assistant}的身份回答以下问题：\n{prompt}"
             
             # 获取历史消息
-            history = get_chat_history(model_type)
+            history = [] if standalone else get_history_for_prompt(model_type)
             if history:
-                # 将最近的对话历史添加到提示词中
-                recent_history = history[-6:]  # 保留最近3轮对话
+                # 将预算内最近的对话历史添加到提示词中
+                recent_history = fit_history_to_budget(model_type, history, prompt, get_prompt_budget(model_type),
+                                                       [{"role": "user", "content": enhanced_prompt}])
                 history_text = "\n".join([f"{'用户' if msg['role']=='user' else '助手'}: {msg['content']}" 
                                         for msg in recent_history])
                 enhanced_prompt = f"以下是历史对话：\n{history_text}\n\n当前问题：{enhanced_prompt}"
+            summary = None if standalone else get_history_summary(model_type)
+            if summary:
+                enhanced_prompt = f"此前对话的摘要：\n{summary}\n\n{enhanced_prompt}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.openai.com/v1/chat/completions",
-                json={
+                {
                     "model": "o1-mini",
                     "messages": [{"role": "user", "content": enhanced_prompt}],
                     "max_completion_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "Kimi(视觉理解)":
             api_key = st.session_state.api_keys.get("Kimi(视觉理解)", "")
@@ -728,18 +2499,18 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.moonshot.cn/v1/chat/completions",
-                json={
+                {
                     "model": "moonshot-v1-8k-vision-preview",
                     "messages": messages
                 },
-                headers=headers
+                headers,
+                stream=stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "GPTs(聊天、语音识别)":
             api_key = st.session_state.api_keys.get("OpenAI", "")
@@ -748,20 +2519,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.openai.com/v1/chat/completions",
-                json={
+                {
                     "model": "gpt-4o",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "grok2":
             api_key = st.session_state.api_keys.get("xAI", "")
@@ -770,20 +2542,21 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             headers["Authorization"] = f"Bearer {api_key}"
             
-            response = requests.post(
+            return request_chat_completion(
+                model_type,
                 "https://api.x.ai/v1/chat/completions",
-                json={
+                {
                     "model": "grok-2-latest",
                     "messages": messages,
                     "temperature": st.session_state.temperature,
                     "max_tokens": st.session_state.max_tokens
                 },
-                headers=headers
+                headers,
+                rag_data,
+                stream,
+                use_cache=use_cache,
+                record_history=not standalone
             )
-            result = handle_response(response, rag_data)
-            if result:
-                manage_chat_history(model_type, "assistant", result)
-            return result
 
         elif model_type == "混元生文":
             api_key = st.session_state.api_keys.get("混元生文", "")
@@ -792,21 +2565,58 @@ def call_model_api(prompt, model_type, rag_data=None):
                 return None
             
             try:
+                with import_timing.subsystem("OpenAI SDK"):
+                    from openai import OpenAI
                 client = OpenAI(
                     api_key=api_key,
-                    base_url="https://api.hunyuan.cloud.tencent.com/v1"
+                    base_url="https://api.hunyuan.cloud.tencent.com/v1",
+                    http_client=http_client.get_httpx_client()
                 )
                 
-                response = client.chat.completions.create(
-                    model="hunyuan-turbo",
-                    messages=messages,
-                    temperature=st.session_state.temperature,
-                    max_tokens=st.session_state.max_tokens
-                )
+                payload = {
+                    "model": "hunyuan-turbo",
+                    "messages": messages,
+                    "temperature": st.session_state.temperature,
+                    "max_tokens": st.session_state.max_tokens
+                }
+                cache, cache_key = None, None
+                if use_cache and st.session_state.response_cache_enabled:
+                    cache = get_response_cache()
+                    if cache.is_cacheable(payload, st.session_state.cache_nondeterministic):
+                        cache_key = cache.make_key(model_type, payload)
+                        cached = cache.get(cache_key)
+                        if cached is not None:
+                            return replay_cached_response(model_type, cached, stream)
+                
+                if not standalone:
+                    record_prompt_tokens(model_type, messages)
+                start_time = time.perf_counter()
+                if stream:
+                    response = client.chat.completions.create(**payload, stream=True)
+                else:
+                    with tracing.span("llm_total", model_type, stream=False):
+                        response = client.chat.completions.create(**payload, stream=False)
+                
+                if stream:
+                    def on_complete(text):
+                        if not standalone:
+                            manage_chat_history(model_type, "assistant", text)
+                        if cache_key:
+                            cache.put(cache_key, model_type, text)
+
+                    return ChatStream(
+                        model_type,
+                        iter_openai_sdk_chunks(response),
+                        start_time=start_time,
+                        on_complete=on_complete
+                    )
                 
                 if response.choices:
                     result = response.choices[0].message.content
-                    manage_chat_history(model_type, "assistant", result)
+                    if not standalone:
+                        manage_chat_history(model_type, "assistant", result)
+                    if cache_key:
+                        cache.put(cache_key, model_type, result)
                     return result
                 else:
                     st.error("API 返回格式异常")
@@ -827,8 +2637,65 @@ def call_model_api(prompt, model_type, rag_data=None):
         st.error(f"API调用失败: {str(e)}")
         return None
 
+def request_chat_completion(model_type, url, payload, headers, rag_data=None, stream=False, use_cache=True,
+                            record_history=True):
+    """发送 OpenAI 兼容格式的对话请求，并在得到完整回答后写入对话历史
+
+    stream=True 时以 SSE 方式请求，返回 ChatStream；历史记录在流结束后才写入。
+    use_cache=False 时本次请求跳过响应缓存；record_history=False 时不写入历史、不计入本轮用量。
+    """
+    cache, cache_key = None, None
+    if use_cache and st.session_state.response_cache_enabled:
+        cache = get_response_cache()
+        if cache.is_cacheable(payload, st.session_state.cache_nondeterministic):
+            cache_key = cache.make_key(model_type, payload, rag_data)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return replay_cached_response(model_type, cached, stream)
+    
+    if record_history:
+        record_prompt_tokens(model_type, payload["messages"])
+    if not stream:
+        with tracing.span("llm_total", model_type, stream=False) as span:
+            response = http_client.post(url, json=payload, headers=headers)
+            span["status_code"] = response.status_code
+        result = handle_response(response, rag_data)
+        if result:
+            calibrate_token_counter(model_type, payload["messages"], response.json().get("usage"))
+            if record_history:
+                manage_chat_history(model_type, "assistant", result)
+            if cache_key:
+                cache.put(cache_key, model_type, result)
+        return result
+    
+    start_time = time.perf_counter()
+    response = http_client.post(url, json={**payload, "stream": True}, headers=headers, stream=True)
+    if response.status_code != 200:
+        # 错误响应不是事件流，交给 handle_response 统一报错
+        handle_response(response)
+        response.close()
+        return None
+
+    def on_complete(text):
+        calibrate_token_counter(model_type, payload["messages"], chat_stream.usage)
+        if record_history:
+            manage_chat_history(model_type, "assistant", text)
+        if cache_key:
+            cache.put(cache_key, model_type, text)
+
+    chat_stream = ChatStream(
+        model_type,
+        iter_chat_stream_chunks(response),
+        rag_data=rag_data,
+        start_time=start_time,
+        on_complete=on_complete
+    )
+    return chat_stream
+
 def handle_response(response, rag_data=None):
-    """处理 API 响应"""
+    """处理 API 响应（所在分支已超时取消时丢弃结果，不再输出提示）"""
+    if branch_cancelled():
+        return None
     try:
         if response.status_code == 200:
             response_json = response.json()
@@ -861,9 +2728,340 @@ def handle_response(response, rag_data=None):
         st.error(f"响应解析失败: {str(e)}")
         return None
 
-# 使用 langchain 实现 RAG：加载文档、分割、嵌入、索引
-def rag_index_document(content, source):
-    """将文档添加到向量数据库"""
+class ChatStream:
+    """流式回答：逐块产出文本，记录首字延迟（TTFT）和总耗时，流结束后回调写入历史
+
+    读取中途出错（读超时、连接中断、SDK 报错）时记录到 error 并产出一段错误提示后结束，
+    此时 completed 保持 False，不写入历史。
+    """
+
+    def __init__(self, model_type, chunks, rag_data=None, start_time=None, on_complete=None):
+        self.model_type = model_type
+        self._chunks = chunks
+        self.rag_data = rag_data
+        self.start_time = start_time or time.perf_counter()
+        self.on_complete = on_complete
+        self.ttft = None  # 首个文本块到达的耗时（秒）
+        self.total_time = None
+        self.usage = None  # 服务商在流末尾返回的 token 用量（如有）
+        self.text = ""
+        self.completed = False
+        self.error = None  # 读取中途的异常
+        self.cache_hit = False  # 是否来自响应缓存
+
+    def __iter__(self):
+        parts = []
+        try:
+            for piece in self._chunks:
+                if isinstance(piece, dict):
+                    self.usage = piece
+                    continue
+                if not piece:
+                    continue
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - self.start_time
+                parts.append(piece)
+                yield piece
+        except Exception as e:
+            # 响应体在 call_model_api 之外读取，异常不能抛出到页面
+            self.error = e
+            self.total_time = time.perf_counter() - self.start_time
+            tracing.observe("llm_total", self.total_time, self.model_type, error=True, stream=True)
+            yield f"\n\n❌ 流式输出中断：{str(e)}"
+            return
+        if parts and self.rag_data:  # 与 handle_response 一致，在末尾追加引用来源
+            citation = "\n\n引用来源：\n" + "\n".join([f"- {source}" for source in self.rag_data])
+            parts.append(citation)
+            yield citation
+        self.text = "".join(parts)
+        self.total_time = time.perf_counter() - self.start_time
+        self.completed = True
+        if not self.cache_hit and self.ttft is not None:
+            tracing.observe("llm_ttft", self.ttft, self.model_type, stream=True)
+            tracing.observe("llm_total", self.total_time, self.model_type, stream=True)
+        if self.text and self.on_complete:
+            self.on_complete(self.text)
+
+    def close(self):
+        """提前放弃读取（如对比模式超时）：关闭底层连接，不写入历史"""
+        close = getattr(self._chunks, "close", None)
+        if close:
+            close()
+
+def iter_chat_stream_chunks(response):
+    """解析 OpenAI 兼容格式的 SSE 响应，产出增量文本（usage 以 dict 形式产出）"""
+    try:
+        for data in http_client.iter_sse_data(response):
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if chunk.get("usage"):
+                yield chunk["usage"]
+            choices = chunk.get("choices") or []
+            if choices:
+                # 只取增量 delta；MiniMax 等在流末尾附带的完整 message 需跳过
+                delta = choices[0].get("delta") or {}
+                if delta.get("content"):
+                    yield delta["content"]
+            elif chunk.get("result"):
+                # 文心一言流式格式
+                yield chunk["result"]
+    finally:
+        response.close()
+
+def iter_openai_sdk_chunks(response):
+    """解析 OpenAI SDK 流式响应（混元），产出增量文本"""
+    for chunk in response:
+        if getattr(chunk, "usage", None):
+            yield chunk.usage.model_dump()
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def record_turn_metrics(model_type, stream):
+    """记录本轮流式回答的首字延迟与总耗时"""
+    metrics = {
+        "model": model_type,
+        "ttft": stream.ttft,
+        "total_time": stream.total_time,
+        "timestamp": datetime.now().isoformat()
+    }
+    st.session_state.turn_metrics.append(metrics)
+    return metrics
+
+def finish_turn_trace(trace):
+    """结束本轮追踪，保存并返回分阶段耗时分解"""
+    tracing.end_trace(trace)
+    breakdown = {
+        "trace_id": trace.trace_id,
+        "model": trace.model_type,
+        "elapsed": trace.elapsed,
+        "stages": trace.totals(),
+        "timestamp": datetime.now().isoformat()
+    }
+    st.session_state.turn_traces.append(breakdown)
+    del st.session_state.turn_traces[:-TURN_TRACE_HISTORY]
+    return breakdown
+
+def describe_turn_trace(breakdown):
+    """生成本轮耗时分解说明（同一阶段执行多次时显示总耗时和次数）"""
+    parts = [
+        f"{TRACE_STAGE_LABELS.get(stage, stage)} {seconds:.2f}s" + (f"×{count}" if count > 1 else "")
+        for stage, (seconds, count) in breakdown["stages"].items()
+    ]
+    if not parts:
+        return None
+    return f"⏱️ 本轮 {breakdown['elapsed']:.2f}s：" + " · ".join(parts)
+
+def estimate_tokens(text, model_type=None):
+    """按模型计数 token（OpenAI 模型可用 tiktoken 时精确计数，其余为校准过的估算）"""
+    return token_budget.count_tokens(text, model_type)
+
+def record_prompt_tokens(model_type, messages):
+    """记录本轮实际发送的提示词 token 数，回答下方据此显示用量"""
+    tokens = token_budget.count_messages(messages, model_type)
+    if branch_cancelled():
+        return tokens
+    st.session_state.turn_prompt_tokens.append({
+        "model": model_type,
+        "tokens": tokens,
+        "budget": get_prompt_budget(model_type),
+        "window": token_budget.context_window(model_type),
+        "exact": token_budget.get_counter().is_exact(model_type)
+    })
+    return tokens
+
+def calibrate_token_counter(model_type, messages, usage):
+    """用服务商返回的 prompt_tokens 校准该模型的 token 估算器"""
+    if isinstance(usage, dict) and usage.get("prompt_tokens"):
+        token_budget.calibrate(model_type, messages, usage["prompt_tokens"])
+
+def describe_prompt_tokens():
+    """本轮发送的提示词 token 用量说明（没有记录时返回 None）"""
+    records = st.session_state.get("turn_prompt_tokens") or []
+    if not records:
+        return None
+    return " · ".join(
+        f"🔢 {record['model']} 提示词 {'' if record['exact'] else '约 '}{record['tokens']} tokens"
+        f"（预算 {record['budget']} / 上下文窗口 {record['window']}）"
+        for record in records
+    )
+
+def compare_single_model(prompt, model_type, messages, placeholder, dispatch_time, cancel_event=None):
+    """对比模式的单个模型任务：流式请求并实时刷新所在列，返回延迟与 token 统计
+
+    cancel_event 置位（本轮已判定超时）后停止读取并关闭连接，不再刷新所在列、不写入历史，返回 None。
+    """
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    # 对比模式需要测量真实延迟，跳过响应缓存
+    response = call_model_api(prompt, model_type, messages=messages, stream=True, use_cache=False)
+    text = ""
+    ttft = None
+    usage = {}
+    if isinstance(response, ChatStream):
+        last_render = 0.0
+        for piece in response:
+            if cancelled():
+                response.close()
+                return None
+            if ttft is None:
+                ttft = time.perf_counter() - dispatch_time
+            text += piece
+            # 限制刷新频率，避免多列同时高频重绘
+            if time.perf_counter() - last_render > 0.1:
+                placeholder.markdown(text + "▌")
+                last_render = time.perf_counter()
+        usage = response.usage or {}
+    elif response:
+        text = response
+        ttft = time.perf_counter() - dispatch_time
+    latency = time.perf_counter() - dispatch_time
+    if cancelled():
+        return None
+    placeholder.markdown(text or "（未获取到回答）")
+    
+    if isinstance(response, ChatStream) and response.error is not None:
+        return {"model": model_type, "text": "", "error": f"流式输出中断：{str(response.error)}"}
+    
+    completion_tokens = usage.get("completion_tokens") or estimate_tokens(text, model_type)
+    prompt_tokens = usage.get("prompt_tokens") or token_budget.count_messages(messages, model_type)
+    return {
+        "model": model_type,
+        "text": text,
+        "latency": latency,
+        "ttft": ttft,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / latency if text and latency > 0 else 0.0
+    }
+
+def run_model_comparison(prompt, model_types):
+    """对比模式：同一问题并发发送给多个模型，每个回答在独立列中流式显示
+
+    消息列表只格式化一次，由所有模型共用。返回按提交顺序排列的统计结果列表。
+    """
+    # 按参与对比的模型中最小的预算组装，保证每个模型都放得下
+    shared_messages = format_messages_for_model(st.session_state.selected_model, prompt, budget_models=model_types)
+    for model_type in model_types:
+        if model_type != st.session_state.selected_model:
+            manage_chat_history(model_type, "user", prompt)
+    
+    columns = st.columns(len(model_types))
+    placeholders = {}
+    for column, model_type in zip(columns, model_types):
+        with column:
+            st.markdown(f"**{model_type}**")
+            placeholders[model_type] = (st.empty(), st.empty())
+            placeholders[model_type][0].markdown("⏳ 等待响应...")
+    
+    dispatch_time = time.perf_counter()
+    futures = []
+    for model_type in model_types:
+        # 超时后置位，仍在流式输出的模型停止读取，不再刷新所在列或写入历史
+        cancel_event = threading.Event()
+        futures.append((model_type, submit_with_script_ctx(
+            run_branch, compare_single_model,
+            (prompt, model_type, shared_messages, placeholders[model_type][0], dispatch_time), cancel_event
+        ), cancel_event))
+    
+    results = []
+    for model_type, future, cancel_event in futures:
+        remaining = max(COMPARE_TIMEOUT - (time.perf_counter() - dispatch_time), 0)
+        try:
+            result = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            cancel_event.set()
+            future.cancel()
+            result = {"model": model_type, "text": "", "error": f"超过 {COMPARE_TIMEOUT} 秒未完成"}
+        except Exception as e:
+            result = {"model": model_type, "text": "", "error": str(e)}
+        
+        metrics_placeholder = placeholders[model_type][1]
+        if result.get("error"):
+            metrics_placeholder.error(f"❌ {result['error']}")
+        elif result["text"]:
+            metrics_placeholder.caption(
+                f"⏱️ 总耗时 {result['latency']:.2f}s · 首字 {result['ttft']:.2f}s · "
+                f"输入 {result['prompt_tokens']} / 输出 {result['completion_tokens']} tokens · "
+                f"{result['tokens_per_second']:.1f} tokens/s"
+            )
+        results.append(result)
+    
+    st.session_state.compare_results.append({
+        "prompt": prompt,
+        "timestamp": datetime.now().isoformat(),
+        "results": [{k: v for k, v in result.items() if k != "text"} for result in results]
+    })
+    return results
+
+# 使用 langchain 实现 RAG：加载文档、分割、嵌入、索引
+def iter_text_segments(content, window=RAG_SPLIT_WINDOW):
+    """把文本（字符串，或逐段产出字符串的迭代器）切成不超过 window 的片段
+
+    优先在换行、句号或空格处断开，避免把句子切碎。产出 (片段, 已读取的原始字符数)。
+    """
+    pieces = [content] if isinstance(content, str) else content
+    carry = ""
+    consumed = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        start = 0
+        while start < len(piece):
+            take = window - len(carry)
+            segment = carry + piece[start:start + take]
+            consumed += min(take, len(piece) - start)
+            start += take
+            if len(segment) < window:
+                # 当前段已读完，剩余部分与下一段拼接
+                carry = segment + "\n"
+                break
+            cut = max(segment.rfind(sep, window // 2) for sep in ("\n", "。", " "))
+            cut = cut + 1 if cut > 0 else len(segment)
+            yield segment[:cut], consumed
+            carry = segment[cut:]
+    if carry.strip():
+        yield carry, consumed
+
+def iter_document_chunks(content):
+    """惰性地清理并切分文档，产出 (文本块, 进度, 附加元数据)
+
+    content 为字符串时，进度为已读取的原始字符数；
+    为 (页码, 文本) 迭代器时逐页切分，进度为已处理的页数，页码（大于 0 时）写入元数据。
+    """
+    with import_timing.subsystem("文本切分"):
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=RAG_CHUNK_SIZE,
+        chunk_overlap=RAG_CHUNK_OVERLAP,
+        length_function=len,
+    )
+    
+    def split(text):
+        for segment, consumed in iter_text_segments(text):
+            segment = clean_text(segment)
+            if segment:
+                for chunk in text_splitter.split_text(segment):
+                    yield chunk, consumed
+    
+    if isinstance(content, str):
+        for chunk, consumed in split(content):
+            yield chunk, consumed, {}
+        return
+    for pages_done, (page_number, text) in enumerate(content, start=1):
+        metadata = {"page": page_number} if page_number else {}
+        for chunk, _ in split(text):
+            yield chunk, pages_done, metadata
+
+def rag_index_document(content, source, total=None, content_hash=None):
+    """将文档添加到向量数据库
+
+    content 可以是完整字符串，也可以是逐页产出 (页码, 文本) 的迭代器（此时 total 为总页数，用于显示进度）。
+    文本按窗口惰性切分、分批编码并写入索引，不再限制文本块数量。
+    content_hash 为文档内容哈希（字符串内容可省略，自动计算），已登记的文档直接跳过。
+    """
     try:
         # 检查存储路径
         if not st.session_state.get("chromadb_path"):
@@ -871,64 +3069,132 @@ def rag_index_document(content, source):
             return False
             
         # 检查内容
-        if not content or not isinstance(content, str):
+        if content is None or (isinstance(content, str) and not content.strip()):
             st.error("⚠️ 文档内容为空或格式不正确")
             return False
-            
-        # 清理文本内容
-        content = clean_text(content)
-        if not content:
-            st.error("⚠️ 清理后的文本内容为空")
-            return False
-            
-        # 文本分割
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=50,
-            length_function=len,
-        )
-        texts = text_splitter.split_text(content)
         
-        if not texts:
-            st.error("⚠️ 文本分割后为空")
-            return False
-            
-        # 限制文本块数量
-        max_chunks = 100
-        if len(texts) > max_chunks:
-            st.warning(f"文档过大，将只处理前 {max_chunks} 个文本块")
-            texts = texts[:max_chunks]
+        # 内容未变化的文档不再重复编码入库
+        if content_hash is None and isinstance(content, str):
+            content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if content_hash and skip_if_indexed(content_hash, source):
+            return True
             
         # 获取向量库实例
         vectorstore = get_vector_store()
         if not vectorstore:
             return False
         
+        # 已写入索引的文本块 id；入库未完成（中途返回或异常）时记为墓碑，不留下可检索但未登记的文本块
+        chunk_ids = []
+        indexed = False
         try:
-            # 分批添加文档
-            batch_size = 20
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i+batch_size]
-                batch_metadatas = [{"source": source} for _ in batch_texts]
-                vectorstore.add_texts(
-                    texts=batch_texts,
-                    metadatas=batch_metadatas
-                )
+            # 分批编码并添加文档（命中向量缓存的文本块不再经过模型计算）
+            wal = get_vector_wal(os.path.join(st.session_state.chromadb_path, "faiss_index"))
+            lexical = get_lexical_index(st.session_state.chromadb_path)
+            total_units = len(content) if isinstance(content, str) else total
+            progress_bar = st.progress(0.0) if total_units else None
+            status = st.empty()
+            # 同一文档内重复的文本块只入库一次
+            seen_chunks = set()
+            duplicate_count = 0
+            
+            def unique_chunks():
+                nonlocal duplicate_count
+                for item in iter_document_chunks(content):
+                    digest = hashlib.blake2b(item[0].encode("utf-8"), digest_size=16).digest()
+                    if digest in seen_chunks:
+                        duplicate_count += 1
+                        continue
+                    seen_chunks.add(digest)
+                    yield item
+            
+            chunks = unique_chunks()
+            chunk_count = 0
+            start_time = time.perf_counter()
+            # 切分、编码、写索引按批交替进行，分别累计耗时，整篇文档结束后各记录一个 span
+            stage_seconds = {"split": 0.0, "embed": 0.0, "index_write": 0.0}
+            shared = get_shared_vector_store(st.session_state.chromadb_path)
+            # 等待正在进行的后台清理结束，避免重建索引时丢失新增的向量
+            with wal.maintenance_lock:
+                while True:
+                    stage_start = time.perf_counter()
+                    batch = list(itertools.islice(chunks, RAG_EMBED_BATCH_SIZE))
+                    stage_seconds["split"] += time.perf_counter() - stage_start
+                    if not batch:
+                        break
+                    batch_texts = [text for text, _, _ in batch]
+                    batch_metadatas = [{"source": source, **extra} for _, _, extra in batch]
+                    batch_ids = [str(uuid.uuid4()) for _ in batch_texts]
+                    stage_start = time.perf_counter()
+                    batch_vectors = embed_texts_cached(batch_texts)
+                    stage_seconds["embed"] += time.perf_counter() - stage_start
+                    if batch_vectors is None:
+                        return False
+                    # 先写增量日志再更新内存索引
+                    stage_start = time.perf_counter()
+                    chunk_ids.extend(batch_ids)
+                    wal.append(batch_ids, batch_texts, batch_metadatas, batch_vectors)
+                    with shared.writing():
+                        vectorstore.add_embeddings(
+                            text_embeddings=list(zip(batch_texts, batch_vectors)),
+                            metadatas=batch_metadatas,
+                            ids=batch_ids
+                        )
+                    lexical.add(batch_ids, batch_texts)
+                    stage_seconds["index_write"] += time.perf_counter() - stage_start
+                
+                    chunk_count += len(batch_texts)
+                    rate = chunk_count / max(time.perf_counter() - start_time, 1e-6)
+                    if progress_bar:
+                        progress_bar.progress(min(batch[-1][1] / total_units, 1.0))
+                    status.caption(f"已索引 {chunk_count} 个文本块（{rate:.1f} 块/秒）")
+            
+            if progress_bar:
+                progress_bar.empty()
+            status.empty()
+            for stage, seconds in stage_seconds.items():
+                tracing.observe(stage, seconds, kind="document", source=source, chunks=chunk_count)
+            if chunk_count == 0:
+                st.error("⚠️ 文档中未提取到有效文本块")
+                return False
+            
+            with wal.maintenance_lock:
+                # 文本块数量超过阈值时自动从 Flat 迁移到近似索引
+                index_config = load_index_config(st.session_state.chromadb_path)
+                with shared.writing():
+                    migrated = apply_index_config(vectorstore, index_config)
+                if migrated:
+                    st.info(f"📈 知识库已达 {vectorstore.index.ntotal} 个文本块，索引已重建为 {get_index_type(vectorstore.index)}")
             
-            # 保存向量库
-            save_path = os.path.join(st.session_state.chromadb_path, "faiss_index")
-            vectorstore.save_local(save_path)
+                # 增量已写入日志；索引迁移后或增量积累到阈值时才重写完整快照
+                if migrated or wal.should_compact():
+                    compact_vector_store(vectorstore, st.session_state.chromadb_path)
             
-            # 更新会话状态
-            st.session_state.vector_store = vectorstore
+            # 登记文档；同一来源的旧版本标记删除（先写新版本再删旧版本，检索不会出现空窗）
+            registry = get_document_registry(st.session_state.chromadb_path)
+            if content_hash:
+                registry.register(content_hash, source, chunk_ids)
+            indexed = True
+            if content_hash:
+                replaced = registry.delete_source(source, keep_hash=content_hash)
+                if replaced:
+                    st.info(f"🔄 已替换 {source} 的旧版本（{replaced} 个文本块）")
+                    schedule_purge(vectorstore, st.session_state.chromadb_path)
+            st.session_state.vector_store_version = shared.version
             if source not in st.session_state.rag_data:
                 st.session_state.rag_data.append(source)
-            st.success(f"✅ 成功添加 {len(texts)} 个文本块到知识库")
+            elapsed = time.perf_counter() - start_time
+            duplicate_note = f"，跳过 {duplicate_count} 个重复文本块" if duplicate_count else ""
+            st.success(f"✅ 成功添加 {chunk_count} 个文本块到知识库（{elapsed:.1f}s，{chunk_count / max(elapsed, 1e-6):.1f} 块/秒{duplicate_note}）")
             return True
             
         except Exception as e:
             st.error(f"添加文档失败：{str(e)}")
             return False
+        finally:
+            if chunk_ids and not indexed:
+                get_document_registry(st.session_state.chromadb_path).discard(source, chunk_ids)
+                schedule_purge(vectorstore, st.session_state.chromadb_path)
             
     except Exception as e:
         st.error(f"❌ 处理文档失败：{str(e)}")
@@ -936,28 +3202,54 @@ def rag_index_document(content, source):
         st.error(f"详细错误：{traceback.format_exc()}")
         return False
 
-def rag_generate_response(query):
-    """生成 RAG 响应"""
+def unique_documents(docs, k):
+    """按文本内容去重，返回前 k 个检索结果"""
+    seen = set()
+    unique = []
+    for doc in docs:
+        if doc.page_content in seen:
+            continue
+        seen.add(doc.page_content)
+        unique.append(doc)
+        if len(unique) == k:
+            break
+    return unique
+
+def rag_generate_response(query, cancel_event=None):
+    """生成 RAG 响应
+
+    作为本轮的并发分支运行时传入 cancel_event：超时后不再调用模型、不再输出提示，结果被丢弃。
+    """
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
     try:
         # 获取向量库实例
         vectorstore = get_vector_store()
         if not vectorstore:
             return "请先上传文件或网址到知识库。"
         
-        # 限制相似性搜索的数量
-        k = 2  # 减少返回的文档数量
-        
         try:
-            # 执行相似性搜索
-            docs = vectorstore.similarity_search(query, k=k)
+            # 执行相似性搜索（过滤已删除和内容重复的文本块）
+            docs = search_knowledge_base(vectorstore, query, RAG_MAX_DOCS)
+            if cancelled():
+                return None
             
             if not docs:
                 return "未找到相关信息。请尝试调整问题或添加更多相关文档。"
             
-            # 限制上下文长度
-            max_context_length = 2000
-            context = "\n\n".join([doc.page_content[:max_context_length] for doc in docs])
-            sources = "\n".join([f"- {doc.metadata.get('source', '未知来源')}" for doc in docs])
+            # 按相关度依次把检索结果填入 token 预算，放不下的文本块截断或舍弃
+            model_type = st.session_state.selected_model
+            context_budget = int(get_prompt_budget(model_type) * RAG_CONTEXT_SHARE) - estimate_tokens(query, model_type)
+            texts, _ = token_budget.pack_texts([doc.page_content for doc in docs], context_budget, model_type)
+            docs = docs[:max(len(texts), 1)]
+            context = "\n\n".join(texts or [docs[0].page_content[:RAG_CHUNK_SIZE]])
+            # 同一来源（同一页）的多个文本块只列出一次
+            sources = "\n".join(dict.fromkeys(
+                f"- {doc.metadata.get('source', '未知来源')}"
+                + (f"（第 {doc.metadata['page']} 页）" if doc.metadata.get('page') else "")
+                for doc in docs
+            ))
             
             # 构建提示词
             prompt = f"""基于以下参考信息回答问题。如果参考信息不足以回答问题，请明确说明。
@@ -971,15 +3263,21 @@ def rag_generate_response(query):
 """
             # 调用模型生成回答
             response = call_model_api(prompt, st.session_state.selected_model)
+            if cancelled():
+                return None
             if response:
                 return f"{response}\n\n来源：\n{sources}"
             return "生成回答失败，请重试。"
             
         except Exception as e:
+            if cancelled():
+                return None
             st.error(f"搜索相关文档失败：{str(e)}")
             return "处理查询时出错，请重试。"
             
     except Exception as e:
+        if cancelled():
+            return None
         st.error(f"❌ 生成回答失败：{str(e)}")
         import traceback
         st.error(f"详细错误：{traceback.format_exc()}")
@@ -1013,7 +3311,6 @@ def handle_file_upload(uploaded_files):
                     content = extract_text_from_file(uploaded_file)
                     if content:
                         if rag_index_document(content, file_name):
-                            st.session_state.rag_data.append(file_name)
                             st.success(f"文件 {file_name} 已成功加入 RAG 知识库")
                 else:
                     st.warning(f"RAG 模式下，文件 {file_name} 的类型（{file_type}）不支持加入知识库。")
@@ -1054,18 +3351,19 @@ def handle_file_upload(uploaded_files):
                                     ]
                                 }
                                 
-                                response = requests.post(
-                                    "https://api.moonshot.cn/v1/chat/completions",
-                                    json=payload,
-                                    headers=headers
-                                )
+                                with tracing.span("llm_total", "Kimi(视觉理解)", stream=False):
+                                    response = http_client.post(
+                                        "https://api.moonshot.cn/v1/chat/completions",
+                                        json=payload,
+                                        headers=headers
+                                    )
                                 
                                 if response.status_code == 200:
                                     result = response.json()["choices"][0]["message"]["content"]
                                     st.success("✅ 图片分析完成")
                                     with st.chat_message("assistant"):
                                         st.markdown(f"**图片分析结果：**\n\n{result}")
-                                    st.session_state.messages.append({
+                                    append_display_message({
                                         "role": "assistant",
                                         "content": f"图片 {uploaded_file.name} 的分析结果：\n\n{result}",
                                         "type": "text"
@@ -1078,7 +3376,7 @@ def handle_file_upload(uploaded_files):
                     if speech_result:
                         st.write("语音识别结果：")
                         st.write(speech_result)
-                        st.session_state.messages.append({
+                        append_display_message({
                             "role": "assistant",
                             "content": f"语音识别结果：\n{speech_result}",
                             "type": "text"
@@ -1091,7 +3389,7 @@ def handle_file_upload(uploaded_files):
                         if summary_result:
                             st.write("文本总结结果：")
                             st.write(summary_result)
-                            st.session_state.messages.append({
+                            append_display_message({
                                 "role": "assistant",
                                 "content": f"文本总结结果：\n{summary_result}",
                                 "type": "text"
@@ -1101,37 +3399,76 @@ def handle_file_upload(uploaded_files):
         except Exception as e:
             st.error(f"文件处理失败 ({file_name}): {str(e)}")
 
+@tracing.traced("extract")
 def extract_text_from_file(file):
     """从不同类型的文件中提取文本内容"""
     try:
-        file_type = file.name.split('.')[-1].lower()
-        content = file.read()
-        
-        if file_type == 'txt':
-            # 处理文本文件
-            return content.decode('utf-8')
-        elif file_type == 'pdf':
-            # 处理 PDF 文件
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-            return "\n".join([page.extract_text() for page in pdf_reader.pages])
-        elif file_type in ['docx', 'doc']:
-            # 处理 Word 文件
-            doc = Document(io.BytesIO(content))
-            return "\n".join([para.text for para in doc.paragraphs])
-        elif file_type in ['csv', 'xlsx', 'xls']:
-            # 处理表格文件
-            if file_type == 'csv':
-                df = pd.read_csv(io.BytesIO(content))
-            else:
-                df = pd.read_excel(io.BytesIO(content))
-            return df.to_string()
-        else:
-            st.warning(f"不支持的文件类型：{file_type}")
-            return None
+        content = text_extraction.extract_text(file.name, file.read())
+        if content is None:
+            st.warning(f"不支持的文件类型：{text_extraction.get_file_type(file.name)}")
+        return content
     except Exception as e:
         st.error(f"处理文件失败：{str(e)}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def get_extraction_pool():
+    """进程级文本提取进程池
+
+    使用 spawn 启动工作进程，避免 fork 已加载向量模型和多个线程的服务进程。
+    """
+    import multiprocessing
+    return ProcessPoolExecutor(
+        max_workers=max(1, EXTRACT_MAX_WORKERS),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_page_cache(cache_path):
+    """按路径共享的进程级页面文本缓存"""
+    return text_extraction.PageTextCache(cache_path)
+
+def spool_uploaded_file(file):
+    """把上传文件分块写入临时文件，返回临时文件路径（供工作进程内存映射打开）"""
+    file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{text_extraction.get_file_type(file.name)}") as temp_file:
+        shutil.copyfileobj(file, temp_file, 1024 * 1024)
+        return temp_file.name
+
+def submit_text_extraction(files, cache_path):
+    """把 (上传文件, 文件哈希) 列表提交到进程池并行逐页提取文本，返回 {future: (file, 文件哈希)}
+
+    提取结果逐页写入页面缓存，future 的结果为 (页数, 提取耗时)。
+    已缓存的文件直接返回；进程池不可用时退回当前进程内提取。
+    """
+    cache = get_page_cache(cache_path)
+    futures = {}
+    for file, file_hash in files:
+        page_count = cache.page_count(file_hash)
+        if page_count is not None:
+            # 同一文件内容已提取过，直接读取页面缓存
+            future = Future()
+            future.set_result((page_count, 0.0))
+            futures[future] = (file, file_hash)
+            continue
+        
+        temp_path = spool_uploaded_file(file)
+        args = (text_extraction.extract_pages_to_cache, temp_path, file.name, file_hash, cache_path)
+        try:
+            future = get_extraction_pool().submit(*args)
+        except (BrokenProcessPool, RuntimeError, OSError):
+            # 进程池已损坏：丢弃缓存的实例，本次在当前进程内同步提取
+            get_extraction_pool.clear()
+            future = Future()
+            try:
+                future.set_result(args[0](*args[1:]))
+            except Exception as e:
+                future.set_exception(e)
+        # 提取结束后删除临时文件
+        future.add_done_callback(lambda _, path=temp_path: os.path.exists(path) and os.unlink(path))
+        futures[future] = (file, file_hash)
+    return futures
+
 def perform_speech_recognition(audio_bytes):
     """
     使用当前选择的模型进行语音识别
@@ -1143,7 +3480,9 @@ def perform_speech_recognition(audio_bytes):
     
     try:
         # 创建 OpenAI 客户端
-        client = OpenAI(api_key=api_key)
+        with import_timing.subsystem("OpenAI SDK"):
+            from openai import OpenAI
+        client = OpenAI(api_key=api_key, http_client=http_client.get_httpx_client())
         
         # 将音频数据转换为临时文件
         with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
@@ -1182,13 +3521,14 @@ def retrieve_relevant_content(query):
     """
     vectorstore = get_vector_store()
     try:
-        results = vectorstore.similarity_search(query, k=3)
+        results = search_knowledge_base(vectorstore, query, 3)
     except Exception as e:
         st.error(f"检索时出现错误: {str(e)}")
         return []
     # 提取文档 metadata 中的 "source" 信息；如果不存在则返回 "未知来源"
     return [doc.metadata.get("source", "未知来源") for doc in results]
 
+@tracing.traced("fetch")
 def fetch_url_content(url):
     """获取网页内容并提取有效文本"""
     try:
@@ -1196,10 +3536,12 @@ def fetch_url_content(url):
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        response = requests.get(url, headers=headers, verify=False, timeout=10)
+        response = http_client.get(url, headers=headers, verify=False, timeout=10)
         response.raise_for_status()
         
         # 使用 BeautifulSoup 提取文本内容
+        with import_timing.subsystem("网页解析"):
+            from bs4 import BeautifulSoup
         soup = BeautifulSoup(response.content, 'html.parser')
         
         # 移除脚本和样式元素
@@ -1226,13 +3568,25 @@ def clear_vector_store():
             return False
             
         db_path = st.session_state.chromadb_path
-        if os.path.exists(db_path):
-            import shutil
-            shutil.rmtree(db_path)
-            # 重新创建目录
-            os.makedirs(db_path, exist_ok=True)
+        index_path = os.path.join(db_path, "faiss_index")
+        shared = get_shared_vector_store(db_path)
+        # 与合并快照相同的加锁顺序：等待进行中的入库和清理结束，删除期间检索排队等待
+        with get_vector_wal(index_path).maintenance_lock, shared.writing():
+            if os.path.exists(db_path):
+                import shutil
+                shutil.rmtree(db_path)
+                # 重新创建目录
+                os.makedirs(db_path, exist_ok=True)
+            
+            # 丢弃该路径下指向已删除文件的进程级实例（其他知识库路径不受影响），下次使用时重新创建
+            get_shared_vector_store.clear(db_path)
+            get_vector_wal.clear(index_path)
+            get_document_registry.clear(db_path)
+            get_lexical_index.clear(db_path)
+            get_page_cache.clear(os.path.join(db_path, "page_cache.sqlite"))
+            get_embedding_cache.clear(os.path.join(db_path, "embedding_cache"))
             
-        st.session_state.vector_store = None
+        st.session_state.vector_store_version = None
         st.session_state.rag_data = []
         st.success("✅ 知识库已清空")
         st.rerun()
@@ -1316,6 +3670,7 @@ def is_financial_domain(url):
     except:
         return 0
 
+@tracing.traced("search")
 def perform_web_search(query, max_results=10):
     """执行优化的财经金融搜索"""
     try:
@@ -1331,10 +3686,11 @@ def perform_web_search(query, max_results=10):
             optimized_query = query
         
         # 使用 DuckDuckGoSearchRun 进行主搜索
-        search_tool = DuckDuckGoSearchRun()
-        initial_results = search_tool.run(optimized_query)
+        initial_results = get_search_tool().run(optimized_query)
         
         # 使用 DDGS 进行补充搜索
+        with import_timing.subsystem("联网搜索"):
+            from duckduckgo_search import DDGS
         with DDGS() as ddgs:
             detailed_results = list(ddgs.text(
                 optimized_query,
@@ -1404,14 +3760,23 @@ def perform_web_search(query, max_results=10):
         return final_response.strip()
     
     except Exception as e:
-        st.error(f"财经信息搜索失败: {str(e)}")
+        if not branch_cancelled():
+            st.error(f"财经信息搜索失败: {str(e)}")
         return None
 
-def get_search_response(query):
-    """生成优化的财经搜索响应，并由大模型总结"""
+def get_search_response(query, cancel_event=None):
+    """生成优化的财经搜索响应，并由大模型总结
+
+    作为本轮的并发分支运行时传入 cancel_event：超时后不再调用模型、不再输出提示，结果被丢弃。
+    """
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
     try:
         # 获取搜索结果
         search_results = perform_web_search(query)
+        if cancelled():
+            return None
         if not search_results:
             return "抱歉，没有找到相关的财经信息。"
         
@@ -1434,6 +3799,8 @@ def get_search_response(query):
 """
         # 调用大模型进行总结
         summary = call_model_api(summary_prompt, st.session_state.selected_model)
+        if cancelled():
+            return None
         
         # 构建最终响应
         response = "📊 **核心回答：**\n\n"
@@ -1447,7 +3814,8 @@ def get_search_response(query):
         return response
 
     except Exception as e:
-        st.error(f"生成回答失败：{str(e)}")
+        if not cancelled():
+            st.error(f"生成回答失败：{str(e)}")
         return None
 
 def process_urls(urls_input):
@@ -1458,10 +3826,13 @@ def process_urls(urls_input):
         with st.spinner(f"正在处理网址：{url}"):
             try:
                 # 发送 HTTP 请求获取网页内容
-                response = requests.get(url, timeout=10)
-                response.raise_for_status()  # 检查请求是否成功
+                with tracing.span("fetch", url=url):
+                    response = http_client.get(url, timeout=10)
+                    response.raise_for_status()  # 检查请求是否成功
                 
                 # 使用 BeautifulSoup 解析网页内容
+                with import_timing.subsystem("网页解析"):
+                    from bs4 import BeautifulSoup
                 soup = BeautifulSoup(response.content, 'html.parser')
                 
                 # 移除脚本和样式元素
@@ -1479,7 +3850,6 @@ def process_urls(urls_input):
                 if text:
                     # 将网页内容添加到 RAG 知识库
                     if rag_index_document(text, url):
-                        st.session_state.rag_data.append(url)
                         st.success(f"✅ 网址 {url} 已成功加入知识库")
                 else:
                     st.warning(f"⚠️ 网址 {url} 未提取到有效内容")
@@ -1489,21 +3859,231 @@ def process_urls(urls_input):
             except Exception as e:
                 st.error(f"❌ 处理网址 {url} 时出错：{str(e)}")
 
+def current_rss_bytes():
+    """当前进程常驻内存（字节），仅在支持 /proc 的系统上可用"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class EmbeddingModelHolder:
+    """进程级 embedding 模型持有者：模型只加载一次，由所有会话共享
+
+    首次加载时执行一次预热编码，并记录加载耗时、参数内存和进程内存增量。
+    """
+
+    def __init__(self, model_name, cache_folder="models"):
+        self.model_name = model_name
+        self.cache_folder = cache_folder
+        self.embeddings = None
+        self.info = {"state": "idle"}
+        self._lock = threading.Lock()
+
+    def get(self):
+        """返回已加载的模型；尚未加载时在当前线程加载（并发调用只会加载一次）"""
+        with self._lock:
+            if self.embeddings is None:
+                self._load()
+            return self.embeddings
+
+    def _load(self):
+        self.info = {"state": "loading"}
+        rss_before = current_rss_bytes()
+        start_time = time.perf_counter()
+        try:
+            with import_timing.subsystem("向量库"):
+                from langchain_community.embeddings import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(
+                model_name=self.model_name,
+                cache_folder=self.cache_folder
+            )
+            embeddings.embed_query("预热")  # 触发权重加载与首次前向计算
+        except Exception as e:
+            self.info = {"state": "failed", "error": str(e)}
+            raise
+        rss_after = current_rss_bytes()
+        param_bytes = None
+        client = getattr(embeddings, "client", None)
+        if client is not None and hasattr(client, "parameters"):
+            param_bytes = sum(p.numel() * p.element_size() for p in client.parameters())
+        self.embeddings = embeddings
+        self.info = {
+            "state": "ready",
+            "load_seconds": time.perf_counter() - start_time,
+            "param_bytes": param_bytes,
+            "rss_delta_bytes": rss_after - rss_before if rss_before and rss_after else None,
+            "loaded_at": datetime.now().isoformat()
+        }
+
+    def warm_up_async(self):
+        """在后台线程中预加载模型，不阻塞页面渲染"""
+        def warm_up():
+            try:
+                self.get()
+            except Exception:
+                pass  # 错误信息已记录在 info 中，首次实际使用时会再次尝试并提示
+
+        threading.Thread(target=warm_up, name="embedding-warmup", daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_holder():
+    """进程级 embedding 模型单例；服务进程内首次运行脚本时开始后台预热"""
+    holder = EmbeddingModelHolder(EMBEDDING_MODEL_NAME)
+    if EMBEDDING_WARMUP:
+        holder.warm_up_async()
+    return holder
+
 def get_embeddings():
-    """获取 embeddings 实例"""
+    """获取 embeddings 实例（进程级共享，只加载一次）"""
     try:
-        # 使用中文基础模型
-        embeddings = HuggingFaceEmbeddings(
-            model_name="shibing624/text2vec-base-chinese",
-            cache_folder="models"
-        )
-        return embeddings
+        return get_embedding_holder().get()
     except Exception as e:
         st.error(f"初始化 embeddings 失败：{str(e)}")
         import traceback
         st.error(f"详细错误：{traceback.format_exc()}")
         return None
 
+class EmbeddingCache:
+    """文本块向量的内容寻址缓存，键为 (embedding 模型, 文本 SHA-256)
+
+    向量以 float32 矩阵追加写入 vectors.f32 并通过内存映射读取，
+    SQLite 偏移索引记录每个键所在的行。命中时完全跳过模型前向计算。
+    """
+
+    def __init__(self, cache_dir, model_id):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self._lock = threading.Lock()
+        self._matrix = None  # 当前的只读内存映射
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "offsets.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS offsets (key TEXT PRIMARY KEY, row INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dimension'").fetchone()
+        self.dimension = int(row[0]) if row else None
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_id}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _row_count(self):
+        if not self.dimension or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dimension * 4)
+
+    def _mapped_matrix(self, min_rows):
+        """返回覆盖至少 min_rows 行的内存映射，文件增长后重新映射（调用方需持有锁）"""
+        import numpy as np
+        if self._matrix is None or self._matrix.shape[0] < min_rows:
+            rows = self._row_count()
+            self._matrix = np.memmap(self.vectors_path, dtype="float32", mode="r",
+                                     shape=(rows, self.dimension))
+        return self._matrix
+
+    def get_many(self, texts):
+        """批量查询，返回与 texts 对齐的向量列表（未命中为 None）"""
+        keys = [self._key(text) for text in texts]
+        results = [None] * len(texts)
+        with self._lock:
+            rows = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows.update(self._conn.execute(
+                    f"SELECT key, row FROM offsets WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            if rows:
+                matrix = self._mapped_matrix(max(rows.values()) + 1)
+                for i, key in enumerate(keys):
+                    if key in rows:
+                        results[i] = matrix[rows[key]].tolist()
+            hits = sum(1 for vector in results if vector is not None)
+            self.stats["hits"] += hits
+            self.stats["misses"] += len(texts) - hits
+        return results
+
+    def put_many(self, texts, vectors):
+        """追加写入新向量及其偏移"""
+        import numpy as np
+        if not texts:
+            return
+        matrix = np.asarray(vectors, dtype="float32")
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = matrix.shape[1]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('dimension', ?)", (str(self.dimension),)
+                )
+            start_row = self._row_count()
+            with open(self.vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO offsets (key, row) VALUES (?, ?)",
+                [(self._key(text), start_row + i) for i, text in enumerate(texts)]
+            )
+            self._conn.commit()
+
+    def snapshot(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM offsets").fetchone()[0]
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "entries": entries,
+            "bytes": os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0,
+            "hit_rate": stats["hits"] / lookups if lookups else 0.0
+        })
+        return stats
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_cache(cache_dir):
+    """按目录共享的进程级向量缓存"""
+    return EmbeddingCache(cache_dir, EMBEDDING_MODEL_NAME)
+
+def embed_texts_cached(texts):
+    """编码文本块：先查向量缓存，只对未命中的文本调用模型，返回与 texts 对齐的向量列表"""
+    embeddings = get_embeddings()
+    if embeddings is None:
+        return None
+    cache = get_embedding_cache(os.path.join(st.session_state.chromadb_path, "embedding_cache"))
+    vectors = cache.get_many(texts)
+    # 同一批次内的重复文本只计算一次
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing:
+        computed = embeddings.embed_documents(missing)
+        cache.put_many(missing, computed)
+        computed_by_text = dict(zip(missing, computed))
+        vectors = [vector if vector is not None else computed_by_text[text]
+                   for text, vector in zip(texts, vectors)]
+    return vectors
+
+def describe_embedding_status():
+    """生成 embedding 模型加载状态说明"""
+    info = get_embedding_holder().info
+    if info["state"] == "ready":
+        details = [f"加载耗时 {info['load_seconds']:.1f}s"]
+        if info.get("param_bytes"):
+            details.append(f"参数 {info['param_bytes'] / 1024 / 1024:.0f} MB")
+        if info.get("rss_delta_bytes"):
+            details.append(f"进程内存增加 {info['rss_delta_bytes'] / 1024 / 1024:.0f} MB")
+        return "✅ 向量模型已加载（" + "，".join(details) + "）"
+    if info["state"] == "loading":
+        return "⏳ 向量模型正在后台加载..."
+    if info["state"] == "failed":
+        return f"❌ 向量模型加载失败：{info.get('error')}"
+    return "向量模型尚未加载"
+
+# 服务进程内首次运行时启动向量模型后台预热（之后的会话直接复用）
+get_embedding_holder()
+
 # ====================
 # 侧边栏配置
 # ====================
@@ -1579,6 +4159,10 @@ with st.sidebar:
         st.session_state.temperature = st.slider("创意度", 0.0, 1.0, 0.5, 0.1)
     with col2:
         st.session_state.max_tokens = st.slider("响应长度", 100, 4096, 2048, 100)
+    st.session_state.context_share = st.slider(
+        "上下文占用比例", 0.1, 0.9, CONTEXT_SHARE, 0.05,
+        help="系统提示词、对话历史和知识库参考信息合计最多占用模型上下文窗口的比例"
+    )
 
     # 联网搜索功能按钮
     if st.button(
@@ -1596,6 +4180,47 @@ with st.sidebar:
         st.session_state.rag_enabled = not st.session_state.rag_enabled
         st.rerun()
 
+    # 流式输出按钮
+    if st.button(
+        f"⚡ 流式输出[{('on' if st.session_state.stream_enabled else 'off')}]",
+        use_container_width=True
+    ):
+        st.session_state.stream_enabled = not st.session_state.stream_enabled
+        st.rerun()
+
+    # 摘要记忆按钮
+    if st.button(
+        f"🧠 摘要记忆[{('on' if st.session_state.summary_memory_enabled else 'off')}]",
+        use_container_width=True,
+        help="较早的对话在后台折叠为摘要，每轮提示词只包含摘要和最近几条消息"
+    ):
+        st.session_state.summary_memory_enabled = not st.session_state.summary_memory_enabled
+        st.rerun()
+    summary_state = st.session_state.chat_summaries.get(st.session_state.selected_model)
+    if st.session_state.summary_memory_enabled and summary_state and summary_state["summary"]:
+        st.caption(
+            f"🧠 已折叠 {summary_state['folded']} 条早期消息，摘要约 "
+            f"{token_budget.count_tokens(summary_state['summary'], st.session_state.selected_model)} tokens"
+        )
+
+    # 多模型对比按钮
+    if st.button(
+        f"⚖️ 对比模式[{('on' if st.session_state.compare_enabled else 'off')}]",
+        use_container_width=True
+    ):
+        st.session_state.compare_enabled = not st.session_state.compare_enabled
+        st.rerun()
+    
+    if st.session_state.compare_enabled:
+        comparable_models = [m for m in model_options if m != "DALL-E(文生图)"]
+        st.session_state.compare_models = st.multiselect(
+            "选择对比模型",
+            comparable_models,
+            default=[m for m in st.session_state.compare_models if m in comparable_models]
+                    or comparable_models[:2],
+            help="同一问题将并发发送给所选模型，对比模式下不使用联网搜索和 RAG"
+        )
+
     # API 测试功能
     st.subheader("API 测试")
     if st.button("🔍 测试 API 连接"):
@@ -1613,8 +4238,97 @@ with st.sidebar:
                 except Exception as e:
                     st.error(f"API 测试失败：{str(e)}")
 
+    # 连接池状态（进程级，所有会话共享）
+    with st.expander("🔌 连接池状态", expanded=False):
+        pool_stats = http_client.get_stats()
+        if pool_stats:
+            st.caption(f"每主机连接数上限：{http_client.POOL_MAXSIZE}，keep-alive 空闲探测：{http_client.KEEPALIVE_IDLE}s")
+            for host, stats in pool_stats.items():
+                st.markdown(
+                    f"**{urlparse(host).netloc}**：请求 {stats['requests']} 次，"
+                    f"新建连接 {stats['new_connections']}，复用 {stats['reused_connections']}"
+                    f"（{stats['reuse_rate']:.0%}），平均耗时 {stats['avg_seconds']:.2f}s"
+                )
+        else:
+            st.caption("暂无请求记录")
+
+    # 脚本与各片段的运行耗时（侧边栏只在完整运行时刷新，显示的是此前的记录）
+    with st.expander("⏱️ 运行耗时", expanded=False):
+        if st.session_state.run_timings:
+            for scope, samples in st.session_state.run_timings.items():
+                st.caption(
+                    f"{scope}：最近 {samples[-1]:.0f} ms，平均 {sum(samples) / len(samples):.0f} ms"
+                    f"（{len(samples)} 次）"
+                )
+        else:
+            st.caption("暂无记录")
+        # 进程级：各阶段累计耗时（与 /metrics 端点的直方图同源）
+        stage_totals = {}
+        for (stage, _), entry in tracing.get_metrics().snapshot().items():
+            totals = stage_totals.setdefault(stage, {"count": 0, "sum": 0.0, "errors": 0})
+            for name in totals:
+                totals[name] += entry[name]
+        if stage_totals:
+            st.markdown("**各阶段耗时（进程级）**")
+            for stage, totals in stage_totals.items():
+                errors_note = f"，失败 {totals['errors']} 次" if totals["errors"] else ""
+                st.caption(
+                    f"{TRACE_STAGE_LABELS.get(stage, stage)}：平均 {totals['sum'] / totals['count']:.2f}s"
+                    f"（{totals['count']} 次{errors_note}）"
+                )
+        metrics_server = get_metrics_server()
+        if metrics_server:
+            st.caption(f"指标端点：http://{METRICS_HOST}:{metrics_server.server_port}/metrics")
+        # 进程级：启动时的顶层导入和各子系统首次使用时的导入耗时
+        import_report = import_timing.report()
+        if import_report:
+            st.markdown("**导入耗时（进程级）**")
+            for name, entry in import_report:
+                st.caption(f"{name}：{entry['seconds'] * 1000:.0f} ms，新加载 {entry['modules']} 个模块")
+
+    # 响应缓存（进程级，所有会话共享）
+    with st.expander("💾 响应缓存", expanded=False):
+        st.session_state.response_cache_enabled = st.checkbox(
+            "启用响应缓存",
+            value=st.session_state.response_cache_enabled,
+            help="相同模型、相同消息与参数的请求直接返回缓存的回答"
+        )
+        st.session_state.cache_nondeterministic = st.checkbox(
+            "缓存非确定性回答",
+            value=st.session_state.cache_nondeterministic,
+            help="默认只缓存创意度为 0 的回答；开启后创意度大于 0 的回答也会被缓存"
+        )
+        cache_stats = get_response_cache().snapshot()
+        st.caption(
+            f"命中率 {cache_stats['hit_rate']:.0%}（内存 {cache_stats['memory_hits']} / "
+            f"磁盘 {cache_stats['disk_hits']} / 未命中 {cache_stats['misses']}），"
+            f"共 {cache_stats['disk_entries']} 条，{cache_stats['disk_bytes'] / 1024:.1f} KB，"
+            f"淘汰 {cache_stats['evictions']} 条"
+        )
+        st.markdown("**语义缓存**")
+        st.session_state.semantic_cache_enabled = st.checkbox(
+            "启用语义缓存",
+            value=st.session_state.semantic_cache_enabled,
+            help="用向量模型匹配意思相近的问题，直接返回同一模型、同一助手角色下的历史回答"
+        )
+        st.session_state.semantic_cache_threshold = st.slider(
+            "相似度阈值", 0.80, 0.99, st.session_state.semantic_cache_threshold, 0.01
+        )
+        semantic_stats = get_semantic_cache().snapshot()
+        st.caption(
+            f"命中率 {semantic_stats['hit_rate']:.0%}（命中 {semantic_stats['hits']} / "
+            f"未命中 {semantic_stats['misses']}），共 {semantic_stats['entries']} 条，"
+            f"淘汰 {semantic_stats['evictions']} 条"
+        )
+        if st.button("🗑️ 清空响应缓存"):
+            get_response_cache().clear()
+            get_semantic_cache().clear()
+            st.success("✅ 响应缓存已清空")
+
     if st.button("🧹 清空对话历史"):
-        st.session_state.messages = []
+        # 删除当前对话的记录并开始新对话（各模型的历史和摘要一并清空）
+        get_conversation_store().delete(st.session_state.conversation_id)
+        start_conversation()
         st.rerun()
 
     # 在主界面的侧边栏添加 ChromaDB 配置
@@ -1675,164 +4389,199 @@ st.title("🤖 多模型智能助手2.10(学术增强版)")
 # 文件和网址上传区域
 st.markdown("### 📁 文件上传")
 
-# RAG 模式：多文件上传和网址输入
-if st.session_state.rag_enabled:
-    # 文件上传
-    uploaded_files = st.file_uploader(
-        "支持多个文件上传（建议不超过5个）",
-        accept_multiple_files=True,
-        type=["txt", "pdf", "docx", "doc", "csv", "xlsx", "xls"],
-        key="multi_file_uploader"
-    )
+@st.fragment
+def render_upload_panel():
+    """文件上传面板（独立片段：选择文件、提交只重新运行本面板）"""
+    run_start = time.perf_counter()
+    # RAG 模式：多文件上传和网址输入
+    if st.session_state.rag_enabled:
+        # 文件上传
+        uploaded_files = st.file_uploader(
+            "支持多个文件上传（建议不超过5个）",
+            accept_multiple_files=True,
+            type=["txt", "pdf", "docx", "doc", "csv", "xlsx", "xls"],
+            key="multi_file_uploader"
+        )
     
-    # 网址输入
-    st.markdown("### 🔗 网址上传")
-    urls_input = st.text_area(
-        "每行输入一个网址（建议不超过5个）",
-        height=100,
-        key="urls_input",
-        placeholder="https://example1.com\nhttps://example2.com"
-    )
+        # 网址输入
+        st.markdown("### 🔗 网址上传")
+        urls_input = st.text_area(
+            "每行输入一个网址（建议不超过5个）",
+            height=100,
+            key="urls_input",
+            placeholder="https://example1.com\nhttps://example2.com"
+        )
     
-    # 提交按钮
-    if st.button("📤 提交文件和网址"):
-        if not uploaded_files and not urls_input.strip():
-            st.warning("请至少上传一个文件或输入一个网址。")
-        else:
-            success_count = 0
-            # 处理文件
-            if uploaded_files:
-                if len(uploaded_files) > 5:
-                    st.warning("⚠️ 文件数量超过5个，建议减少文件数量以获得更好的处理效果。")
-                
-                for file in uploaded_files:
-                    with st.spinner(f"正在处理文件：{file.name}"):
-                        try:
-                            content = extract_text_from_file(file)
-                            if content:
-                                if rag_index_document(content, file.name):
-                                    success_count += 1
-                                    st.session_state.rag_data.append(file.name)
-                                    st.success(f"✅ 文件 {file.name} 已成功加入知识库")
-                            else:
-                                st.error(f"❌ 无法提取文件内容：{file.name}")
-                        except Exception as e:
-                            st.error(f"❌ 处理文件失败：{str(e)}")
-            
-            # 处理网址
-            if urls_input.strip():
-                process_urls(urls_input)
-
-            if success_count > 0:
-                st.success(f"✅ 共成功处理 {success_count} 个文件/网址")
-                # 强制刷新向量库实例
-                st.session_state.vector_store = None
-                # 重新加载向量库
-                get_vector_store()
+        # 提交按钮
+        if st.button("📤 提交文件和网址"):
+            if not uploaded_files and not urls_input.strip():
+                st.warning("请至少上传一个文件或输入一个网址。")
             else:
-                st.error("❌ 未能成功处理任何文件或网址")
-
-# 非 RAG 模式：单文件上传并立即处理
-else:
-    uploaded_file = st.file_uploader(
-        "上传单个文件进行分析",
-        accept_multiple_files=False,
-        type=["txt", "pdf", "docx", "doc", "jpg", "jpeg", "png", "mp3", "wav", "m4a"],
-        key="single_file_uploader"
-    )
+                success_count = 0
+                # 处理文件
+                if uploaded_files:
+                    if len(uploaded_files) > 5:
+                        st.warning("⚠️ 文件数量超过5个，建议减少文件数量以获得更好的处理效果。")
+                
+                    # 所有文件同时在进程池中提取文本，先提取完的文件先入库，
+                    # 使其余文件的提取与当前文件的编码入库重叠进行
+                    batch_start = time.perf_counter()
+                    # 内容未变化的文件直接跳过，不再提取和编码
+                    pending_files = []
+                    for file in uploaded_files:
+                        file_hash = hashlib.sha256(file.getbuffer()).hexdigest()
+                        if skip_if_indexed(file_hash, file.name):
+                            success_count += 1
+                        else:
+                            pending_files.append((file, file_hash))
+                
+                    page_cache_path = os.path.join(st.session_state.chromadb_path, "page_cache.sqlite")
+                    futures = submit_text_extraction(pending_files, page_cache_path)
+                    for future in as_completed(futures):
+                        file, file_hash = futures[future]
+                        with st.spinner(f"正在处理文件：{file.name}"):
+                            try:
+                                page_count, extract_seconds = future.result()
+                                if extract_seconds:
+                                    # 提取在工作进程中完成，耗时由工作进程测得
+                                    tracing.observe("extract", extract_seconds, file=file.name, pages=page_count)
+                                if page_count:
+                                    # 从页面缓存逐页读取并入库
+                                    pages = get_page_cache(page_cache_path).iter_pages(file_hash)
+                                    index_start = time.perf_counter()
+                                    if rag_index_document(pages, file.name, total=page_count, content_hash=file_hash):
+                                        success_count += 1
+                                        extract_note = f"提取 {extract_seconds:.1f}s" if extract_seconds else "命中页面缓存"
+                                        st.success(
+                                            f"✅ 文件 {file.name} 已成功加入知识库"
+                                            f"（{extract_note}，入库 {time.perf_counter() - index_start:.1f}s）"
+                                        )
+                                else:
+                                    st.error(f"❌ 无法提取文件内容：{file.name}")
+                            except ValueError as e:
+                                st.warning(f"⚠️ {file.name}：{str(e)}")
+                            except Exception as e:
+                                st.error(f"❌ 处理文件失败：{file.name}：{str(e)}")
+                    if futures:
+                        st.caption(f"⏱️ {len(futures)} 个文件总耗时 {time.perf_counter() - batch_start:.1f}s（提取进程数 {max(1, EXTRACT_MAX_WORKERS)}）")
+            
+                # 处理网址
+                if urls_input.strip():
+                    process_urls(urls_input)
+
+                if success_count > 0:
+                    # 新增内容已在内存向量库和增量日志中，无需重新加载
+                    st.success(f"✅ 共成功处理 {success_count} 个文件/网址")
+                else:
+                    st.error("❌ 未能成功处理任何文件或网址")
+
+    # 非 RAG 模式：单文件上传并立即处理
+    else:
+        uploaded_file = st.file_uploader(
+            "上传单个文件进行分析",
+            accept_multiple_files=False,
+            type=["txt", "pdf", "docx", "doc", "jpg", "jpeg", "png", "mp3", "wav", "m4a"],
+            key="single_file_uploader"
+        )
     
-    if uploaded_file:
-        file_type = uploaded_file.name.split('.')[-1].lower()
+        if uploaded_file:
+            file_type = uploaded_file.name.split('.')[-1].lower()
         
-        try:
-            # 1. 语音识别（GPTs）
-            if file_type in ["mp3", "wav", "m4a"]:
-                with st.spinner("🎵 正在进行语音识别..."):
-                    if "OpenAI" not in st.session_state.api_keys:
-                        st.error("请先配置 OpenAI API 密钥")
-                    else:
-                        client = OpenAI(api_key=st.session_state.api_keys["OpenAI"])
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_type}") as tmp_file:
-                            tmp_file.write(uploaded_file.getvalue())
-                            tmp_file.flush()
+            try:
+                # 1. 语音识别（GPTs）
+                if file_type in ["mp3", "wav", "m4a"]:
+                    with st.spinner("🎵 正在进行语音识别..."):
+                        if "OpenAI" not in st.session_state.api_keys:
+                            st.error("请先配置 OpenAI API 密钥")
+                        else:
+                            with import_timing.subsystem("OpenAI SDK"):
+                                from openai import OpenAI
+                            client = OpenAI(
+                                api_key=st.session_state.api_keys["OpenAI"],
+                                http_client=http_client.get_httpx_client()
+                            )
+                            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_type}") as tmp_file:
+                                tmp_file.write(uploaded_file.getvalue())
+                                tmp_file.flush()
                             
-                            with open(tmp_file.name, "rb") as audio_file:
-                                transcription = client.audio.transcriptions.create(
-                                    model="whisper-1",
-                                    file=audio_file,
-                                    language="zh"
-                                )
+                                with open(tmp_file.name, "rb") as audio_file:
+                                    transcription = client.audio.transcriptions.create(
+                                        model="whisper-1",
+                                        file=audio_file,
+                                        language="zh"
+                                    )
                         
-                        st.success("✅ 语音识别完成")
-                        with st.chat_message("assistant"):
-                            st.markdown(f"**语音识别结果：**\n\n{transcription.text}")
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": f"语音文件 {uploaded_file.name} 的识别结果：\n\n{transcription.text}",
-                            "type": "text"
-                        })
+                            st.success("✅ 语音识别完成")
+                            with st.chat_message("assistant"):
+                                st.markdown(f"**语音识别结果：**\n\n{transcription.text}")
+                            append_display_message({
+                                "role": "assistant",
+                                "content": f"语音文件 {uploaded_file.name} 的识别结果：\n\n{transcription.text}",
+                                "type": "text"
+                            })
             
-            # 2. 图片分析（moonshot-v1-8k-vision-preview）
-            elif file_type in ["jpg", "jpeg", "png"]:
-                with st.spinner("🖼️ 正在分析图片..."):
-                    if st.session_state.selected_model == "Kimi(视觉理解)":  # 只使用 Kimi 进行视觉理解
-                        if "Kimi(视觉理解)" not in st.session_state.api_keys:
-                            st.error("请先配置 Kimi(视觉理解) API 密钥")
-                        else:
-                            image_content = uploaded_file.getvalue()
-                            encoded_image = base64.b64encode(image_content).decode('utf-8')
+                # 2. 图片分析（moonshot-v1-8k-vision-preview）
+                elif file_type in ["jpg", "jpeg", "png"]:
+                    with st.spinner("🖼️ 正在分析图片..."):
+                        if st.session_state.selected_model == "Kimi(视觉理解)":  # 只使用 Kimi 进行视觉理解
+                            if "Kimi(视觉理解)" not in st.session_state.api_keys:
+                                st.error("请先配置 Kimi(视觉理解) API 密钥")
+                            else:
+                                image_content = uploaded_file.getvalue()
+                                encoded_image = base64.b64encode(image_content).decode('utf-8')
                             
-                            headers = {
-                                "Content-Type": "application/json",
-                                "Authorization": f"Bearer {st.session_state.api_keys['Kimi(视觉理解)']}"
-                            }
+                                headers = {
+                                    "Content-Type": "application/json",
+                                    "Authorization": f"Bearer {st.session_state.api_keys['Kimi(视觉理解)']}"
+                                }
                             
-                            payload = {
-                                "model": "moonshot-v1-8k-vision-preview",
-                                "messages": [
-                                    {
-                                        "role": "user",
-                                        "content": [
-                                            {
-                                                "type": "text",
-                                                "text": "请详细分析这张图片的内容，包括主要对象、场景、细节等方面。"
-                                            },
-                                            {
-                                                "type": "image_url",
-                                                "image_url": {
-                                                    "url": f"data:image/jpeg;base64,{encoded_image}"
+                                payload = {
+                                    "model": "moonshot-v1-8k-vision-preview",
+                                    "messages": [
+                                        {
+                                            "role": "user",
+                                            "content": [
+                                                {
+                                                    "type": "text",
+                                                    "text": "请详细分析这张图片的内容，包括主要对象、场景、细节等方面。"
+                                                },
+                                                {
+                                                    "type": "image_url",
+                                                    "image_url": {
+                                                        "url": f"data:image/jpeg;base64,{encoded_image}"
+                                                    }
                                                 }
-                                            }
-                                        ]
-                                    }
-                                ]
-                            }
+                                            ]
+                                        }
+                                    ]
+                                }
                             
-                            response = requests.post(
-                                "https://api.moonshot.cn/v1/chat/completions",
-                                json=payload,
-                                headers=headers
-                            )
+                                with tracing.span("llm_total", "Kimi(视觉理解)", stream=False):
+                                    response = http_client.post(
+                                        "https://api.moonshot.cn/v1/chat/completions",
+                                        json=payload,
+                                        headers=headers
+                                    )
                             
-                            if response.status_code == 200:
-                                result = response.json()["choices"][0]["message"]["content"]
-                                st.success("✅ 图片分析完成")
-                                with st.chat_message("assistant"):
-                                    st.markdown(f"**图片分析结果：**\n\n{result}")
-                                st.session_state.messages.append({
-                                    "role": "assistant",
-                                    "content": f"图片 {uploaded_file.name} 的分析结果：\n\n{result}",
-                                    "type": "text"
-                                })
-                            else:
-                                st.error(f"❌ 图片分析失败：{response.text}")
+                                if response.status_code == 200:
+                                    result = response.json()["choices"][0]["message"]["content"]
+                                    st.success("✅ 图片分析完成")
+                                    with st.chat_message("assistant"):
+                                        st.markdown(f"**图片分析结果：**\n\n{result}")
+                                    append_display_message({
+                                        "role": "assistant",
+                                        "content": f"图片 {uploaded_file.name} 的分析结果：\n\n{result}",
+                                        "type": "text"
+                                    })
+                                else:
+                                    st.error(f"❌ 图片分析失败：{response.text}")
             
-            # 3. 文档总结
-            elif file_type in ["txt", "pdf", "docx", "doc"]:
-                with st.spinner("📄 正在总结文档..."):
-                    content = extract_text_from_file(uploaded_file)
-                    if content:
-                        summary_prompt = f"""请对以下文本进行专业的总结分析：
+                # 3. 文档总结
+                elif file_type in ["txt", "pdf", "docx", "doc"]:
+                    with st.spinner("📄 正在总结文档..."):
+                        content = extract_text_from_file(uploaded_file)
+                        if content:
+                            summary_prompt = f"""请对以下文本进行专业的总结分析：
 
 文本内容：
 {content}
@@ -1845,102 +4594,211 @@ else:
 
 请用清晰、专业的语言组织回答。"""
 
-                        summary = call_model_api(summary_prompt, st.session_state.selected_model)
-                        if summary:
-                            st.success("✅ 文档总结完成")
-                            with st.chat_message("assistant"):
-                                st.markdown(f"**文档总结结果：**\n\n{summary}")
-                            st.session_state.messages.append({
-                                "role": "assistant",
-                                "content": f"文档 {uploaded_file.name} 的总结：\n\n{summary}",
-                                "type": "text"
-                            })
+                            summary = call_model_api(summary_prompt, st.session_state.selected_model)
+                            if summary:
+                                st.success("✅ 文档总结完成")
+                                with st.chat_message("assistant"):
+                                    st.markdown(f"**文档总结结果：**\n\n{summary}")
+                                append_display_message({
+                                    "role": "assistant",
+                                    "content": f"文档 {uploaded_file.name} 的总结：\n\n{summary}",
+                                    "type": "text"
+                                })
             
-            else:
-                st.warning(f"⚠️ 不支持的文件类型：{file_type}")
+                else:
+                    st.warning(f"⚠️ 不支持的文件类型：{file_type}")
         
-        except Exception as e:
-            st.error(f"❌ 处理文件失败：{str(e)}")
-            import traceback
-            st.error(f"详细错误：{traceback.format_exc()}")
+            except Exception as e:
+                st.error(f"❌ 处理文件失败：{str(e)}")
+                import traceback
+                st.error(f"详细错误：{traceback.format_exc()}")
+    record_run_time("上传面板", run_start)
+
+render_upload_panel()
 
 # ====================
 # 用户问题输入区域
-with st.container():
-    # 初始提示（仅在对话记录为空时显示）
-    if not st.session_state.messages:
-        with st.chat_message("assistant"):
-            st.write("您好！我是多模型智能助手，请选择模型和功能开始交互。")
-            
-    # 在主界面聊天部分，修改用户输入区域的代码
-    # 在用户输入前添加当前助手提示
-    if st.session_state.selected_assistant:
-        st.markdown(
-            f"<p style='color: #666666; font-size: 0.8em; margin-bottom: 5px;'> 👨 当前助手：{st.session_state.selected_assistant}</p>", 
-            unsafe_allow_html=True
-        )
+@st.fragment
+def render_chat_panel():
+    """对话面板（独立片段：发送消息只重新运行本面板，不重绘侧边栏和上传面板）"""
+    run_start = time.perf_counter()
+    with st.container():
+        # 初始提示（仅在对话记录为空时显示）
+        if not st.session_state.messages:
+            with st.chat_message("assistant"):
+                st.write("您好！我是多模型智能助手，请选择模型和功能开始交互。")
+            
+        # 在主界面聊天部分，修改用户输入区域的代码
+        # 在用户输入前添加当前助手提示
+        if st.session_state.selected_assistant:
+            st.markdown(
+                f"<p style='color: #666666; font-size: 0.8em; margin-bottom: 5px;'> 👨 当前助手：{st.session_state.selected_assistant}</p>", 
+                unsafe_allow_html=True
+            )
 
-    # 用户输入
-    user_input = st.chat_input(
-        "请输入您的问题",
-        key="user_input"
-    )
+        # 用户输入
+        user_input = st.chat_input(
+            "请输入您的问题",
+            key="user_input"
+        )
     
-    if user_input:
-        # 记录用户输入到历史记录
-        manage_chat_history(st.session_state.selected_model, "user", user_input)
+        if user_input:
+            st.session_state.turn_prompt_tokens = []
+            # 本轮各阶段（搜索、检索、模型调用等）的耗时 span 计入同一个追踪
+            turn_trace = tracing.start_trace(st.session_state.selected_model)
+            # 记录用户输入到历史记录
+            manage_chat_history(st.session_state.selected_model, "user", user_input)
         
-        with st.chat_message("user"):
-            st.write(user_input)
+            with st.chat_message("user"):
+                st.write(user_input)
         
-        st.session_state.messages.append({"role": "user", "content": user_input, "type": "text"})
+            append_display_message({"role": "user", "content": user_input, "type": "text"})
         
-        with st.spinner("🧠 正在思考..."):
-            combined_response = ""
+            # 对比模式：同一问题并发发送给多个模型
+            if st.session_state.compare_enabled and st.session_state.compare_models:
+                with st.chat_message("assistant"):
+                    compare_results = run_model_comparison(user_input, st.session_state.compare_models)
+                answered = [result for result in compare_results if result.get("text")]
+                if answered:
+                    append_display_message({
+                        "role": "assistant",
+                        "content": "⚖️ **模型对比结果**\n\n" + "\n\n".join(
+                            f"### {result['model']}\n\n{result['text']}" for result in answered
+                        ),
+                        "type": "text"
+                    })
+                else:
+                    st.error("未能获取到任何结果，请重试。")
+            else:
+                with st.spinner("🧠 正在思考..."):
+                    combined_response = ""
             
-            # 联网搜索部分
-            if st.session_state.search_enabled:
-                try:
-                    search_response = get_search_response(user_input)
-                    if search_response:
-                        combined_response += search_response + "\n\n"
-                except Exception as e:
-                    st.error(f"搜索过程出错：{str(e)}")
+                    # 联网搜索与 RAG 检索并发执行，本轮耗时取决于最慢的分支
+                    branches = []
+                    if st.session_state.search_enabled:
+                        branches.append(("search", get_search_response, (user_input,), SEARCH_BRANCH_TIMEOUT))
+                    if st.session_state.rag_enabled:
+                        branches.append(("rag", rag_generate_response, (user_input,), RAG_BRANCH_TIMEOUT))
+                    branch_results = run_turn_branches(branches) if branches else {}
             
-            # RAG 检索部分
-            if st.session_state.rag_enabled:
-                try:
-                    rag_response = rag_generate_response(user_input)
-                    if rag_response:
-                        combined_response += "📚 **知识库检索结果：**\n\n" + rag_response + "\n\n"
-                except Exception as e:
-                    st.error(f"RAG 检索出错：{str(e)}")
+                    # 按固定顺序组装回答：先联网搜索，后知识库检索
+                    if "search" in branch_results:
+                        search_response, error = branch_results["search"]
+                        if error:
+                            st.error(f"搜索过程出错：{str(error)}")
+                        elif search_response:
+                            combined_response += search_response + "\n\n"
             
-            # 如果两个功能都未开启，使用普通对话模式
-            if not (st.session_state.search_enabled or st.session_state.rag_enabled):
-                response = call_model_api(user_input, st.session_state.selected_model)
-                if response:
-                    combined_response = response
+                    if "rag" in branch_results:
+                        rag_response, error = branch_results["rag"]
+                        if error:
+                            st.error(f"RAG 检索出错：{str(error)}")
+                        elif rag_response:
+                            combined_response += "📚 **知识库检索结果：**\n\n" + rag_response + "\n\n"
             
-            # 显示组合后的回答
-            if combined_response:
-                with st.chat_message("assistant"):
-                    st.markdown(combined_response)
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": combined_response,
-                    "type": "text"
-                })
-                # 记录助手回答到历史记录
-                manage_chat_history(st.session_state.selected_model, "assistant", combined_response)
-            else:
-                st.error("未能获取到任何结果，请重试。")
+                    # 如果两个功能都未开启，使用普通对话模式
+                    semantic_hit, semantic_vector = None, None
+                    if not (st.session_state.search_enabled or st.session_state.rag_enabled):
+                        if st.session_state.semantic_cache_enabled:
+                            semantic_hit, semantic_vector = get_semantic_cache().lookup(
+                                semantic_cache_scope(st.session_state.selected_model),
+                                user_input,
+                                st.session_state.semantic_cache_threshold
+                            )
+                        if semantic_hit:
+                            combined_response = semantic_hit["response"]
+                        else:
+                            response = call_model_api(
+                                user_input,
+                                st.session_state.selected_model,
+                                stream=st.session_state.stream_enabled
+                            )
+                            if response:
+                                combined_response = response
+        
+                # 流式回答：边生成边渲染，流结束后才写入对话历史
+                if isinstance(combined_response, ChatStream):
+                    chat_stream = combined_response
+                    with st.chat_message("assistant"):
+                        combined_response = st.write_stream(chat_stream)
+                        if chat_stream.cache_hit:
+                            st.caption("💾 命中响应缓存")
+                        elif chat_stream.completed:
+                            metrics = record_turn_metrics(st.session_state.selected_model, chat_stream)
+                            if metrics["ttft"] is not None:
+                                st.caption(f"⏱️ 首字延迟 {metrics['ttft']:.2f}s · 总耗时 {metrics['total_time']:.2f}s")
+                            if describe_prompt_tokens():
+                                st.caption(describe_prompt_tokens())
+                    if chat_stream.completed and chat_stream.text:
+                        append_display_message({
+                            "role": "assistant",
+                            "content": combined_response,
+                            "type": "text"
+                        })
+                        if semantic_vector is not None:
+                            get_semantic_cache().add(
+                                semantic_cache_scope(st.session_state.selected_model),
+                                user_input, chat_stream.text, vector=semantic_vector
+                            )
+                    else:
+                        st.error("未能获取到任何结果，请重试。")
+                # 显示组合后的回答
+                elif combined_response:
+                    with st.chat_message("assistant"):
+                        st.markdown(combined_response)
+                        if semantic_hit:
+                            st.caption(
+                                f"🧠 语义缓存命中（相似度 {semantic_hit['similarity']:.2f}，"
+                                f"相似问题：{semantic_hit['prompt'][:50]}）"
+                            )
+                        elif describe_prompt_tokens():
+                            st.caption(describe_prompt_tokens())
+                    if semantic_vector is not None and not semantic_hit:
+                        get_semantic_cache().add(
+                            semantic_cache_scope(st.session_state.selected_model),
+                            user_input, combined_response, vector=semantic_vector
+                        )
+                    append_display_message({
+                        "role": "assistant",
+                        "content": combined_response,
+                        "type": "text"
+                    })
+                    # 记录助手回答到历史记录
+                    manage_chat_history(st.session_state.selected_model, "assistant", combined_response)
+                else:
+                    st.error("未能获取到任何结果，请重试。")
+        
+            # 结束本轮追踪后再调度后台摘要，摘要请求不计入本轮耗时分解
+            turn_breakdown = describe_turn_trace(finish_turn_trace(turn_trace))
+            if turn_breakdown:
+                st.caption(turn_breakdown)
+        
+            # 本轮结束后在后台更新滚动摘要，不阻塞本轮回答
+            summary_models = st.session_state.compare_models if st.session_state.compare_enabled else []
+            for model_type in dict.fromkeys([st.session_state.selected_model, *summary_models]):
+                schedule_history_summary(model_type)
 
-# ====================
-# 显示历史对话记录
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        if msg.get("type") == "image":
-            st.image(msg["content"])
-        else:
-            st.write(msg["content"])
\ No newline at end of file
+    # ====================
+    # 显示历史对话记录：只渲染最近的消息，更早的消息按需分页从对话存储读取
+    if st.session_state.messages:
+        older_messages = []
+        get_conversation_store()._flush_for_read()  # 提交后才分配序号，作为分页游标
+        # 尚未提交成功的消息没有序号，以最早的已提交消息为游标
+        first_seq = next((msg["seq"] for msg in st.session_state.messages if msg["seq"] is not None), None)
+        if first_seq is not None and st.session_state.history_pages:
+            older_messages = get_conversation_store().page(
+                st.session_state.conversation_id, "", before_seq=first_seq,
+                limit=st.session_state.history_pages * CHAT_PAGE_SIZE
+            )
+            if older_messages:
+                first_seq = older_messages[0]["seq"]
+        if first_seq is not None and get_conversation_store().has_before(st.session_state.conversation_id, "", first_seq):
+            if st.button("⬆️ 加载更早的消息", key="load_older_messages"):
+                st.session_state.history_pages += 1
+                st.rerun(scope="fragment")
+        for msg in older_messages + st.session_state.messages:
+            render_message(msg)
+    record_run_time("对话面板", run_start)
+
+render_chat_panel()
+record_run_time("完整运行", script_run_start)
@@ -0,0 +1,148 @@
+"""
+call_model_api 离线压测
+
+以 Streamlit 裸模式加载 ChatBot.py（不启动页面），把各服务商请求通过 http_client 的重定向改发到
+模拟服务（默认在本进程内启动 mock_provider，也可用 --base-url 指向已运行的服务），
+按给定并发对每个服务商路径（模型 × 流式/非流式）发送独立请求（不读写对话历史、跳过响应缓存），
+报告吞吐、延迟分位数和首字延迟。非流式请求的首字延迟即完整回答的延迟。
+
+    python benchmark.py --requests 100 --concurrency 8
+    python benchmark.py --models 豆包 MiniMax 文心一言 --mode stream --token-rate 100 --error-rate 0.05
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import runpy
+import sys
+import tempfile
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+import mock_provider
+import token_budget
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ChatBot.py")
+# 压测时为每个服务商填入的占位密钥（键名与侧边栏的 API 密钥配置一致）
+API_KEY_NAMES = ["豆包", "DeepSeek", "通义千问", "文心一言", "智谱清言", "MiniMax", "OpenAI",
+                 "Kimi(视觉理解)", "xAI", "混元生文"]
+DEFAULT_MODELS = list(token_budget.MODEL_CONTEXT_WINDOWS) + ["DALL-E(文生图)"]
+
+
+def load_app(path=APP_PATH):
+    """以裸模式执行 ChatBot.py 并返回其全局命名空间（关闭指标端点、追踪日志和模型预热）"""
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("TRACE_LOG_PATH", "")
+    os.environ.setdefault("EMBEDDING_WARMUP", "0")
+    os.environ.setdefault("CHAT_STORE_PATH", os.path.join(tempfile.mkdtemp(prefix="llm-bench-"), "chat.sqlite"))
+    logging.getLogger("streamlit").setLevel(logging.ERROR)  # 裸模式下每次调用都会警告缺少运行上下文
+    app = runpy.run_path(path, run_name="chatbot_benchmark")
+    import streamlit as st
+    st.session_state.api_keys = {name: "mock-key" for name in API_KEY_NAMES}
+    st.session_state.response_cache_enabled = False
+    return app
+
+
+def percentile(values, q):
+    """最近秩法分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(math.ceil(q / 100 * len(ordered)) - 1, 0))]
+
+
+def run_once(app, model_type, prompt, stream):
+    """发送一次请求，返回 (是否成功, 延迟秒数, 首字延迟秒数)"""
+    start = time.perf_counter()
+    try:
+        result = app["call_model_api"](prompt, model_type, stream=stream, use_cache=False, standalone=True)
+        if isinstance(result, app["ChatStream"]):
+            for _ in result:
+                pass
+            return bool(result.text), result.total_time, result.ttft
+    except Exception:
+        return False, time.perf_counter() - start, None
+    elapsed = time.perf_counter() - start
+    return bool(result), elapsed, elapsed
+
+
+def benchmark_path(app, model_type, stream, requests, concurrency, prompt):
+    """以给定并发压测一个服务商路径，返回统计结果"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_once(app, model_type, prompt, stream), range(requests)))
+    wall = time.perf_counter() - start
+    latencies = [latency for ok, latency, _ in results if ok]
+    ttfts = [ttft for ok, _, ttft in results if ok and ttft is not None]
+    return {
+        "model": model_type,
+        "mode": "stream" if stream else "non-stream",
+        "requests": requests,
+        "ok": len(latencies),
+        "errors": requests - len(latencies),
+        "rps": len(latencies) / wall if wall else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+    }
+
+
+def pad(text, width):
+    """按显示宽度左对齐（中文字符占两列）"""
+    display_width = sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+    return text + " " * max(width - display_width, 0)
+
+
+def format_row(row):
+    def ms(value):
+        return f"{value * 1000:8.0f}" if value is not None else f"{'-':>8}"
+    return (f"{pad(row['model'], 24)}{pad(row['mode'], 12)}{row['ok']:>5}/{row['requests']:<5}{row['errors']:>6}"
+            f"{row['rps']:>9.1f}{ms(row['p50'])}{ms(row['p95'])}{ms(row['p99'])}{ms(row['ttft_p50'])}{ms(row['ttft_p95'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="call_model_api 离线压测（模拟服务商）")
+    parser.add_argument("--models", nargs="*", default=DEFAULT_MODELS, help="要压测的模型（默认全部）")
+    parser.add_argument("--mode", choices=["stream", "non-stream", "both"], default="both",
+                        help="流式/非流式（不支持流式的模型只测非流式）")
+    parser.add_argument("--requests", type=int, default=50, help="每个服务商路径的请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    parser.add_argument("--prompt", default="请简要介绍一下量化投资。")
+    parser.add_argument("--base-url", default="", help="已运行的模拟服务地址，为空时在本进程内启动")
+    parser.add_argument("--json", dest="json_path", default="", help="把结果另存为 JSON 文件")
+    mock_provider.add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    base_url = args.base_url
+    if not base_url:
+        server = mock_provider.start_server(mock_provider.config_from_args(args))
+        base_url = f"http://127.0.0.1:{server.server_port}"
+    http_client.set_base_url_override(base_url)
+    app = load_app()
+
+    header = (f"{pad('模型', 24)}{pad('模式', 12)}{pad('成功/请求', 11)}{pad('失败', 6)}{'req/s':>9}"
+              f"{'p50ms':>8}{'p95ms':>8}{'p99ms':>8}{'TTFT50':>8}{'TTFT95':>8}")
+    print(f"模拟服务：{base_url}，并发 {args.concurrency}，每路径 {args.requests} 次请求")
+    print(header)
+    rows = []
+    for model_type in args.models:
+        modes = {"stream": [True], "non-stream": [False], "both": [False, True]}[args.mode]
+        for stream in modes:
+            if stream and model_type not in app["STREAMING_MODELS"]:
+                continue
+            row = benchmark_path(app, model_type, stream, args.requests, args.concurrency, args.prompt)
+            rows.append(row)
+            print(format_row(row))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    return 0 if all(row["ok"] for row in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
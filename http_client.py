@@ -0,0 +1,274 @@
+"""
+进程级 HTTP 客户端层
+
+按服务商主机（scheme://host:port）维护一个带连接池的 requests.Session，
+由所有 Streamlit 会话共享。连续的对话轮次会复用已建立的 TCP+TLS 连接，
+避免每次请求都重新握手。同时统计每个主机的请求数、新建连接数和复用次数。
+"""
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# 连接池配置（可通过环境变量覆盖）
+POOL_CONNECTIONS = int(os.environ.get("LLM_HTTP_POOL_CONNECTIONS", "4"))  # 每个 Session 缓存的连接池数量
+POOL_MAXSIZE = int(os.environ.get("LLM_HTTP_POOL_MAXSIZE", "32"))  # 每个主机保留的最大连接数
+POOL_BLOCK = os.environ.get("LLM_HTTP_POOL_BLOCK", "0") == "1"  # 连接耗尽时是否阻塞等待
+KEEPALIVE_IDLE = int(os.environ.get("LLM_HTTP_KEEPALIVE_IDLE", "60"))  # TCP keep-alive 空闲探测间隔（秒）
+KEEPALIVE_INTERVAL = int(os.environ.get("LLM_HTTP_KEEPALIVE_INTERVAL", "15"))
+KEEPALIVE_COUNT = int(os.environ.get("LLM_HTTP_KEEPALIVE_COUNT", "4"))
+MAX_HOSTS = int(os.environ.get("LLM_HTTP_MAX_HOSTS", "64"))  # 最多同时保留的主机 Session 数（网页抓取会访问任意主机）
+# 服务商请求重定向（离线压测用）：设置为 scheme://host:port 后，post 请求和 OpenAI SDK 请求改发到该地址，路径不变；
+# get 请求（网页抓取）不受影响
+BASE_URL_OVERRIDE = os.environ.get("LLM_HTTP_BASE_URL_OVERRIDE", "")
+
+
+def _keepalive_socket_options():
+    """构建开启 TCP keep-alive 的 socket 选项（按平台支持情况添加）"""
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE))
+    elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, KEEPALIVE_IDLE))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT))
+    return options
+
+
+class HostStats:
+    """单个主机的连接统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def record_request(self, elapsed, failed=False):
+        with self._lock:
+            self.requests += 1
+            self.total_seconds += elapsed
+            if failed:
+                self.errors += 1
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+                "errors": self.errors,
+                "avg_seconds": self.total_seconds / self.requests if self.requests else 0.0,
+            }
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """在 urllib3 新建连接时计数的 HTTPAdapter，用于统计连接复用情况"""
+
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options", _keepalive_socket_options())
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        stats = self._stats
+
+        class _CountingHTTPPool(HTTPConnectionPool):
+            def _new_conn(self):
+                stats.record_new_connection()
+                return super()._new_conn()
+
+        class _CountingHTTPSPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                stats.record_new_connection()
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPPool,
+            "https": _CountingHTTPSPool,
+        }
+
+
+class PooledHTTPClient:
+    """按主机维护共享 Session 的 HTTP 客户端（线程安全）"""
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 pool_block=POOL_BLOCK, max_hosts=MAX_HOSTS):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_hosts = max_hosts
+        self._sessions = OrderedDict()  # host_key -> (session, stats)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host_key(url):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _create_session(self, stats):
+        session = requests.Session()
+        adapter = CountingHTTPAdapter(
+            stats,
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def _entry(self, url):
+        key = self._host_key(url)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                stats = HostStats()
+                entry = (self._create_session(stats), stats)
+                self._sessions[key] = entry
+                # 超出主机上限时关闭最久未使用的 Session
+                while len(self._sessions) > self.max_hosts:
+                    _, (old_session, _) = self._sessions.popitem(last=False)
+                    old_session.close()
+            else:
+                self._sessions.move_to_end(key)
+            return entry
+
+    def get_session(self, url):
+        """获取 url 所属主机的共享 Session"""
+        return self._entry(url)[0]
+
+    def request(self, method, url, **kwargs):
+        session, stats = self._entry(url)
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            stats.record_request(time.perf_counter() - start, failed=True)
+            raise
+        stats.record_request(time.perf_counter() - start, failed=response.status_code >= 500)
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def stats(self):
+        """返回每个主机的连接统计 {host: {...}}"""
+        with self._lock:
+            entries = list(self._sessions.items())
+        return {key: stats.snapshot() for key, (_, stats) in entries}
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# 进程级单例：模块只会被导入一次，所有会话共享同一组连接池
+_client = PooledHTTPClient()
+_httpx_client = None
+_httpx_lock = threading.Lock()
+
+
+def get_client():
+    """获取进程级共享的 HTTP 客户端"""
+    return _client
+
+
+def set_base_url_override(base_url):
+    """设置（空值则取消）服务商请求重定向地址"""
+    global BASE_URL_OVERRIDE
+    BASE_URL_OVERRIDE = base_url.rstrip("/") if base_url else ""
+
+
+def apply_base_url_override(url):
+    """按重定向设置替换 url 的 scheme://host:port"""
+    if not BASE_URL_OVERRIDE:
+        return url
+    parsed = urlparse(url)
+    return BASE_URL_OVERRIDE + url[len(f"{parsed.scheme}://{parsed.netloc}"):]
+
+
+def post(url, **kwargs):
+    return _client.post(apply_base_url_override(url), **kwargs)
+
+
+def get(url, **kwargs):
+    return _client.get(url, **kwargs)
+
+
+def get_stats():
+    return _client.stats()
+
+
+def iter_sse_data(response):
+    """逐条解析 Server-Sent Events 流中的 data 字段，遇到 [DONE] 时结束
+
+    使用 chunk_size=None 按服务端分块读取，避免 urllib3 攒满固定字节数才返回。
+    """
+    data_lines = []
+    for raw_line in response.iter_lines(chunk_size=None):
+        line = raw_line.decode("utf-8", errors="replace") if isinstance(raw_line, bytes) else raw_line
+        if not line:
+            # 空行表示一个事件结束
+            if data_lines:
+                data = "\n".join(data_lines)
+                data_lines = []
+                if data.strip() == "[DONE]":
+                    return
+                yield data
+            continue
+        if line.startswith(":"):
+            continue  # 注释/心跳
+        if line.startswith("data:"):
+            value = line[5:]
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+    if data_lines:
+        data = "\n".join(data_lines)
+        if data.strip() != "[DONE]":
+            yield data
+
+
+def get_httpx_client():
+    """获取供 OpenAI SDK（混元、Whisper）复用的共享 httpx 连接池"""
+    global _httpx_client
+    with _httpx_lock:
+        if _httpx_client is None:
+            import httpx
+            def redirect(request):
+                if BASE_URL_OVERRIDE:
+                    request.url = httpx.URL(apply_base_url_override(str(request.url)))
+                    request.headers["Host"] = request.url.netloc.decode("ascii")
+
+            _httpx_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=POOL_MAXSIZE,
+                    max_keepalive_connections=POOL_MAXSIZE,
+                    keepalive_expiry=KEEPALIVE_IDLE,
+                ),
+                event_hooks={"request": [redirect]}
+            )
+        return _httpx_client
@@ -0,0 +1,121 @@
+"""
+启动与按需导入耗时统计
+
+较重的子系统（向量库/embedding、文本切分、联网搜索、网页解析、OpenAI SDK）在首次使用时才导入，
+导入处用 subsystem() 包裹，记录首次导入的耗时和新加载的模块数，供侧边栏展示。
+
+作为脚本运行时检查冷启动导入耗时：在新的解释器中依次执行目标脚本顶层的 import 语句，
+逐条报告耗时，总耗时超过预算时以非零状态退出，可放在 CI 或发布前检查中：
+
+    python import_timing.py                    # 检查 ChatBot.py，预算取 STARTUP_IMPORT_BUDGET（默认 0.5 秒）
+    python import_timing.py --budget 0.8 --baseline streamlit ChatBot.py
+
+--baseline 中的模块先行导入且不计入预算（服务进程在运行脚本前已经加载了 streamlit）。
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUDGET_SECONDS = float(os.environ.get("STARTUP_IMPORT_BUDGET", "0.5"))
+DEFAULT_BASELINE = ("streamlit",)
+
+_lock = threading.Lock()
+_records = {}  # 子系统 -> {"seconds": 首次导入耗时, "modules": 新加载模块数, "loaded_at": 时间戳}
+
+
+def record(name, seconds, modules):
+    """累加一个子系统的导入耗时（同一子系统可能在多处分别导入不同模块）"""
+    with _lock:
+        entry = _records.setdefault(name, {"seconds": 0.0, "modules": 0, "loaded_at": time.time()})
+        entry["seconds"] += seconds
+        entry["modules"] += modules
+
+
+@contextmanager
+def subsystem(name):
+    """包裹子系统的局部导入；只有实际加载了新模块时才记录（已导入时开销可忽略）
+
+    多个线程同时导入时模块数按全局增量统计，只是近似值。
+    """
+    before = len(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        added = len(sys.modules) - before
+        if added > 0:
+            record(name, time.perf_counter() - start, added)
+
+
+def report():
+    """按耗时从高到低返回 [(子系统, 记录)]"""
+    with _lock:
+        return sorted(((name, dict(entry)) for name, entry in _records.items()),
+                      key=lambda item: item[1]["seconds"], reverse=True)
+
+
+def top_level_imports(path):
+    """目标脚本模块顶层的 import 语句源码（不含函数内的局部导入）"""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return [ast.get_source_segment(source, node) for node in tree.body
+            if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+_PROBE = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+for module in json.loads(sys.argv[2]):
+    __import__(module)
+timings = []
+for statement in json.loads(sys.argv[3]):
+    start = time.perf_counter()
+    exec(statement, {})
+    timings.append((statement, time.perf_counter() - start))
+print(json.dumps(timings))
+"""
+
+
+def measure_cold_imports(path, baseline=DEFAULT_BASELINE):
+    """在新的解释器中测量目标脚本顶层导入的耗时，返回 [(import 语句, 秒)]"""
+    statements = top_level_imports(path)
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE, os.path.dirname(os.path.abspath(path)),
+         json.dumps(list(baseline)), json.dumps(statements)],
+        capture_output=True, text=True, check=True
+    )
+    return [tuple(item) for item in json.loads(result.stdout)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查脚本顶层导入的冷启动耗时")
+    parser.add_argument("script", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ChatBot.py"))
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_SECONDS, help="总耗时预算（秒）")
+    parser.add_argument("--baseline", nargs="*", default=list(DEFAULT_BASELINE), help="先行导入且不计入预算的模块")
+    parser.add_argument("--top", type=int, default=10, help="列出耗时最高的前几条 import")
+    args = parser.parse_args(argv)
+
+    try:
+        timings = measure_cold_imports(args.script, args.baseline)
+    except subprocess.CalledProcessError as e:
+        print(f"导入失败：\n{e.stderr}", file=sys.stderr)
+        return 2
+    total = sum(seconds for _, seconds in timings)
+    for statement, seconds in sorted(timings, key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{seconds * 1000:8.1f} ms  {statement}")
+    print(f"顶层导入共 {len(timings)} 条，总耗时 {total:.3f}s（预算 {args.budget:.3f}s）")
+    if total > args.budget:
+        print("超出冷启动导入预算，请把新增的重量级依赖改为在使用处导入", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+按需加载的向量库存储
+
+快照不再使用 pickle：Flat 索引的向量以 float32 矩阵写入 vectors.f32 并以内存映射方式检索；
+HNSW/IVF 索引写入 index.faiss 并整体读入（图结构和倒排表需要常驻内存）。
+文本块内容、元数据和位置映射存放在 docstore.sqlite 中，只在命中 top-k 时按 id 读取。
+Flat 索引打开快照只需映射文件和连接数据库，冷启动耗时和常驻内存不随知识库规模增长。
+快照之后新增的文本块保存在内存覆盖层中，直到下一次压缩写入新快照并重新打开。
+"""
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.sqlite"
+WRITE_BATCH_ROWS = 10000  # 写快照时每批处理的文本块数
+
+
+class MemmapFlatIndex:
+    """内存映射的精确 L2 索引，接口与 faiss 索引的常用部分一致
+
+    快照中的向量通过 np.memmap 读取（由操作系统页缓存按需加载、多进程共享），
+    新增向量保存在按倍数扩容的内存缓冲区中；检索时两部分分别计算 top-k 后合并。
+    """
+
+    def __init__(self, path, dimension, rows):
+        self.d = dimension
+        self._base = np.memmap(path, dtype="float32", mode="r", shape=(rows, dimension)) if rows else None
+        self._base_rows = rows
+        self._buffer = np.zeros((0, dimension), dtype="float32")
+        self._extra_rows = 0
+
+    @property
+    def _extra(self):
+        return self._buffer[:self._extra_rows]
+
+    @property
+    def ntotal(self):
+        return self._base_rows + self._extra_rows
+
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype="float32").reshape(-1, self.d)
+        end = self._extra_rows + len(vectors)
+        if end > len(self._buffer):
+            # 容量翻倍，逐批追加的总复制量与新增行数成线性
+            buffer = np.zeros((max(end, 2 * len(self._buffer), 1024), self.d), dtype="float32")
+            buffer[:self._extra_rows] = self._extra
+            self._buffer = buffer
+        self._buffer[self._extra_rows:end] = vectors
+        self._extra_rows = end
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype="float32")
+        parts = []
+        if self._base_rows:
+            parts.append(faiss.knn(queries, self._base, min(k, self._base_rows)))
+        if len(self._extra):
+            distances, labels = faiss.knn(queries, self._extra, min(k, len(self._extra)))
+            parts.append((distances, labels + self._base_rows))
+        if not parts:
+            return (np.full((len(queries), k), np.inf, dtype="float32"),
+                    np.full((len(queries), k), -1, dtype="int64"))
+        distances = np.hstack([part[0] for part in parts])
+        labels = np.hstack([part[1] for part in parts])
+        order = np.argsort(distances, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+        if labels.shape[1] < k:
+            pad = k - labels.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            labels = np.pad(labels, ((0, 0), (0, pad)), constant_values=-1)
+        return distances, labels
+
+    def reconstruct(self, position):
+        if position < self._base_rows:
+            return np.array(self._base[position])
+        return self._extra[position - self._base_rows].copy()
+
+    def reconstruct_n(self, start, count):
+        rows = [self._base[start:min(start + count, self._base_rows)]] if start < self._base_rows else []
+        extra_start = max(start - self._base_rows, 0)
+        extra_end = max(start + count - self._base_rows, 0)
+        if extra_end > extra_start:
+            rows.append(self._extra[extra_start:extra_end])
+        return np.vstack(rows) if rows else np.zeros((0, self.d), dtype="float32")
+
+
+class ChunkStore:
+    """快照中的文本块表：position（索引位置）、chunk_id、文本和元数据"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self.meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.count = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get(self, chunk_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT text, metadata FROM chunks WHERE chunk_id = ?", (chunk_id,)
+            ).fetchone()
+
+    def id_at(self, position):
+        with self._lock:
+            row = self._conn.execute("SELECT chunk_id FROM chunks WHERE position = ?", (position,)).fetchone()
+        return row[0] if row else None
+
+    def positions_of(self, chunk_ids):
+        result = {}
+        chunk_ids = list(chunk_ids)
+        with self._lock:
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i:i + 500]
+                result.update(self._conn.execute(
+                    f"SELECT chunk_id, position FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall())
+        return result
+
+    def iter_ids(self):
+        """按位置顺序分批产出 (position, chunk_id)"""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT position, chunk_id FROM chunks WHERE position > ? ORDER BY position LIMIT ?",
+                    (last, WRITE_BATCH_ROWS)
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    @staticmethod
+    def write(path, rows, meta):
+        """写入新的文本块表，rows 为 (position, chunk_id, text, metadata) 迭代器"""
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE chunks (position INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE, text TEXT, metadata TEXT)")
+        conn.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+        batch = []
+        for position, chunk_id, text, metadata in rows:
+            batch.append((position, chunk_id, text, json.dumps(metadata, ensure_ascii=False)))
+            if len(batch) >= WRITE_BATCH_ROWS:
+                conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", batch)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [(k, str(v)) for k, v in meta.items()])
+        conn.commit()
+        conn.close()
+
+
+class LazyDocstore(Docstore, AddableMixin):
+    """按 id 从快照读取文档的 docstore，快照之后新增的文档保存在内存覆盖层"""
+
+    def __init__(self, store):
+        self.store = store
+        self._overlay = {}
+        self._deleted = set()
+
+    def search(self, search):
+        if search in self._deleted:
+            return f"ID {search} not found."
+        if search in self._overlay:
+            return self._overlay[search]
+        row = self.store.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def add(self, texts):
+        overlapping = set(texts) & set(self._overlay)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._overlay.update(texts)
+        self._deleted.difference_update(texts)
+
+    def delete(self, ids):
+        for chunk_id in ids:
+            self._overlay.pop(chunk_id, None)
+            self._deleted.add(chunk_id)
+
+
+class LazyIdMap(MutableMapping):
+    """索引位置 → chunk_id 的映射：快照部分查询 SQLite，新增部分保存在内存"""
+
+    def __init__(self, store):
+        self.store = store
+        self._overlay = {}
+
+    def __getitem__(self, position):
+        position = int(position)  # faiss 返回的是 numpy 整数，SQLite 不能直接绑定
+        if position in self._overlay:
+            return self._overlay[position]
+        if 0 <= position < self.store.count:
+            chunk_id = self.store.id_at(position)
+            if chunk_id is not None:
+                return chunk_id
+        raise KeyError(position)
+
+    def __setitem__(self, position, chunk_id):
+        self._overlay[position] = chunk_id
+
+    def __delitem__(self, position):
+        raise TypeError("快照中的位置映射不可删除，请通过压缩重建")
+
+    def __len__(self):
+        return self.store.count + len(self._overlay)
+
+    def __iter__(self):
+        for position, _ in self.items():
+            yield position
+
+    def items(self):
+        yield from self.store.iter_ids()
+        yield from sorted(self._overlay.items())
+
+    def values(self):
+        for _, chunk_id in self.items():
+            yield chunk_id
+
+    def positions_of(self, chunk_ids):
+        chunk_ids = set(chunk_ids)
+        result = self.store.positions_of(chunk_ids)
+        result.update({chunk_id: pos for pos, chunk_id in self._overlay.items() if chunk_id in chunk_ids})
+        return result
+
+
+class LazyFAISS(FAISS):
+    """以按需加载格式读写快照的 FAISS 向量库"""
+
+    @classmethod
+    def load_lazy(cls, folder, embeddings):
+        store = ChunkStore(os.path.join(folder, DOCSTORE_FILE))
+        dimension = int(store.meta["dimension"])
+        if store.meta.get("index_file") == VECTORS_FILE:
+            index = MemmapFlatIndex(os.path.join(folder, VECTORS_FILE), dimension, store.count)
+        else:
+            index = faiss.read_index(os.path.join(folder, INDEX_FILE))
+        return cls(embeddings, index, LazyDocstore(store), LazyIdMap(store))
+
+    def reload(self, folder):
+        """重新打开压缩后写出的快照，丢弃内存覆盖层（调用方需持写锁，实例本身保持不变）"""
+        fresh = self.load_lazy(folder, self.embedding_function)
+        self.index, self.docstore, self.index_to_docstore_id = fresh.index, fresh.docstore, fresh.index_to_docstore_id
+
+    @classmethod
+    def from_store(cls, vectorstore):
+        """把已加载的向量库转换为按需加载格式（内容不变，压缩时按新格式写快照）"""
+        return cls(vectorstore.embedding_function, vectorstore.index,
+                   vectorstore.docstore, vectorstore.index_to_docstore_id)
+
+    def to_memory(self):
+        """把全部内容读入内存，转换为普通 FAISS 向量库"""
+        index = self.index
+        if isinstance(index, MemmapFlatIndex):
+            index = faiss.IndexFlatL2(index.d)
+            if self.index.ntotal:
+                index.add(self.index.reconstruct_n(0, self.index.ntotal))
+        mapping = dict(self.index_to_docstore_id.items())
+        docstore = InMemoryDocstore({chunk_id: self.docstore.search(chunk_id) for chunk_id in mapping.values()})
+        return FAISS(self.embedding_function, index, docstore, mapping)
+
+    def save_local(self, folder_path, index_name="index", exclude=(), rebuild=None):
+        """写出快照；exclude 中的文本块不写入，其余文本块按原顺序重新编号
+
+        HNSW/IVF 索引无法直接删除向量，有文本块需要移除时由 rebuild(保留的位置列表) 返回重建后的索引。
+        """
+        os.makedirs(folder_path, exist_ok=True)
+        index = self.index
+        total = index.ntotal
+        mapping = self.index_to_docstore_id
+        exclude = set(exclude)
+        if not exclude:
+            removed = set()
+        elif isinstance(mapping, LazyIdMap):
+            removed = set(mapping.positions_of(exclude).values())
+        else:
+            removed = {position for position, chunk_id in mapping.items() if chunk_id in exclude}
+        if isinstance(index, (MemmapFlatIndex, faiss.IndexFlat)):
+            # 分批写出向量矩阵，避免一次性复制整个索引
+            index_file = VECTORS_FILE
+            with open(os.path.join(folder_path, VECTORS_FILE), "wb") as f:
+                for start in range(0, total, WRITE_BATCH_ROWS):
+                    block = index.reconstruct_n(start, min(WRITE_BATCH_ROWS, total - start))
+                    if removed:
+                        block = block[[i for i in range(len(block)) if start + i not in removed]]
+                    f.write(np.ascontiguousarray(block, dtype="float32").tobytes())
+        else:
+            index_file = INDEX_FILE
+            if removed:
+                if rebuild is None:
+                    raise ValueError("移除 HNSW/IVF 索引中的文本块需要提供 rebuild")
+                index = rebuild([position for position in range(total) if position not in removed])
+            faiss.write_index(index, os.path.join(folder_path, INDEX_FILE))
+
+        items = mapping.items() if isinstance(mapping, LazyIdMap) else sorted(mapping.items())
+
+        def rows():
+            new_position = 0
+            for position, chunk_id in items:
+                if position in removed:
+                    continue
+                doc = self.docstore.search(chunk_id)
+                if isinstance(doc, Document):
+                    yield new_position, chunk_id, doc.page_content, doc.metadata
+                else:
+                    # 位置必须与向量一一对应，缺失的文档以空内容占位
+                    yield new_position, chunk_id, "", {}
+                new_position += 1
+
+        ChunkStore.write(os.path.join(folder_path, DOCSTORE_FILE), rows(),
+                         {"dimension": index.d, "index_file": index_file})
@@ -0,0 +1,238 @@
+"""
+离线模拟服务商 HTTP 服务
+
+按 ChatBot.py 实际使用的接口格式应答，用于在不消耗真实 API 额度的情况下压测 call_model_api：
+- OpenAI 兼容的 .../chat/completions（豆包、DeepSeek、通义千问、智谱清言、Kimi、OpenAI、grok，以及混元的 OpenAI SDK）；
+- 文心一言 /rpc/2.0/...：回答在 result 字段；
+- MiniMax /v1/text/chatcompletion_v2：OpenAI 格式附带 base_resp，流式输出末尾附带完整 message；
+- DALL-E /v1/images/generations：图片地址在 data[].url。
+对话接口在请求体 stream=true 时以 SSE 分块输出。
+
+可配置首字节延迟（含抖动）、输出 token 速率、回答长度和错误注入比例。配合 http_client 的
+LLM_HTTP_BASE_URL_OVERRIDE 把各服务商请求改发到本服务：
+
+    python mock_provider.py --port 8900 --latency 0.3 --token-rate 50 --error-rate 0.02
+    LLM_HTTP_BASE_URL_OVERRIDE=http://127.0.0.1:8900 streamlit run ChatBot.py
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# 模拟回答按 token 逐个输出（每项视为一个 token）
+RESPONSE_TOKENS = ["这是", "模拟", "服务商", "返回", "的", "回答", "，", "用于", "离线", "压测", "。"]
+ERROR_STATUSES = (429, 500, 503)
+
+
+class MockConfig:
+    """模拟服务的行为配置（线程安全地抽取随机延迟和错误）"""
+
+    def __init__(self, latency=0.2, jitter=0.05, token_rate=50.0, response_tokens=64, error_rate=0.0, seed=None):
+        self.latency = latency  # 首字节延迟（秒）
+        self.jitter = jitter  # 首字节延迟的随机抖动上限（秒）
+        self.token_rate = token_rate  # 每秒输出的 token 数，0 表示不限速
+        self.response_tokens = response_tokens  # 每个回答的 token 数
+        self.error_rate = error_rate  # 返回错误状态码的请求比例
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw_latency(self):
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def draw_error(self):
+        """按错误比例抽取错误状态码，不注入错误时返回 None"""
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                return self._random.choice(ERROR_STATUSES)
+        return None
+
+    def token_interval(self):
+        return 1 / self.token_rate if self.token_rate > 0 else 0
+
+    def completion_tokens(self):
+        return [RESPONSE_TOKENS[i % len(RESPONSE_TOKENS)] for i in range(self.response_tokens)]
+
+
+def wire_format(path):
+    """按请求路径判断服务商接口格式，未知路径返回 None"""
+    if path.endswith("/images/generations"):
+        return "dalle"
+    if path.startswith("/rpc/2.0/"):
+        return "wenxin"
+    if path.endswith("/chatcompletion_v2"):
+        return "minimax"
+    if path.endswith("/chat/completions"):
+        return "openai"
+    return None
+
+
+def count_prompt_tokens(body):
+    """粗略估算请求的提示词 token 数（每两个字符计一个）"""
+    messages = body.get("messages") or [{"content": body.get("prompt", "")}]
+    return sum(len(str(message.get("content", ""))) for message in messages) // 2 + 1
+
+
+def completion_body(wire, body, text, usage):
+    """非流式回答的响应体"""
+    if wire == "wenxin":
+        return {"id": f"as-{uuid.uuid4().hex[:10]}", "object": "chat.completion", "created": int(time.time()),
+                "result": text, "is_truncated": False, "need_clear_history": False, "usage": usage}
+    response = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": usage
+    }
+    if wire == "minimax":
+        response["base_resp"] = {"status_code": 0, "status_msg": "success"}
+    return response
+
+
+def stream_events(wire, body, tokens, usage):
+    """流式回答的 SSE 事件（不含间隔），产出 data 字段内容"""
+    if wire == "wenxin":
+        for i, token in enumerate(tokens):
+            yield json.dumps({"result": token, "is_end": False, "sentence_id": i}, ensure_ascii=False)
+        yield json.dumps({"result": "", "is_end": True, "sentence_id": len(tokens), "usage": usage})
+        return
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    def chunk(choices, **extra):
+        return json.dumps({"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                           "model": body.get("model", "mock"), "choices": choices, **extra}, ensure_ascii=False)
+
+    for i, token in enumerate(tokens):
+        delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+        yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+    if wire == "minimax":
+        # MiniMax 在流末尾附带完整的 message 和用量
+        yield chunk([{"index": 0, "finish_reason": "stop",
+                      "message": {"role": "assistant", "content": "".join(tokens)}}],
+                    usage=usage, base_resp={"status_code": 0, "status_msg": "success"})
+    else:
+        yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        yield chunk([], usage=usage)
+    yield "[DONE]"
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        config = self.server.config
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON body", "type": "invalid_request_error"}})
+            return
+        wire = wire_format(urlparse(self.path).path)
+        if wire is None:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}", "type": "not_found"}})
+            return
+
+        error_status = config.draw_error()
+        time.sleep(config.draw_latency())
+        if error_status:
+            if wire == "wenxin":
+                self._send_json(error_status, {"error_code": 18, "error_msg": "mock injected error"})
+            else:
+                self._send_json(error_status, {"error": {"message": "mock injected error", "type": "server_error",
+                                                         "code": error_status}})
+            return
+
+        if wire == "dalle":
+            self._send_json(200, {"created": int(time.time()),
+                                  "data": [{"url": f"https://mock.invalid/images/{uuid.uuid4().hex}.png"}]})
+            return
+
+        tokens = config.completion_tokens()
+        prompt_tokens = count_prompt_tokens(body)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        if body.get("stream"):
+            self._send_stream(wire, body, tokens, usage, config.token_interval())
+        else:
+            time.sleep(len(tokens) * config.token_interval())
+            self._send_json(200, completion_body(wire, body, "".join(tokens), usage))
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, wire, body, tokens, usage, interval):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, data in enumerate(stream_events(wire, body, tokens, usage)):
+            if i and i <= len(tokens):
+                time.sleep(interval)  # 首个 token 随首字节延迟到达，之后按 token 速率输出
+            event = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass  # 压测时不逐条打印请求
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端连接池丢弃空闲连接时会重置连接，不打印堆栈
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_server(config=None, host="127.0.0.1", port=0):
+    """在后台线程中启动模拟服务，port 为 0 时自动分配端口（见返回值的 server_port）"""
+    server = MockProviderServer((host, port), MockProviderHandler)
+    server.config = config or MockConfig()
+    threading.Thread(target=server.serve_forever, name="mock-provider", daemon=True).start()
+    return server
+
+
+def add_config_arguments(parser):
+    """模拟服务的行为参数（压测脚本复用）"""
+    parser.add_argument("--latency", type=float, default=0.2, help="首字节延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="首字节延迟的随机抖动上限（秒）")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="每秒输出的 token 数，0 为不限速")
+    parser.add_argument("--response-tokens", type=int, default=64, help="每个回答的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误状态码的请求比例")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+
+
+def config_from_args(args):
+    return MockConfig(args.latency, args.jitter, args.token_rate, args.response_tokens, args.error_rate, args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线模拟服务商 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    server = start_server(config_from_args(args), args.host, args.port)
+    print(f"模拟服务已启动：http://{args.host}:{server.server_port}（Ctrl+C 退出）")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
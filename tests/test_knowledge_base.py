@@ -0,0 +1,92 @@
+"""
+知识库入库与后台清理的回归测试
+
+以 Streamlit 裸模式加载 ChatBot.py，用按字符二元组散列的确定性向量代替 embedding 模型，
+知识库写在临时目录中。
+"""
+import os
+import runpy
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+THREAD_TIMEOUT = 30  # 秒，超时视为死锁
+
+
+class HashEmbeddings(Embeddings):
+    """按字符二元组散列到固定维度的确定性向量"""
+
+    dimension = 64
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dimension, dtype="float32")
+        for pair in zip(text, text[1:]):
+            vector[hash(pair) % self.dimension] += 1
+        norm = np.linalg.norm(vector) or 1.0
+        return (vector / norm).tolist()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """加载 ChatBot.py 并返回其函数使用的全局命名空间"""
+    monkeypatch.setenv("METRICS_PORT", "0")
+    monkeypatch.setenv("TRACE_LOG_PATH", "")
+    monkeypatch.setenv("EMBEDDING_WARMUP", "0")
+    monkeypatch.setenv("CHAT_STORE_PATH", str(tmp_path / "chat.sqlite"))
+    namespace = runpy.run_path(os.path.join(ROOT, "ChatBot.py"), run_name="chatbot_test")
+    app = namespace["rag_index_document"].__globals__  # run_path 返回的是副本，替换需作用于函数实际引用的字典
+    embeddings = HashEmbeddings()
+    app["get_embeddings"] = lambda: embeddings
+    import streamlit as st
+    st.session_state.chromadb_path = str(tmp_path / "kb")
+    st.session_state.rag_data = []
+    yield app
+    app["st"].cache_resource.clear()
+
+
+def run_in_thread(fn, *args):
+    """在新线程中执行（模拟 Streamlit 每次运行脚本使用不同的线程），超时则判定为死锁"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn(*args)), daemon=True)
+    thread.start()
+    thread.join(THREAD_TIMEOUT)
+    assert not thread.is_alive(), f"{fn.__name__} 在 {THREAD_TIMEOUT} 秒内未结束"
+    return result[0]
+
+
+def document(topic, paragraphs=20):
+    return "\n\n".join(f"{topic}第{i}段：公司年报披露营业收入与净利润的变化情况。" * 3 for i in range(paragraphs))
+
+
+def test_ingest_after_scheduled_purge(app):
+    db_root = app["st"].session_state.chromadb_path
+    assert app["rag_index_document"](document("旧版"), "report.txt")
+    # 同一来源的新版本把旧版本的文本块记为墓碑
+    assert app["rag_index_document"](document("新版"), "report.txt")
+    registry = app["get_document_registry"](db_root)
+    assert registry.snapshot()["pending_purge"] > 0
+
+    app["PURGE_MIN_CHUNKS"] = 1
+    vectorstore = app["get_vector_store"]()
+    assert run_in_thread(app["schedule_purge"], vectorstore, db_root)
+    # 清理排队或进行中时，之后的入库只需等待清理结束，不能死锁
+    assert run_in_thread(app["rag_index_document"], document("附注"), "notes.txt")
+
+    deadline = time.monotonic() + THREAD_TIMEOUT
+    while registry.snapshot()["pending_purge"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert registry.snapshot()["pending_purge"] == 0
+    wal = app["get_vector_wal"](os.path.join(db_root, "faiss_index"))
+    assert wal.purge_lock.acquire(timeout=THREAD_TIMEOUT)
+    wal.purge_lock.release()
+    chunk_ids = {chunk_id for chunk_id, _ in app["iter_vector_store_documents"](vectorstore)}
+    assert not chunk_ids & registry.deleted_ids()
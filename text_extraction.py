@@ -0,0 +1,154 @@
+"""
+文档文本提取
+
+与 Streamlit 无关的纯函数，供进程池中的工作进程调用
+（Streamlit 执行的脚本模块无法被子进程导入，因此提取逻辑放在独立模块中）。
+PDF 的 extract_text 是 CPU 密集型且持有 GIL，多个文件需在独立进程中并行提取。
+
+PDF 以内存映射方式打开并逐页提取，提取结果按文件内容哈希逐页写入 SQLite 缓存，
+同一文件再次提交时直接读取缓存；文本始终逐页流转，峰值内存不随文件大小增长。
+
+PyPDF2、python-docx、pandas 在解析对应类型时才导入，导入本模块本身只依赖标准库。
+"""
+import io
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+PAGE_CACHE_COMMIT_EVERY = 20  # 每提取多少页提交一次缓存事务
+
+
+def get_file_type(file_name):
+    """根据文件名返回小写扩展名"""
+    return file_name.split('.')[-1].lower()
+
+
+def iter_pdf_pages(stream):
+    """逐页产出 PDF 文本 (页码, 文本)，页码从 1 开始"""
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(stream)
+    for page_number, page in enumerate(pdf_reader.pages, start=1):
+        yield page_number, page.extract_text() or ""
+
+
+def iter_file_pages(stream, file_name):
+    """逐页产出文件文本 (页码, 文本)
+
+    只有 PDF 有页码；其他类型整体作为一页产出，页码为 0。
+    不支持的文件类型抛出 ValueError。
+    """
+    file_type = get_file_type(file_name)
+    if file_type == 'pdf':
+        yield from iter_pdf_pages(stream)
+        return
+    content = stream.read()
+    if file_type == 'txt':
+        # 处理文本文件
+        yield 0, content.decode('utf-8')
+    elif file_type in ['docx', 'doc']:
+        # 处理 Word 文件
+        from docx import Document
+        doc = Document(io.BytesIO(content))
+        yield 0, "\n".join([para.text for para in doc.paragraphs])
+    elif file_type in ['csv', 'xlsx', 'xls']:
+        # 处理表格文件
+        import pandas as pd
+        if file_type == 'csv':
+            df = pd.read_csv(io.BytesIO(content))
+        else:
+            df = pd.read_excel(io.BytesIO(content))
+        yield 0, df.to_string()
+    else:
+        raise ValueError(f"不支持的文件类型：{file_type}")
+
+
+def extract_text(file_name, content):
+    """从文件字节内容中提取完整文本，不支持的文件类型返回 None"""
+    try:
+        return "\n".join(text for _, text in iter_file_pages(io.BytesIO(content), file_name))
+    except ValueError:
+        return None
+
+
+class PageTextCache:
+    """按文件内容哈希缓存逐页提取文本的 SQLite 存储（可被多个进程同时打开）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "file_hash TEXT, page INTEGER, text TEXT, PRIMARY KEY (file_hash, page))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "file_hash TEXT PRIMARY KEY, page_count INTEGER, extracted_at REAL)"
+        )
+        self._conn.commit()
+
+    def page_count(self, file_hash):
+        """已完整提取的文件返回页数，否则返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT page_count FROM documents WHERE file_hash = ?", (file_hash,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def iter_pages(self, file_hash, batch_size=16):
+        """按页码顺序分批读取缓存的页面文本 (页码, 文本)"""
+        last_page = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT page, text FROM pages WHERE file_hash = ? AND page > ? ORDER BY page LIMIT ?",
+                    (file_hash, last_page, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_page = rows[-1][0]
+
+    def store(self, file_hash, pages):
+        """写入逐页产出的文本，全部写完后才标记为完整，返回页数"""
+        self._conn.execute("DELETE FROM pages WHERE file_hash = ?", (file_hash,))
+        count = 0
+        for page_number, text in pages:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (file_hash, page, text) VALUES (?, ?, ?)",
+                (file_hash, page_number, text)
+            )
+            count += 1
+            if count % PAGE_CACHE_COMMIT_EVERY == 0:
+                self._conn.commit()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (file_hash, page_count, extracted_at) VALUES (?, ?, ?)",
+            (file_hash, count, time.time())
+        )
+        self._conn.commit()
+        return count
+
+    def close(self):
+        self._conn.close()
+
+
+def extract_pages_to_cache(path, file_name, file_hash, cache_path):
+    """工作进程入口：以内存映射方式打开落盘的上传文件，逐页提取并写入页面缓存
+
+    返回 (页数, 提取耗时秒数)；不支持的文件类型抛出 ValueError。
+    """
+    start = time.perf_counter()
+    cache = PageTextCache(cache_path)
+    try:
+        if os.path.getsize(path) == 0:
+            # 空文件无法内存映射
+            return cache.store(file_hash, []), time.perf_counter() - start
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                page_count = cache.store(file_hash, iter_file_pages(mapped, file_name))
+    finally:
+        cache.close()
+    return page_count, time.perf_counter() - start
@@ -0,0 +1,197 @@
+"""
+按 token 预算组装提示词
+
+维护各模型的上下文窗口，并按模型计数 token：OpenAI 模型在安装了 tiktoken 时使用对应编码精确计数，
+其余服务商使用本地估算器（中文字符与其他字符分别折算），并用服务商返回的 prompt_tokens
+持续校准每个模型的估算系数。打包函数按预算从新到旧保留历史消息、按检索排序填充参考文本。
+"""
+import re
+import threading
+
+# 各模型的上下文窗口（token）
+DEFAULT_CONTEXT_WINDOW = 8192
+MODEL_CONTEXT_WINDOWS = {
+    "豆包": 32768,
+    "DeepSeek-V3": 65536,
+    "DeepSeek-R1(深度推理)": 65536,
+    "通义千问": 131072,
+    "文心一言": 8192,
+    "智谱清言": 128000,
+    "MiniMax": 16384,
+    "o1(深度推理)": 128000,
+    "Kimi(视觉理解)": 8192,
+    "GPTs(聊天、语音识别)": 128000,
+    "grok2": 131072,
+    "混元生文": 32768,
+}
+# 可用 tiktoken 精确计数的模型及其编码
+TIKTOKEN_ENCODINGS = {
+    "GPTs(聊天、语音识别)": "o200k_base",
+    "o1(深度推理)": "o200k_base",
+}
+# 估算器：每个中文字符折算的 token 数（中文词表较大的模型一个 token 常覆盖 1~2 个汉字）
+DEFAULT_CJK_TOKENS_PER_CHAR = 1.0
+CJK_TOKENS_PER_CHAR = {
+    "DeepSeek-V3": 0.6,
+    "DeepSeek-R1(深度推理)": 0.6,
+    "通义千问": 0.7,
+    "智谱清言": 0.7,
+    "文心一言": 0.7,
+    "豆包": 0.7,
+    "混元生文": 0.7,
+    "MiniMax": 0.8,
+}
+OTHER_CHARS_PER_TOKEN = 4  # 英文、数字和符号约 4 个字符 1 token
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色标记等固定开销
+CALIBRATION_WEIGHT = 0.2  # 校准系数的指数滑动平均权重
+CALIBRATION_BOUNDS = (0.5, 2.0)  # 单次观测的比例超出该范围时视为异常，不参与校准
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def context_window(model_type):
+    """模型的上下文窗口大小（token）"""
+    return MODEL_CONTEXT_WINDOWS.get(model_type, DEFAULT_CONTEXT_WINDOW)
+
+
+def prompt_budget(model_type, share, reserve_output):
+    """本轮提示词可用的 token 数：不超过上下文窗口的 share，且为回答预留 reserve_output 个 token"""
+    window = context_window(model_type)
+    return max(min(int(window * share), window - reserve_output), 0)
+
+
+class TokenCounter:
+    """按模型计数 token（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encodings = {}  # 编码名 -> tiktoken 编码（不可用时为 None）
+        self._scales = {}  # 模型 -> 估算器校准系数
+
+    def _encoding(self, model_type):
+        name = TIKTOKEN_ENCODINGS.get(model_type)
+        if name is None:
+            return None
+        with self._lock:
+            if name not in self._encodings:
+                try:
+                    import tiktoken
+                    self._encodings[name] = tiktoken.get_encoding(name)
+                except Exception:
+                    # 未安装 tiktoken 或无法获取编码文件时退回估算器
+                    self._encodings[name] = None
+            return self._encodings[name]
+
+    def is_exact(self, model_type):
+        return self._encoding(model_type) is not None
+
+    def estimate(self, text, model_type=None):
+        """未校准的本地估算"""
+        if not text:
+            return 0
+        cjk_count = len(_CJK_PATTERN.findall(text))
+        ratio = CJK_TOKENS_PER_CHAR.get(model_type, DEFAULT_CJK_TOKENS_PER_CHAR)
+        return int(cjk_count * ratio + (len(text) - cjk_count + OTHER_CHARS_PER_TOKEN - 1) / OTHER_CHARS_PER_TOKEN)
+
+    def count(self, text, model_type=None):
+        if not text:
+            return 0
+        encoding = self._encoding(model_type)
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return max(int(self.estimate(text, model_type) * self._scales.get(model_type, 1.0)), 1)
+
+    def count_messages(self, messages, model_type=None):
+        return sum(self.count(msg["content"], model_type) + MESSAGE_OVERHEAD_TOKENS
+                   for msg in messages if isinstance(msg.get("content"), str))
+
+    def calibrate(self, model_type, messages, prompt_tokens):
+        """用服务商返回的 prompt_tokens 校准估算器（精确计数的模型无需校准）"""
+        if not prompt_tokens or self.is_exact(model_type):
+            return
+        estimated = sum(self.estimate(msg["content"], model_type) + MESSAGE_OVERHEAD_TOKENS
+                        for msg in messages if isinstance(msg.get("content"), str))
+        if not estimated:
+            return
+        observed = prompt_tokens / estimated
+        if not CALIBRATION_BOUNDS[0] <= observed <= CALIBRATION_BOUNDS[1]:
+            return
+        with self._lock:
+            scale = self._scales.get(model_type, 1.0)
+            self._scales[model_type] = scale + (observed - scale) * CALIBRATION_WEIGHT
+
+    def scales(self):
+        with self._lock:
+            return dict(self._scales)
+
+    def truncate(self, text, budget, model_type=None):
+        """截断文本使其不超过 budget 个 token"""
+        if budget <= 0:
+            return ""
+        encoding = self._encoding(model_type)
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= budget else encoding.decode(tokens[:budget])
+        total = self.count(text, model_type)
+        if total <= budget:
+            return text
+        end = int(len(text) * budget / total)
+        while end > 0 and self.count(text[:end], model_type) > budget:
+            end = int(end * 0.9)
+        return text[:end]
+
+
+# 进程级单例：校准系数由所有会话共享
+_counter = TokenCounter()
+
+
+def get_counter():
+    return _counter
+
+
+def count_tokens(text, model_type=None):
+    return _counter.count(text, model_type)
+
+
+def count_messages(messages, model_type=None):
+    return _counter.count_messages(messages, model_type)
+
+
+def calibrate(model_type, messages, prompt_tokens):
+    _counter.calibrate(model_type, messages, prompt_tokens)
+
+
+def fit_history(history, budget, model_type=None):
+    """从最新的消息往前保留历史，总 token 数不超过 budget，返回按时间顺序排列的消息"""
+    kept = []
+    used = 0
+    for msg in reversed(history):
+        cost = _counter.count(msg["content"], model_type) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    # 不以助手消息开头，避免上下文缺少对应的问题
+    while kept and kept[0]["role"] == "assistant":
+        kept.pop(0)
+    return kept
+
+
+def pack_texts(texts, budget, model_type=None, min_tail_tokens=64):
+    """按顺序填充文本直到用完 budget，放不下的文本在剩余预算足够时截断后加入，返回 (文本列表, token 数)"""
+    packed = []
+    used = 0
+    for text in texts:
+        cost = _counter.count(text, model_type)
+        if used + cost <= budget:
+            packed.append(text)
+            used += cost
+            continue
+        remaining = budget - used
+        if remaining >= min_tail_tokens:
+            tail = _counter.truncate(text, remaining, model_type)
+            packed.append(tail)
+            used += _counter.count(tail, model_type)
+        break
+    return packed, used
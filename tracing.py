@@ -0,0 +1,230 @@
+"""
+轻量级分阶段耗时追踪
+
+每个阶段（搜索、抓取、提取、切分、编码、写索引、检索、模型首字延迟与总耗时）记录为一个 span，
+按阶段和模型打标签，同时：
+- 以 JSON 行写入结构化日志（每行一个 span，带所属轮次的 trace_id）；
+- 累计到进程级 Prometheus 直方图和错误计数，由本地 /metrics 端点以文本格式输出；
+- 追加到当前轮次的 Trace（通过 contextvars 传递，线程池中的分支需复制上下文后执行），供界面展示本轮耗时分解。
+"""
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 直方图桶上界（秒）：覆盖本地检索的毫秒级到模型生成的分钟级
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_PREFIX = "llm_agent"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 日志文件轮转大小
+LOG_BACKUP_COUNT = 3
+
+logger = logging.getLogger("multi_llm_agent.trace")
+logger.propagate = False  # 不混入 Streamlit 的日志输出
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """一轮对话内记录的 span 列表（多个分支线程可同时追加）"""
+
+    def __init__(self, model_type=""):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.model_type = model_type
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.spans = []
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, span):
+        with self._lock:
+            if self.elapsed is None:
+                self.spans.append(span)
+
+    def totals(self):
+        """按阶段汇总 {阶段: (总耗时, 次数)}，保持阶段首次出现的顺序"""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                seconds, count = totals.get(span["stage"], (0.0, 0))
+                totals[span["stage"]] = (seconds + span["seconds"], count + 1)
+        return totals
+
+
+def start_trace(model_type=""):
+    """开始一轮追踪并设为当前上下文的 Trace"""
+    trace = Trace(model_type)
+    trace._token = _current_trace.set(trace)
+    return trace
+
+
+def end_trace(trace):
+    """结束追踪：此后到达的 span 只写日志和指标，不再计入本轮"""
+    trace.elapsed = time.perf_counter() - trace.started
+    if trace._token is not None:
+        try:
+            _current_trace.reset(trace._token)
+        except ValueError:
+            _current_trace.set(None)  # 在其他上下文中结束时无法还原，直接清空
+        trace._token = None
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class Metrics:
+    """进程级直方图与计数（标签：阶段、模型）"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # (stage, model_type) -> {"buckets": [...], "sum": 秒, "count": 次数}
+        self._errors = {}  # (stage, model_type) -> 次数
+
+    def observe(self, stage, model_type, seconds, error=False):
+        key = (stage, model_type or "none")
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def snapshot(self):
+        """{(stage, model_type): {"count", "sum", "errors"}}"""
+        with self._lock:
+            return {key: {"count": h["count"], "sum": h["sum"], "errors": self._errors.get(key, 0)}
+                    for key, h in self._histograms.items()}
+
+    def render(self):
+        """Prometheus 文本格式"""
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Latency of each pipeline stage in seconds.", f"# TYPE {name} histogram"]
+        with self._lock:
+            histograms = {key: (list(h["buckets"]), h["sum"], h["count"]) for key, h in self._histograms.items()}
+            errors = dict(self._errors)
+        for (stage, model_type), (buckets, total, count) in sorted(histograms.items()):
+            labels = f'stage="{_escape(stage)}",model_type="{_escape(model_type)}"'
+            for bound, value in zip(self.buckets, buckets):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {value}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        errors_name = f"{METRIC_PREFIX}_stage_errors_total"
+        lines += [f"# HELP {errors_name} Stage executions that raised an exception.", f"# TYPE {errors_name} counter"]
+        for (stage, model_type), value in sorted(errors.items()):
+            lines.append(f'{errors_name}{{stage="{_escape(stage)}",model_type="{_escape(model_type)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def observe(stage, seconds, model_type=None, error=False, **attrs):
+    """记录一个已测得耗时的 span（如流式回答结束时得到的首字延迟）"""
+    trace = _current_trace.get()
+    if model_type is None:
+        model_type = trace.model_type if trace else ""
+    span = {"stage": stage, "model_type": model_type, "seconds": seconds, "error": error, **attrs}
+    _metrics.observe(stage, model_type, seconds, error)
+    if trace is not None:
+        trace.add(span)
+    if logger.handlers:
+        logger.info(json.dumps({
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "trace_id": trace.trace_id if trace else None,
+            **span
+        }, ensure_ascii=False, default=str))
+    return span
+
+
+@contextmanager
+def span(stage, model_type=None, **attrs):
+    """计时一个阶段；抛出异常时记为错误并继续向外抛出。可通过 yield 的 dict 补充属性"""
+    extra = dict(attrs)
+    start = time.perf_counter()
+    error = False
+    try:
+        yield extra
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, model_type, error, **extra)
+
+
+def traced(stage):
+    """把整个函数记为一个阶段的装饰器"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def configure_log(path):
+    """配置 JSON 行日志：path 为文件路径（按大小轮转），"-" 输出到标准错误，空值不写日志"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    if not path:
+        return
+    if path == "-":
+        handler = logging.StreamHandler()
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不在标准错误中逐条打印抓取请求
+
+
+def start_metrics_server(host, port):
+    """在后台线程中启动 /metrics 端点，端口被占用时抛出 OSError"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server